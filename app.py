@@ -1,83 +1,816 @@
 import argparse
+import concurrent.futures
+import contextlib
 import glob
-import os 
-from vid_anon import audio_processing, frame_processing, utils
+import os
+import time
+import traceback
+from vid_anon import audio_processing, encoding, frame_processing, jobs, names, patching, profiling, utils
+from vid_anon.cache import ResultCache
 
-def main():
-    # Read in all of the command-line arguments
-    parser = argparse.ArgumentParser(description="Video anonymization tool")
+# Models loaded once per process and reused for every file that process anonymizes
+_models = {}
 
-    # TODO add GPU
-    parser.add_argument("input_dir", type=str)
-    parser.add_argument("--blur_face", help="Enable face blurring", action='store_true')
-    parser.add_argument("--blur_shirt", help="Enable shirt blurring to hide logos", action='store_true')
-    parser.add_argument("--redact_names", help="Remove proper nouns from audio", action='store_true')
-    parser.add_argument("--cut_first_last_mile", 
-                        help="Remove the first and last mile of driving to \
-                            protect participant address", type=str)
-    parser.add_argument("--output_dir", help="Where the anonymized files should be stored.\
-                                            default to store where this is run.",
-                        type=str, default='')
-    parser.add_argument("--clean_up", help="Delete intermediate files.", action='store_true')
+# Semaphores shared by the worker processes of a service, limiting how many of each stage
+# run at once across them
+_limits = {}
 
-    args = parser.parse_args()
+def load_models(args, limits=None):
+    """
+    Loads the models needed by the requested stages into this process. Run once in each
+    batch worker so every worker has its own MediaPipe and vosk models.
 
-    # Find all the files to anonymize (even with different namings)
-    files = glob.glob(f'{args.input_dir}/**/*.mp4', recursive=True)
-    files += glob.glob(f'{args.input_dir}/**/*.MP4', recursive=True)
+    Inputs:
+    args   - Namespace - the parsed command-line arguments
+    limits - dict      - semaphores by stage name, limiting how many processes run the stage
+                         at once
 
-    print('Anonymizing the following files:')
-    print(files) 
-    
-    # For each file, run the anonymization and keep track of the intermediate files
-    for file in files: 
-        # TODO add check to see if file has already been processed
+    Returns:
+    None
+    """
+    _limits.update(limits or {})
+    # Worker processes load their own detectors
+    if (args.blur_face or args.blur_shirt) and not args.process_workers and args.shards <= 1:
+        _models['detector'] = frame_processing.load_detector(args.engine, args.blur_shirt,
+                                                             args.max_faces, args.detect_width,
+                                                             args.roi_margin)
+    if args.redact_names:
+        _models['vosk'] = audio_processing.load_vosk(args.vosk_model)
+        _models['names'] = names.NameTagger(args.name_lists)
+
+@contextlib.contextmanager
+def stage(name):
+    """
+    Times a stage with the active profiler, first waiting for a free slot if the number of
+    them running at once is limited.
+    """
+    with _limits.get(name) or contextlib.nullcontext(), profiling.stage(name):
+        yield
+
+def get_blur_opts(args):
+    """
+    Collects the blurring options from the command-line arguments.
+
+    Inputs:
+    args - Namespace - the parsed command-line arguments
+
+    Returns:
+    A dictionary of options passed on to frame_processing.make_frame_blurrer.
+    """
+    return {'detect_every': args.detect_every,
+            'motion_thresh': args.motion_thresh,
+            'scene_thresh': args.scene_thresh,
+            'track_dilate': args.track_dilate,
+            'engine': args.engine,
+            'max_faces': args.max_faces,
+            'detect_width': args.detect_width,
+            'roi_margin': args.roi_margin,
+            'missed': args.missed}
+
+def get_encoder(args):
+    """
+    Sets up the video encoder from the command-line arguments. When several videos are
+    anonymized at once, the cores are split between them.
+
+    Inputs:
+    args - Namespace - the parsed command-line arguments
+
+    Returns:
+    The encoding.Encoder every stage encodes video with.
+    """
+    threads = args.encode_threads
+    if threads == 0 and args.jobs > 1:
+        threads = max(1, (os.cpu_count() or 1) // args.jobs)
+
+    return encoding.Encoder(args.encoder, args.preset, args.crf, threads)
+
+def get_redact_params(args, cache):
+    """
+    Collects everything the redacted audio depends on, for its cache key.
+
+    Inputs:
+    args  - Namespace   - the parsed command-line arguments
+    cache - ResultCache - the result cache, used to fingerprint the name lists
+
+    Returns:
+    A dictionary of the redaction options.
+    """
+    name_lists = args.name_lists or []
+    if cache is not None:
+        name_lists = [cache.file_key(name_list) for name_list in name_lists]
+
+    return {'model': args.vosk_model,
+            'redact_mode': args.redact_mode,
+            'fade_ms': args.fade_ms,
+            'name_lists': name_lists,
+            'google': not args.offline}
+
+def get_tracks_opts(args, output_file, cache=None):
+    """
+    Works out where a video's landmark tracks are saved to or blurred from.
+
+    Inputs:
+    args        - Namespace   - the parsed command-line arguments
+    output_file - String      - the string format for the final output file
+    cache       - ResultCache - the result cache, used to fingerprint tracks being blurred from
+
+    Returns:
+    The tracks_dir and from_tracks options for blur_vid/stream_vid, and a fingerprint of the
+    tracks being blurred from (None if not used) for the cache key.
+    """
+    tracks_dir = output_file.format('tracks')
+    opts = {'tracks_dir': tracks_dir if args.save_tracks else None,
+            'from_tracks': tracks_dir if args.from_tracks else None}
+
+    fingerprint = None
+    if cache is not None and args.from_tracks:
+        fingerprint = [cache.file_key(os.path.join(tracks_dir, name))
+                       for name in ('tracks.json', 'pose.bin', 'faces.bin', 'tracked.bin')]
+
+    return opts, fingerprint
+
+def run_stage(cache, key, out_file, stage):
+    """
+    Runs a stage that writes a file, unless the cache shows it already ran on the same input
+    with the same options and its file hasn't changed since.
+
+    Inputs:
+    cache    - ResultCache - the result cache, or None to always run the stage
+    key      - String      - the stage's cache key
+    out_file - String      - where the stage writes its file
+    stage    - function    - runs the stage and returns the file it made
+
+    Returns:
+    The file the stage made.
+    """
+    if cache is None:
+        return stage()
+
+    cached = cache.get_file(key)
+    if cached is not None:
+        print(f'{cached} is already up to date...continuing...')
+        return cached
+
+    # Anything already at the output wasn't made from this input with these options (or was
+    # only half written), so it can't be reused
+    if os.path.exists(out_file):
+        os.remove(out_file)
+    made = stage()
+    cache.put_file(key, made)
+
+    return made
+
+def get_cut_times(file, args, cache, file_key, timings):
+    """
+    Looks up the first/last mile cut for a video, using the cache when possible.
+
+    Inputs:
+    file     - String      - the video to anonymize
+    args     - Namespace   - the parsed command-line arguments
+    cache    - ResultCache - the result cache, or None
+    file_key - String      - the cache key of the video
+    timings  - dict        - the start/stop times read from the timings file once for the batch
+
+    Returns:
+    The (start, end) times to keep in seconds, or None if the video isn't cut.
+    """
+    if not args.cut_first_last_mile:
+        return None
+    if cache is None:
+        return frame_processing.get_cut_times(file, timings)
+
+    timings_file = f'{args.input_dir}/{args.cut_first_last_mile}'
+    bounds_key = cache.stage_key(file_key, 'cut_bounds', {'timings': cache.file_key(timings_file),
+                                                          'unit': 'seconds'})
+    bounds = cache.get_json(bounds_key)
+    if bounds is None:
+        bounds = {'cut_times': frame_processing.get_cut_times(file, timings)}
+        cache.put_json(bounds_key, bounds)
+
+    return tuple(bounds['cut_times']) if bounds['cut_times'] is not None else None
+
+def anonymize_file(file, args, temp_names=False, timings=None):
+    """
+    Runs every requested anonymization stage on a single video. With a cache, every stage
+    already done on the same input with the same options is skipped, so a rerun picks up at
+    the first stage that isn't cached.
+
+    Inputs:
+    file       - String    - the video to anonymize
+    args       - Namespace - the parsed command-line arguments
+    temp_names - Boolean   - whether intermediate files get names unique to the input path
+    timings    - dict      - the first/last mile start/stop times of the batch, from
+                             frame_processing.read_timings
+
+    Returns:
+    A dictionary with the file, where the anonymized video was saved, whether it succeeded,
+    the error if it failed, how long it took and, when profiling, the profile summary.
+    """
+    result = {'file': file, 'output': None, 'status': 'ok', 'error': None}
+    start_time = time.time()
+    if args.profile:
+        profiling.start()
+    if args.cprofile:
+        profiling.start_cprofile()
+    try:
         print(f'\nAnonymizing {file}...Please be patient, each step may take a few minutes...\n')
         file_tracking = []
 
         # Builds a format string for the output file depending on the suffix
         output_file = utils.get_output(file, args.input_dir, args.output_dir)
+        if os.path.dirname(output_file):
+            os.makedirs(os.path.dirname(output_file), exist_ok=True)
+        if temp_names:
+            temp_file = utils.get_temp_output(file, args.input_dir, args.output_dir)
+        else:
+            temp_file = output_file
+
+        # Cache keys chain from the content of the original file through each stage's options
+        cache = None
+        video_key = None
+        if args.cache_dir:
+            cache = ResultCache(args.cache_dir, int(args.cache_size * 1024**3))
+            video_key = cache.file_key(file)
+        key = lambda parent, stage, params=None: cache.stage_key(parent, stage, params) if cache else None
+        encoder = get_encoder(args)
+        cut_times = get_cut_times(file, args, cache, video_key, timings)
+        if cut_times is not None:
+            video_key = key(video_key, 'cut', {'cut_times': cut_times,
+                                               'fast': not args.reencode_cut,
+                                               'encoder': encoder.params()})
+
+        # Decode and encode the video once with no intermediate video files
+        if args.stream:
+            with stage('stream'):
+                result['output'] = stream_file(file, args, output_file, temp_file, cut_times,
+                                               cache, video_key)
+            return result
 
         # Remove the first and last mile to anonymize home location of drivers in videos
-        # If no cut necessary/found in the timings file, returns original file
-        if args.cut_first_last_mile:
-            cut_file = frame_processing.cut_vid(file, output_file.format('cut.mp4'), 
-                                                f'{args.input_dir}/{args.cut_first_last_mile}')
+        if cut_times is not None:
+            with stage('cut'):
+                cut_file = run_stage(cache, video_key, temp_file.format('cut.mp4'),
+                                     lambda: frame_processing.cut_vid(file, temp_file.format('cut.mp4'),
+                                                                      cut_times,
+                                                                      fast=not args.reencode_cut,
+                                                                      encoder=encoder))
             if cut_file != file:
                 file = cut_file
                 file_tracking += [file]
 
         # Extracts the audio from the cut file
-        audio_file = audio_processing.get_audio(file, output_file.format('audio.wav'))
+        audio_key = key(video_key, 'audio')
+        with stage('extract'):
+            audio_file = run_stage(cache, audio_key, temp_file.format('audio.wav'),
+                                   lambda: audio_processing.get_audio(file, temp_file.format('audio.wav')))
         file_tracking += [audio_file]
 
         # Removes proper nouns from the separated audio file
         if args.redact_names:
-            chunk_files = audio_processing.redact_names(audio_file, 
-                                                        output_file.format('redacted.wav'), 
-                                                        args.output_dir)
-
-            # The redacted file is the first in the list, all others are temporary "chunks" for easier
-            # processing
-            if audio_file != chunk_files[0]:
-                audio_file = chunk_files[0]
-                file_tracking += chunk_files
-            else:
-                file_tracking += chunk_files[1:]
+            redacted_key = key(audio_key, 'redact', get_redact_params(args, cache))
+            redacted_file = run_stage(cache, redacted_key, temp_file.format('redacted.wav'),
+                                      lambda: redact_audio(audio_file, temp_file.format('redacted.wav'),
+                                                           args, cache, audio_key))
+
+            # The redacted file is only tracked when names were actually redacted
+            if audio_file != redacted_file:
+                audio_file = redacted_file
+                file_tracking += [audio_file]
+            audio_key = redacted_key
 
         # Blur the faces and logos on shirts
         if args.blur_face or args.blur_shirt:
-            file = frame_processing.blur_vid(file, output_file.format('blurred.mp4'), 
-                                             args.blur_shirt, args.blur_face)
+            tracks_opts, tracks_fingerprint = get_tracks_opts(args, output_file, cache)
+            blurred_key = key(video_key, 'blur', dict(get_blur_opts(args), blur_shirt=args.blur_shirt,
+                                                      blur_face=args.blur_face,
+                                                      save_tracks=args.save_tracks,
+                                                      tracks=tracks_fingerprint,
+                                                      shards=args.shards,
+                                                      shard_warmup=args.shard_warmup,
+                                                      encoder=encoder.params()))
+            blurred_file = temp_file.format('blurred.mp4')
+            with stage('blur'):
+                file = run_stage(cache, blurred_key, blurred_file,
+                                 lambda: frame_processing.blur_vid(file, blurred_file,
+                                                                   args.blur_shirt, args.blur_face,
+                                                                   workers=args.workers,
+                                                                   queue_size=args.queue_size,
+                                                                   detector=_models.get('detector'),
+                                                                   cache=cache, video_key=video_key,
+                                                                   encoder=encoder,
+                                                                   processes=args.process_workers,
+                                                                   shards=args.shards,
+                                                                   warmup=args.shard_warmup,
+                                                                   **tracks_opts,
+                                                                   **get_blur_opts(args)))
             file_tracking += [file]
-        
+            video_key = blurred_key
+
         # Re-combine the video and audio streams for the final video
-        audio_processing.merge_audio(audio_file, file, output_file.format('anon.mp4'))
-    
+        anon_file = output_file.format('anon.mp4')
+        with stage('merge'):
+            merged_key = key(video_key, 'merge', {'audio': audio_key,
+                                                  'encoder': encoder.params()})
+            result['output'] = run_stage(cache, merged_key, anon_file,
+                                         lambda: audio_processing.merge_audio(audio_file, file,
+                                                                              anon_file, encoder))
+
         # Clean up by deleting the extra files created in the anonymization process
         if len(file_tracking) > 0 and args.clean_up:
             for del_file in file_tracking:
                 print(f'Deleting support file {del_file}')
                 os.remove(del_file)
+    except Exception as e:
+        traceback.print_exc()
+        result['status'] = 'failed'
+        result['error'] = f'{type(e).__name__}: {e}'
+    finally:
+        result['seconds'] = time.time() - start_time
+        if args.cprofile:
+            prof_file = utils.get_output(result['file'], args.input_dir,
+                                         args.output_dir).format('profile.prof')
+            profiling.stop_cprofile(prof_file)
+            print(f'cProfile stats saved to {prof_file}')
+        if args.profile:
+            result['profile'] = profiling.stop()
+
+    return result
+
+def redact_audio(audio_file, redacted_file, args, cache, audio_key):
+    """
+    Removes proper nouns from an audio file.
+
+    Inputs:
+    audio_file    - String      - the audio to redact
+    redacted_file - String      - where the redacted audio should be saved
+    args          - Namespace   - the parsed command-line arguments
+    cache         - ResultCache - the result cache, or None
+    audio_key     - String      - the cache key of the audio
+
+    Returns:
+    The redacted audio file, or the original audio file if there was nothing to redact.
+    """
+    with stage('redact'):
+        return audio_processing.redact_names(audio_file, redacted_file,
+                                             model=_models.get('vosk'),
+                                             model_path=args.vosk_model,
+                                             asr_workers=args.asr_workers,
+                                             redact_mode=args.redact_mode,
+                                             fade_ms=args.fade_ms,
+                                             cache=cache, audio_key=audio_key,
+                                             tagger=_models.get('names'),
+                                             google_pass=not args.offline,
+                                             google_requests=args.google_requests)
+
+def stream_file(file, args, output_file, temp_file, cut_times=None, cache=None, video_key=None):
+    """
+    Anonymizes a single video in streaming mode, where the video is decoded once, blurred and
+    encoded once together with the (redacted) audio and the first/last mile trim.
+
+    Inputs:
+    file        - String      - the video to anonymize
+    args        - Namespace   - the parsed command-line arguments
+    output_file - String      - the string format for the final output file
+    temp_file   - String      - the string format for the intermediary file names
+    cut_times   - tuple       - the (start, end) times to keep, or None to keep everything
+    cache       - ResultCache - the result cache, or None
+    video_key   - String      - the cache key of the trimmed video
+
+    Returns:
+    Where the anonymized video was saved.
+    """
+    (start, end) = cut_times if cut_times is not None else (None, None)
+    key = lambda parent, stage, params=None: cache.stage_key(parent, stage, params) if cache else None
+
+    # Only the audio needs its own file, and only when names are redacted from it
+    audio_file = None
+    audio_key = None
+    file_tracking = []
+    if args.redact_names:
+        audio_key = key(video_key, 'audio')
+        with stage('extract'):
+            extracted = run_stage(cache, audio_key, temp_file.format('audio.wav'),
+                                  lambda: audio_processing.get_audio(file, temp_file.format('audio.wav'),
+                                                                     start, end))
+        redacted_key = key(audio_key, 'redact', get_redact_params(args, cache))
+        audio_file = run_stage(cache, redacted_key, temp_file.format('redacted.wav'),
+                               lambda: redact_audio(extracted, temp_file.format('redacted.wav'),
+                                                    args, cache, audio_key))
+        file_tracking += [extracted] + ([audio_file] if audio_file != extracted else [])
+        audio_key = redacted_key
+
+    anon_file = output_file.format('anon.mp4')
+    tracks_opts, tracks_fingerprint = get_tracks_opts(args, output_file, cache)
+    encoder = get_encoder(args)
+    anon_key = key(video_key, 'stream', dict(get_blur_opts(args), blur_shirt=args.blur_shirt,
+                                             blur_face=args.blur_face, audio=audio_key,
+                                             save_tracks=args.save_tracks,
+                                             tracks=tracks_fingerprint,
+                                             encoder=encoder.params()))
+    anon_file = run_stage(cache, anon_key, anon_file,
+                          lambda: frame_processing.stream_vid(file, anon_file,
+                                                              args.blur_shirt, args.blur_face,
+                                                              cut_times=cut_times,
+                                                              audio_file=audio_file,
+                                                              workers=args.workers,
+                                                              queue_size=args.queue_size,
+                                                              detector=_models.get('detector'),
+                                                              cache=cache, video_key=video_key,
+                                                              encoder=encoder,
+                                                              processes=args.process_workers,
+                                                              **tracks_opts,
+                                                              **get_blur_opts(args)))
+
+    if len(file_tracking) > 0 and args.clean_up:
+        for del_file in file_tracking:
+            print(f'Deleting support file {del_file}')
+            os.remove(del_file)
+
+    return anon_file
+
+def patch_file(file, args, ranges):
+    """
+    Re-processes only some time ranges of a video that was already anonymized, splicing them
+    back into its anonymized video.
+
+    Inputs:
+    file   - String    - the original video
+    args   - Namespace - the parsed command-line arguments
+    ranges - list      - the ranges to re-process, from patching.read_patches
+
+    Returns:
+    A dictionary with the file, where the patched video was saved, whether it succeeded, the
+    error if it failed, how long it took and, when profiling, the profile summary.
+    """
+    result = {'file': file, 'output': None, 'status': 'ok', 'error': None}
+    start_time = time.time()
+    if args.profile:
+        profiling.start()
+    try:
+        anon_file = utils.get_output(file, args.input_dir, args.output_dir).format('anon.mp4')
+        if not os.path.exists(anon_file):
+            raise FileNotFoundError(f'{anon_file} does not exist, the video has to be anonymized '
+                                    'before it can be patched')
+        with stage('patch'):
+            result['output'] = patching.patch_vid(anon_file, anon_file, ranges,
+                                                  args.blur_shirt, args.blur_face,
+                                                  workers=args.workers,
+                                                  queue_size=args.queue_size,
+                                                  detector=_models.get('detector'),
+                                                  encoder=get_encoder(args),
+                                                  model=_models.get('vosk'),
+                                                  model_path=args.vosk_model,
+                                                  redact_mode=args.redact_mode,
+                                                  fade_ms=args.fade_ms,
+                                                  **get_blur_opts(args))
+    except Exception as e:
+        traceback.print_exc()
+        result['status'] = 'failed'
+        result['error'] = f'{type(e).__name__}: {e}'
+    finally:
+        result['seconds'] = time.time() - start_time
+        if args.profile:
+            result['profile'] = profiling.stop()
+
+    return result
+
+def plan_file(file, args, timings=None, patches=None):
+    """
+    Works out which stages would run on a video, without running anything.
+
+    Inputs:
+    file    - String    - the video to anonymize
+    args    - Namespace - the parsed command-line arguments
+    timings - dict      - the first/last mile start/stop times of the batch, or None if they
+                          weren't read
+    patches - dict      - the ranges to re-process in each video with --patch, or None
+
+    Returns:
+    A list describing each stage in the order it would run.
+    """
+    if patches is not None:
+        ranges = patches.get(os.path.basename(file), [])
+        if not ranges:
+            return ['not in the patch file, not patched']
+        redetect = [name for name, on in (('faces', args.blur_face), ('logos', args.blur_shirt))
+                    if on]
+        redetect = f", find {' and '.join(redetect)} again" if redetect else ''
+        return [f"re-process {r['start']:.1f}s to {r['end']:.1f}s{redetect}, blur "
+                f"{len(r['blur'])} boxes and redact {len(r['redact'])} words" for r in ranges]
+
+    stages = []
+    how = 're-encoded' if args.reencode_cut else 'copied between keyframes'
+    if timings is not None:
+        if os.path.basename(file) in timings:
+            stages.append(f'cut the first and last mile ({how})')
+        else:
+            stages.append('not in the timings file, not cut')
+    elif args.cut_first_last_mile:
+        stages.append(f'cut the first and last mile if listed in {args.cut_first_last_mile} ({how})')
+
+    if args.redact_names or not args.stream:
+        stages.append('extract the audio')
+    if args.redact_names:
+        recognizers = 'vosk' if args.offline else 'vosk and Google'
+        stages.append(f'redact names with {recognizers} ({args.redact_mode})')
+
+    blurred = [name for name, on in (('faces', args.blur_face), ('logos', args.blur_shirt)) if on]
+    if blurred:
+        source = 'saved tracks' if args.from_tracks else f'the {args.engine} engine'
+        kind = 'processes' if args.process_workers else 'threads'
+        blur = f"blur {' and '.join(blurred)} with {source} ({args.workers} {kind})"
+        if args.shards > 1 and not args.stream:
+            blur = f"blur {' and '.join(blurred)} with {source} ({args.shards} shards at once)"
+    if args.stream:
+        stages.append('stream: decode, ' + (blur + ', ' if blurred else '')
+                      + f'encode with {args.encoder} and add the audio')
+    else:
+        if blurred:
+            stages.append(f'{blur}, encode with {args.encoder}')
+        stages.append('merge the audio back in')
+
+    return stages
+
+def print_plan(files, args, timings=None, patches=None):
+    """
+    Prints the stages that would run on every file and where the results would be saved.
+
+    Inputs:
+    files   - list      - the videos to anonymize
+    args    - Namespace - the parsed command-line arguments
+    timings - dict      - the first/last mile start/stop times of the batch, or None
+    patches - dict      - the ranges to re-process in each video with --patch, or None
+
+    Returns:
+    None
+    """
+    print(f'\nDry run: {len(files)} files would be anonymized')
+    for file in files:
+        output_file = utils.get_output(file, args.input_dir, args.output_dir)
+        print(f"  {file} -> {output_file.format('anon.mp4')}")
+        for stage in plan_file(file, args, timings, patches):
+            print(f'      {stage}')
+
+def print_summary(results):
+    """
+    Prints how every file in the batch went, with the failures listed last.
+
+    Inputs:
+    results - list - the result dictionaries returned by anonymize_file
+
+    Returns:
+    None
+    """
+    failed = [r for r in results if r['status'] != 'ok']
+    print(f'\nSummary: {len(results) - len(failed)} of {len(results)} files anonymized')
+    for r in results:
+        print(f"  [{r['status']}] {r['file']} -> {r['output']} ({r['seconds']:.1f}s)")
+        profile = r.get('profile')
+        if profile:
+            fps = f"{profile['fps']:.1f} fps" if profile['fps'] else 'no frames'
+            rtf = f"{profile['real_time_factor']:.2f}x real time" if profile['real_time_factor'] else ''
+            print(f"      {fps} {rtf}, peak memory {profile['peak_rss_mb']['self']:.0f} MB "
+                  f"(ffmpeg {profile['peak_rss_mb']['children']:.0f} MB)")
+            if profile['frames_missed']:
+                print(f"      no landmarks found in {profile['frames_missed']} of "
+                      f"{profile['frames_processed']} frames")
+            for name, stats in profile['stages'].items():
+                print(f"      {name}: {stats['wall']:.1f}s wall, {stats['cpu']:.1f}s cpu")
+            for name, stats in profile['encoders'].items():
+                fps = f"{stats['fps']:.1f} fps" if stats['fps'] else 'no frames'
+                print(f"      {name} encode: {stats['encoder']} {stats['frames']} frames, {fps}")
+    if failed:
+        print('Failures:')
+        for r in failed:
+            print(f"  {r['file']}: {r['error']}")
+
+def find_files(input_dir):
+    """
+    Finds all the videos to anonymize in a directory and its subdirectories (even with
+    different namings).
+
+    Inputs:
+    input_dir - String - the directory of the original videos
+
+    Returns:
+    A list of the video files.
+    """
+    files = glob.glob(f'{input_dir}/**/*.mp4', recursive=True)
+    files += glob.glob(f'{input_dir}/**/*.MP4', recursive=True)
+
+    return files
+
+def get_parser():
+    """
+    Builds the parser of the command-line arguments, shared with the service in service.py.
+
+    Returns:
+    The ArgumentParser.
+    """
+    parser = argparse.ArgumentParser(description="Video anonymization tool")
+
+    parser.add_argument("input_dir", type=str)
+    parser.add_argument("--blur_face", help="Enable face blurring", action='store_true')
+    parser.add_argument("--blur_shirt", help="Enable shirt blurring to hide logos", action='store_true')
+    parser.add_argument("--redact_names", help="Remove proper nouns from audio", action='store_true')
+    parser.add_argument("--cut_first_last_mile",
+                        help="Remove the first and last mile of driving to \
+                            protect participant address", type=str)
+    parser.add_argument("--reencode_cut", help="Re-encode the whole video when removing the first \
+                                               and last mile instead of copying it between \
+                                               keyframes.", action='store_true')
+    parser.add_argument("--encoder", help="The encoder every stage writes video with.",
+                        choices=sorted(encoding.ENCODERS.values()), default='libx264')
+    parser.add_argument("--preset", help="The encoder speed preset, faster presets give bigger \
+                                         files.", choices=encoding.PRESETS, default='veryfast')
+    parser.add_argument("--crf", help="The encoder constant rate factor, lower is better quality. \
+                                      Defaults to 18 for libx264 and 22 for libx265.", type=int)
+    parser.add_argument("--encode_threads", help="Most threads each encode uses, 0 to use every core \
+                                                 (split between --jobs).", type=int, default=0)
+    parser.add_argument("--output_dir", help="Where the anonymized files should be stored.\
+                                            default to store where this is run.",
+                        type=str, default='')
+    parser.add_argument("--clean_up", help="Delete intermediate files.", action='store_true')
+    parser.add_argument("--workers", help="Number of threads finding landmarks and blurring frames.",
+                        type=int, default=1)
+    parser.add_argument("--process_workers", help="Run the workers as processes sharing frames \
+                                                  through shared memory instead of threads.",
+                        action='store_true')
+    parser.add_argument("--queue_size", help="Number of frames buffered between the decode, blur \
+                                             and encode stages.", type=int, default=64)
+    parser.add_argument("--vosk_model", help="Where the vosk model is unzipped. Defaults to the \
+                                             VOSK_MODEL_PATH environment variable.", type=str)
+    parser.add_argument("--asr_workers", help="Number of processes recognizing speech chunks at once.",
+                        type=int, default=1)
+    parser.add_argument("--name_lists", help="Text or CSV files of names (e.g. first and last names, \
+                                             or a study's participants) that are always redacted.",
+                        type=str, nargs='+')
+    parser.add_argument("--offline", help="Find names with vosk alone, without sending any audio to \
+                                          Google.", action='store_true')
+    parser.add_argument("--google_requests", help="Most requests waiting on Google at once when \
+                                                  finding names.", type=int, default=4)
+    parser.add_argument("--redact_mode", help="Whether to mute or bleep redacted words.",
+                        choices=['mute', 'bleep'], default='mute')
+    parser.add_argument("--fade_ms", help="Milliseconds to fade the audio out and back in around \
+                                          each redacted word.", type=int, default=0)
+    parser.add_argument("--detect_every", help="Only detect landmarks every n frames and track them \
+                                               with optical flow in between.", type=int, default=1)
+    parser.add_argument("--motion_thresh", help="Detect landmarks again when the tracked regions move \
+                                                more than this many pixels in a frame.", type=float)
+    parser.add_argument("--scene_thresh", help="Detect landmarks again when the mean grey level \
+                                               change between frames is more than this.",
+                        type=float, default=25.0)
+    parser.add_argument("--track_dilate", help="How much to grow tracked regions, as a fraction of \
+                                               their size, so drift can't uncover a face.",
+                        type=float, default=0.15)
+    parser.add_argument("--engine", help="Find landmarks with the MediaPipe holistic model (one \
+                                         person) or with FaceMesh, which finds every face, plus \
+                                         Pose when shirts are blurred.",
+                        choices=['holistic', 'face'], default='holistic')
+    parser.add_argument("--max_faces", help="Most faces the face engine finds in a frame.",
+                        type=int, default=4)
+    parser.add_argument("--detect_width", help="Width frames are downscaled to before landmarks are \
+                                               found, 0 to find them at full resolution.",
+                        type=int, default=640)
+    parser.add_argument("--roi_margin", help="Only look for landmarks in a region around where they \
+                                             were last found, reaching this fraction of their size \
+                                             past them. Faster, but a face coming into view \
+                                             elsewhere is only found at the next check of the \
+                                             whole frame, every 30 detections with the holistic \
+                                             engine. The face engine checks every 5, and every \
+                                             time while fewer than --max_faces faces are found.",
+                        type=float)
+    parser.add_argument("--shards", help="Split each video into this many runs of frames starting \
+                                         on keyframes and blur them at once, each in its own \
+                                         process.", type=int, default=1)
+    parser.add_argument("--shard_warmup", help="Frames before each shard shown to its model so it is \
+                                               already tracking when the shard starts.",
+                        type=int, default=30)
+    parser.add_argument("--missed", help="What to do with frames where no face or pose is found: blur \
+                                         the regions last found again, pixelate the whole frame \
+                                         or leave it as it is.",
+                        choices=frame_processing.MISSED_POLICIES, default='reuse')
+    parser.add_argument("--save_tracks", help="Save every frame's pose and face landmarks next to the \
+                                              anonymized video.", action='store_true')
+    parser.add_argument("--from_tracks", help="Blur from the landmarks saved by an earlier \
+                                              --save_tracks run instead of running MediaPipe.",
+                        action='store_true')
+    parser.add_argument("--stream", help="Decode and encode each video once, piping frames through \
+                                         ffmpeg with no intermediate video files.", action='store_true')
+    parser.add_argument("--cache_dir", help="Where to keep a cache of stage results so reruns skip \
+                                            work already done on the same input and options.",
+                        type=str)
+    parser.add_argument("--cache_size", help="Most the cache can hold, in GB, before the least \
+                                             recently used results are removed.",
+                        type=float, default=10)
+    parser.add_argument("--jobs", help="Number of videos to anonymize at once, each in its own \
+                                       process.", type=int, default=1)
+    parser.add_argument("--job_db", help="A SQLite file recording every video anonymized, so later \
+                                         runs skip the videos already done unless they changed.",
+                        type=str)
+    parser.add_argument("--retry_failed", help="Anonymize the videos --job_db says failed again.",
+                        action='store_true')
+    parser.add_argument("--patch", help="A JSON file of time ranges to re-process in videos that \
+                                        were already anonymized, spliced back into their \
+                                        anonymized videos.", type=str)
+    parser.add_argument("--dry_run", "--dry-run", help="List the files and the stages that would run \
+                                                       on each, without running anything or \
+                                                       loading any models.", action='store_true')
+    parser.add_argument("--profile", help="Save per-stage and per-frame timings, throughput and peak \
+                                          memory of every file to this JSON file.", type=str)
+    parser.add_argument("--cprofile", help="Save cProfile stats of every file next to its anonymized \
+                                           video, with the pipeline threads merged in. Work in \
+                                           other processes (--shards, --process_workers, ASR \
+                                           workers) isn't profiled.", action='store_true')
+
+    return parser
+
+def check_args(parser, args):
+    """
+    Exits with a usage error if options that can't be used together were given.
+
+    Inputs:
+    parser - ArgumentParser - the parser from get_parser
+    args   - Namespace      - the parsed command-line arguments
+
+    Returns:
+    None
+    """
+    if args.shards > 1 and (args.stream or args.save_tracks or args.from_tracks):
+        parser.error('--shards can not be used with --stream, --save_tracks or --from_tracks')
+
+def main():
+    # Read in all of the command-line arguments
+    parser = get_parser()
+    args = parser.parse_args()
+    check_args(parser, args)
+
+    files = find_files(args.input_dir)
+
+    print('Anonymizing the following files:')
+    print(files)
+
+    # Only the listed ranges of already anonymized videos are re-processed when patching
+    patches = None
+    if args.patch:
+        patches = patching.read_patches(args.patch)
+        files = [file for file in files if os.path.basename(file) in patches]
+
+    # Videos already anonymized by an earlier run or the service are skipped
+    queue = None
+    if args.job_db and patches is None:
+        queue = jobs.JobQueue(args.job_db)
+        skipped = ('done',) if args.retry_failed else ('done', 'failed')
+        if args.dry_run:
+            files = [file for file in files if queue.state(file) not in skipped]
+        else:
+            # Jobs left running by a service that stopped would never be run again otherwise
+            if not queue.held():
+                requeued = queue.requeue_running()
+                if requeued:
+                    print(f'Queued {requeued} videos again that were running when the service stopped')
+            files = [file for file in files if queue.add(file, args.retry_failed)]
+        print(f'{len(files)} files have not been anonymized yet')
+
+    # The timings file is read with pandas, which would slow down a dry run
+    if args.dry_run:
+        print_plan(files, args, None, patches)
+        return
+
+    # The first/last mile timings are read once for the whole batch
+    timings = None
+    if args.cut_first_last_mile:
+        timings = frame_processing.read_timings(f'{args.input_dir}/{args.cut_first_last_mile}')
+
+    # Check the encoder is available before any work is done
+    try:
+        encoding.get_encoder(args.encoder, args.preset, args.crf)
+    except ValueError as e:
+        parser.error(str(e))
+    print(f'Encoding video with {get_encoder(args)}')
+
+    # For each file, run the anonymization and keep track of the intermediate files
+    if patches is not None:
+        load_models(args)
+        results = [patch_file(file, args, patches[os.path.basename(file)]) for file in files]
+    elif args.jobs > 1:
+        # Spread the files over a pool of processes which each load their own models
+        with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs,
+                                                    initializer=load_models,
+                                                    initargs=(args,)) as pool:
+            results = list(pool.map(anonymize_file, files, [args] * len(files),
+                                    [True] * len(files), [timings] * len(files)))
+    else:
+        load_models(args)
+        results = [anonymize_file(file, args, timings=timings) for file in files]
+
+    if queue is not None:
+        for r in results:
+            queue.finish(r['file'], r)
+
+    print_summary(results)
+    print()
 
-    print()
\ No newline at end of file
+    if args.profile:
+        profiling.save(args.profile, {r['file']: r.get('profile') for r in results})
+        print(f'Profile saved to {args.profile}')
@@ -0,0 +1,78 @@
+"""
+Micro-benchmark of the per-frame blur kernel, comparing find_and_blur_pts with the original
+find_and_blur_pts_legacy on a synthetic frame with a face and a torso.
+
+Run from the repository root with:
+    python benchmarks/bench_blur.py [--width 1920 --height 1080 --repeats 50]
+"""
+import argparse
+import os
+import sys
+import time
+from collections import namedtuple
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from vid_anon import utils
+
+Landmark = namedtuple('Landmark', ['x', 'y'])
+
+def make_landmarks(n, cx, cy, rx, ry, seed=0):
+    """
+    Makes n mediapipe-like normalized landmarks scattered inside an ellipse.
+    """
+    rng = np.random.default_rng(seed)
+    angles = rng.uniform(0, 2 * np.pi, n)
+    radii = np.sqrt(rng.uniform(0, 1, n))
+    return [Landmark(cx + rx * r * np.cos(a), cy + ry * r * np.sin(a))
+            for a, r in zip(angles, radii)]
+
+def blur_frame(blur_fn, frame, face_lms, shirt_lms, frame_shape):
+    frame = blur_fn(frame, shirt_lms, [11, 12, 24, 23], frame_shape, 20)
+    frame = blur_fn(frame, face_lms, range(468), frame_shape, 10)
+    return frame
+
+def time_kernel(blur_fn, frame, face_lms, shirt_lms, frame_shape, repeats):
+    times = []
+    for _ in range(repeats):
+        work = frame.copy()
+        start = time.perf_counter()
+        blur_frame(blur_fn, work, face_lms, shirt_lms, frame_shape)
+        times.append(time.perf_counter() - start)
+    return np.median(times) * 1000
+
+def main():
+    parser = argparse.ArgumentParser(description="Blur kernel micro-benchmark")
+    parser.add_argument("--width", type=int, default=1920)
+    parser.add_argument("--height", type=int, default=1080)
+    parser.add_argument("--repeats", type=int, default=50)
+    args = parser.parse_args()
+
+    # Smoothed noise looks more like camera footage than raw noise does
+    rng = np.random.default_rng(0)
+    frame = rng.integers(0, 256, (args.height, args.width, 3), dtype=np.uint8)
+    frame = cv2.normalize(cv2.GaussianBlur(frame, (0, 0), 8), None, 0, 255, cv2.NORM_MINMAX)
+    frame_shape = [args.width, args.height]
+    face_lms = make_landmarks(468, 0.5, 0.3, 0.08, 0.14)
+    shirt_lms = make_landmarks(33, 0.5, 0.7, 0.2, 0.2, seed=1)
+
+    legacy = time_kernel(utils.find_and_blur_pts_legacy, frame, face_lms, shirt_lms,
+                         frame_shape, args.repeats)
+    vectorized = time_kernel(utils.find_and_blur_pts, frame, face_lms, shirt_lms,
+                             frame_shape, args.repeats)
+
+    # How different the two kernels' output is inside the blurred area. The block edges can
+    # land one pixel apart, so compare the average difference rather than exact pixels
+    old = blur_frame(utils.find_and_blur_pts_legacy, frame.copy(), face_lms, shirt_lms, frame_shape)
+    new = blur_frame(utils.find_and_blur_pts, frame.copy(), face_lms, shirt_lms, frame_shape)
+    blurred = np.any(old != frame, axis=2) | np.any(new != frame, axis=2)
+    diff = np.abs(old.astype(np.int16) - new)[blurred].mean()
+
+    print(f'{args.width}x{args.height}, median of {args.repeats} frames')
+    print(f'  legacy:     {legacy:8.2f} ms/frame')
+    print(f'  vectorized: {vectorized:8.2f} ms/frame ({legacy / vectorized:.1f}x faster)')
+    print(f'  mean abs difference from legacy output in blurred area: {diff:.2f} levels')
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,495 @@
+"""
+Benchmark suite for the anonymization stages, run on synthetic videos generated offline.
+
+Each video has a face-like head and a shirt with a logo moving over a textured background,
+and a speech-like soundtrack (voiced syllables grouped into words, with long pauses so the
+audio is split into several stretches of speech). They are encoded as H.264 with a keyframe
+every two seconds, like camera footage, and generated once per resolution and duration and
+reused by later runs.
+
+The command line startup is timed first (importing app, --help and a --dry_run plan, each in
+a fresh interpreter) and compared like any other stage, so a heavy import creeping back into
+startup shows up as a regression. Every stage is timed on every video: the blur kernel (utils.find_and_blur_pts), the ffmpeg
+stages (get_audio, cut_vid, merge_audio), blur_vid, stream_vid and redact_names. The Google
+recognizer is replaced by a local stub that returns a fixed transcript, so redact_names only
+needs the vosk model. With --detector stub, MediaPipe is replaced by a detector that finds the
+synthetic head by its colour, so blur_vid times the decode, blur and encode work alone.
+
+Run from the repository root with:
+    python benchmarks/bench_pipeline.py --resolutions 720p 1080p 4k --minutes 1 10 60 \
+        --output baseline.json
+    python benchmarks/bench_pipeline.py --resolutions 720p 1080p 4k --minutes 1 10 60 \
+        --compare baseline.json
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import wave
+from types import SimpleNamespace
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from vid_anon import audio_processing, frame_processing, utils
+
+RESOLUTIONS = {'720p': (1280, 720), '1080p': (1920, 1080), '4k': (3840, 2160)}
+FPS = 30
+SAMPLE_RATE = 16000
+# Keyframes every two seconds, like a dashcam's H.264, so cut_vid copies between keyframes and
+# only re-encodes the ends as it would on a real video
+GOP = 2 * FPS
+
+# BGR colours of the synthetic head and shirt, far from the grey background so the stub
+# detector can find them after compression
+SKIN = (90, 140, 210)
+SHIRT = (160, 60, 30)
+
+# What the stubbed Google recognizer hears in every stretch of speech
+STUB_TRANSCRIPT = 'then Alice drove past the station with Bob and Carol'
+
+def make_background(width, height, seed=0):
+    """
+    Makes a grey textured background. Smoothed noise compresses more like camera footage
+    than raw noise does.
+    """
+    rng = np.random.default_rng(seed)
+    small = rng.integers(0, 256, (height // 8, width // 8), dtype=np.uint8)
+    small = cv2.GaussianBlur(small, (0, 0), 2)
+    gray = cv2.resize(small, (width, height), interpolation=cv2.INTER_LINEAR)
+    gray = cv2.normalize(gray, None, 60, 190, cv2.NORM_MINMAX)
+    return cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR)
+
+def head_position(idx, width, height):
+    """
+    Returns the centre and radii of the head in a frame. The head drifts slowly around the
+    frame with a little faster sway, like someone talking in a car.
+    """
+    t = idx / FPS
+    cx = width * (0.5 + 0.15 * np.sin(t / 7) + 0.01 * np.sin(t * 3))
+    cy = height * (0.35 + 0.05 * np.sin(t / 5))
+    return int(cx), int(cy), int(width * 0.07), int(height * 0.16)
+
+def draw_frame(background, idx):
+    """
+    Draws the head and shirt for a frame on a copy of the background.
+    """
+    frame = background.copy()
+    (height, width) = frame.shape[:2]
+    cx, cy, rx, ry = head_position(idx, width, height)
+
+    # Shirt with a logo under the head
+    top = cy + ry
+    cv2.rectangle(frame, (cx - 3 * rx, top), (cx + 3 * rx, height), SHIRT, -1)
+    cv2.putText(frame, 'LOGO', (cx - rx, top + ry), cv2.FONT_HERSHEY_SIMPLEX,
+                width / 1000, (255, 255, 255), max(1, width // 500))
+
+    # Head with eyes and a mouth that opens and closes
+    cv2.ellipse(frame, (cx, cy), (rx, ry), 0, 0, 360, SKIN, -1)
+    for side in (-1, 1):
+        cv2.circle(frame, (cx + side * rx // 2, cy - ry // 4), max(2, rx // 8), (40, 40, 40), -1)
+    mouth = max(1, int(ry / 10 * (1 + np.sin(idx / 2))))
+    cv2.ellipse(frame, (cx, cy + ry // 2), (rx // 3, mouth), 0, 0, 360, (50, 50, 120), -1)
+
+    return frame
+
+def make_speech(seconds, seed=0):
+    """
+    Makes a speech-like 16 kHz mono signal: voiced syllables with a wandering pitch and a few
+    harmonics, grouped into words and sentences, with a long pause every 30 seconds.
+
+    Returns:
+    The int16 samples.
+    """
+    rng = np.random.default_rng(seed)
+    samples = np.zeros(int(seconds * SAMPLE_RATE), dtype=np.float32)
+    t = 0.5
+    sentence_start = t
+    while t < seconds - 1:
+        # A word of one to three syllables
+        for _ in range(rng.integers(1, 4)):
+            length = rng.uniform(0.12, 0.3)
+            n = int(length * SAMPLE_RATE)
+            start = int(t * SAMPLE_RATE)
+            if start + n > len(samples):
+                break
+            time_axis = np.arange(n) / SAMPLE_RATE
+            f0 = rng.uniform(100, 220) * (1 + 0.1 * np.sin(2 * np.pi * 3 * time_axis))
+            phase = 2 * np.pi * np.cumsum(f0) / SAMPLE_RATE
+            voice = sum(np.sin(k * phase) / k for k in range(1, 6))
+            envelope = np.sin(np.pi * np.arange(n) / n) ** 2
+            samples[start:start + n] += 0.3 * voice * envelope
+            t += length
+
+        # Pause between words, and a long pause between stretches of speech
+        t += rng.uniform(0.08, 0.4)
+        if t - sentence_start > 30:
+            t += 6
+            sentence_start = t
+
+    # A little background noise so the silences aren't digital silence
+    samples += rng.normal(0, 0.002, len(samples)).astype(np.float32)
+    return (np.clip(samples, -1, 1) * 32767).astype(np.int16)
+
+def make_video(path, width, height, seconds):
+    """
+    Generates a synthetic H.264 video with sound.
+
+    Inputs:
+    path    - String - where to save the video
+    width   - Integer - the frame width
+    height  - Integer - the frame height
+    seconds - Float   - the length of the video
+
+    Returns:
+    The path of the video.
+    """
+    print(f'Generating {path} ({width}x{height}, {seconds:.0f}s)...')
+    silent = path + '.silent.mp4'
+    audio = path + '.wav'
+
+    background = make_background(width, height)
+    out = cv2.VideoWriter(silent, cv2.VideoWriter_fourcc('m', 'p', '4', 'v'), FPS, (width, height))
+    for idx in range(int(seconds * FPS)):
+        out.write(draw_frame(background, idx))
+    out.release()
+
+    with wave.open(audio, 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(SAMPLE_RATE)
+        f.writeframes(make_speech(seconds).tobytes())
+
+    subprocess.run(['ffmpeg', '-loglevel', 'error', '-y', '-i', silent, '-i', audio,
+                    '-c:v', 'libx264', '-preset', 'veryfast', '-g', str(GOP), '-pix_fmt', 'yuv420p',
+                    '-c:a', 'aac', '-shortest', path], check=True)
+    os.remove(silent)
+    os.remove(audio)
+
+    return path
+
+class StubHolistic:
+    """
+    Stands in for the MediaPipe holistic model on the synthetic videos. Finds the head by its
+    colour on a subsampled copy of the frame and returns mediapipe-like face and pose landmarks
+    around it.
+    """
+    def process(self, rgb):
+        small = rgb[::8, ::8].astype(np.int16)
+        skin = (small[..., 0] - small[..., 2] > 60) & (small[..., 1] - small[..., 2] > 20)
+        ys, xs = np.nonzero(skin)
+        if len(xs) == 0:
+            return SimpleNamespace(face_landmarks=None, pose_landmarks=None)
+
+        (s_h, s_w) = skin.shape
+        x0, x1, y0, y1 = xs.min() / s_w, xs.max() / s_w, ys.min() / s_h, ys.max() / s_h
+        cx, cy, rx, ry = (x0 + x1) / 2, (y0 + y1) / 2, (x1 - x0) / 2, (y1 - y0) / 2
+        angles = np.linspace(0, 2 * np.pi, 468, endpoint=False)
+        face = [SimpleNamespace(x=cx + rx * np.cos(a), y=cy + ry * np.sin(a)) for a in angles]
+
+        # Shoulders (11, 12) and hips (23, 24) outline the shirt
+        pose = [SimpleNamespace(x=cx, y=cy) for _ in range(33)]
+        pose[11] = SimpleNamespace(x=cx + 2.5 * rx, y=cy + 1.3 * ry)
+        pose[12] = SimpleNamespace(x=cx - 2.5 * rx, y=cy + 1.3 * ry)
+        pose[23] = SimpleNamespace(x=cx + 2 * rx, y=min(1.0, cy + 4 * ry))
+        pose[24] = SimpleNamespace(x=cx - 2 * rx, y=min(1.0, cy + 4 * ry))
+
+        return SimpleNamespace(face_landmarks=SimpleNamespace(landmark=face),
+                               pose_landmarks=SimpleNamespace(landmark=pose))
+
+def stub_recognize_google(self, audio_data, language='en', show_all=False, **kwargs):
+    """
+    Stands in for speech_recognition's Google recognizer with a fixed transcript.
+    """
+    return {'alternative': [{'transcript': STUB_TRANSCRIPT}]}
+
+def remove(*paths):
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+def bench_kernel(video, frames):
+    """
+    Times utils.find_and_blur_pts on frames of the video with the stub landmarks.
+    """
+    cap = cv2.VideoCapture(video)
+    ok, frame = cap.read()
+    cap.release()
+    (f_h, f_w) = frame.shape[:2]
+    results = StubHolistic().process(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+
+    times = []
+    for _ in range(frames):
+        work = frame.copy()
+        start = time.perf_counter()
+        utils.find_and_blur_pts(work, results.pose_landmarks.landmark, [11, 12, 24, 23],
+                                [f_w, f_h], 20)
+        utils.find_and_blur_pts(work, results.face_landmarks.landmark, range(468),
+                                [f_w, f_h], 10)
+        times.append(time.perf_counter() - start)
+
+    # The median is steadier than the mean against the odd slow frame
+    median = float(np.median(times))
+    return {'seconds': median * frames, 'ms_per_frame': median * 1000, 'frames': frames}
+
+def bench_video(name, video, seconds, args, vosk_model):
+    """
+    Times every stage on one synthetic video.
+
+    Returns:
+    A dictionary of the stage results, each with the seconds it took or the error it failed with.
+    """
+    out = os.path.join(args.work_dir, 'out')
+    os.makedirs(out, exist_ok=True)
+    prefix = os.path.join(out, name)
+    frames = int(seconds * FPS)
+    stages = {}
+
+    def run(stage, fn, frames=None):
+        # A stage that fails (e.g. a missing tool) is recorded and the rest still run
+        start = time.perf_counter()
+        try:
+            fn()
+        except Exception as e:
+            stages[stage] = {'error': f'{type(e).__name__}: {e}'}
+            print(f"  {stage}: failed, {stages[stage]['error']}")
+            return
+        elapsed = time.perf_counter() - start
+        stages[stage] = {'seconds': elapsed}
+        if frames:
+            stages[stage]['fps'] = frames / elapsed
+            stages[stage]['real_time_factor'] = elapsed / (frames / FPS)
+        print(f'  {stage}: {elapsed:.2f}s')
+
+    stages['blur_kernel'] = bench_kernel(video, args.kernel_frames)
+    print(f"  blur_kernel: {stages['blur_kernel']['ms_per_frame']:.2f} ms/frame")
+
+    audio_file = prefix + '_audio.wav'
+    remove(audio_file)
+    run('get_audio', lambda: audio_processing.get_audio(video, audio_file))
+
+    # Keep the middle 60% of the video, so both ends are cut away from a keyframe
+    cut_file = prefix + '_cut.mp4'
+    keep_start = seconds * 0.2
+    keep_end = seconds * 0.8
+    remove(cut_file)
+    run('cut_vid', lambda: frame_processing.cut_vid(video, cut_file, (keep_start, keep_end)),
+        int((keep_end - keep_start) * FPS))
+    remove(cut_file)
+
+    detector = frame_processing.load_detector(args.engine, True)
+    blur_opts = {'detect_every': args.detect_every, 'engine': args.engine}
+    blurred_file = prefix + '_blurred.mp4'
+    remove(blurred_file)
+    run('blur_vid', lambda: frame_processing.blur_vid(video, blurred_file, True, True,
+                                                      workers=args.workers, detector=detector,
+                                                      **blur_opts), frames)
+
+    merged_file = prefix + '_anon.mp4'
+    remove(merged_file)
+    run('merge_audio', lambda: audio_processing.merge_audio(audio_file, blurred_file, merged_file),
+        frames)
+    remove(blurred_file, merged_file)
+
+    stream_file = prefix + '_stream.mp4'
+    remove(stream_file)
+    run('stream_vid', lambda: frame_processing.stream_vid(video, stream_file, True, True,
+                                                          workers=args.workers, detector=detector,
+                                                          **blur_opts), frames)
+    remove(stream_file)
+
+    if vosk_model is not None:
+        redacted_file = prefix + '_redacted.wav'
+        remove(redacted_file)
+        run('redact_names', lambda: audio_processing.redact_names(audio_file, redacted_file,
+                                                                  model=vosk_model,
+                                                                  model_path=args.vosk_model,
+                                                                  asr_workers=args.asr_workers))
+        remove(redacted_file)
+    remove(audio_file)
+
+    return stages
+
+def bench_startup(work_dir, runs=5):
+    """
+    Times how long the command line takes to start, each run in a fresh interpreter: importing
+    app, printing --help and a --dry_run plan of the benchmark videos. The heavy libraries are
+    loaded lazily, so none of these should load MediaPipe, OpenCV, vosk or nltk.
+
+    Inputs:
+    work_dir - String  - where the synthetic videos are kept
+    runs     - Integer - the number of times each command is run, the median is kept
+
+    Returns:
+    A dictionary of the median seconds per command, in the same layout as bench_video.
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    main_py = os.path.join(root, '__main__.py')
+    videos = os.path.join(work_dir, 'videos') + os.sep
+    heavy = ['mediapipe', 'cv2', 'vosk', 'nltk', 'speech_recognition', 'pandas', 'scipy']
+    check = ('import sys, app; '
+             f'print(" ".join(m for m in {heavy!r} if m in sys.modules))')
+    commands = {'import': [sys.executable, '-c', 'import app'],
+                'help': [sys.executable, main_py, '--help'],
+                'dry_run': [sys.executable, main_py, videos, '--blur_face', '--redact_names',
+                            '--dry_run']}
+
+    stages = {}
+    for name, cmd in commands.items():
+        times = []
+        for _ in range(max(1, runs)):
+            start = time.perf_counter()
+            subprocess.run(cmd, cwd=root, capture_output=True, check=True)
+            times.append(time.perf_counter() - start)
+        stages[name] = {'seconds': float(np.median(times))}
+        print(f'  startup {name}: {stages[name]["seconds"]:.3f}s')
+
+    loaded = subprocess.run([sys.executable, '-c', check], cwd=root, capture_output=True,
+                            text=True, check=True).stdout.split()
+    stages['import']['heavy_modules'] = loaded
+    if loaded:
+        print(f'  importing app loaded {", ".join(loaded)}')
+
+    return stages
+
+def get_meta(args):
+    """
+    Describes the machine and code the benchmark ran on.
+    """
+    def run(cmd):
+        try:
+            return subprocess.run(cmd, capture_output=True, text=True).stdout.splitlines()[0]
+        except (OSError, IndexError):
+            return None
+
+    return {'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'commit': run(['git', 'rev-parse', '--short', 'HEAD']),
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'cpus': os.cpu_count(),
+            'numpy': np.__version__,
+            'opencv': cv2.__version__,
+            'ffmpeg': run(['ffmpeg', '-version']),
+            'detector': args.detector,
+            'engine': args.engine,
+            'workers': args.workers,
+            'detect_every': args.detect_every,
+            'asr_workers': args.asr_workers}
+
+def compare(results, baseline, threshold, min_seconds):
+    """
+    Compares the results with a baseline run and prints every stage that got slower, and any
+    heavy module importing app loads.
+
+    Inputs:
+    results     - dict  - the results of this run
+    baseline    - dict  - the results of the baseline run
+    threshold   - Float - how much slower (as a fraction) a stage can get before it's flagged
+    min_seconds - Float - stages faster than this in both runs are too noisy to flag
+
+    Returns:
+    The list of (video, stage, baseline seconds, new seconds) regressions, with no seconds
+    for heavy modules loaded at startup.
+    """
+    regressions = []
+    print(f"\nCompared with the baseline from {baseline['meta']['time']} "
+          f"(commit {baseline['meta']['commit']}):")
+    for video, stages in results['videos'].items():
+        for stage, stats in stages.items():
+            old = baseline['videos'].get(video, {}).get(stage)
+            if old is None or 'seconds' not in old or 'seconds' not in stats:
+                continue
+            change = stats['seconds'] / old['seconds'] - 1
+            flag = ''
+            if change > threshold and max(stats['seconds'], old['seconds']) >= min_seconds:
+                flag = '  REGRESSION'
+                regressions.append((video, stage, old['seconds'], stats['seconds']))
+            print(f"  {video} {stage}: {old['seconds']:.2f}s -> {stats['seconds']:.2f}s "
+                  f"({change:+.0%}){flag}")
+
+    # Loading a heavy module at startup is a regression however fast this machine loads it
+    loaded = results['videos'].get('startup', {}).get('import', {}).get('heavy_modules', [])
+    for module in loaded:
+        print(f'  importing app loads {module}  REGRESSION')
+        regressions.append(('startup', f'import {module}', None, None))
+
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Anonymization pipeline benchmark suite")
+    parser.add_argument("--resolutions", nargs='+', choices=list(RESOLUTIONS), default=['720p'])
+    parser.add_argument("--minutes", nargs='+', type=float, default=[1],
+                        help="Lengths of the synthetic videos in minutes.")
+    parser.add_argument("--work_dir", type=str,
+                        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data'),
+                        help="Where the synthetic videos and stage outputs are kept.")
+    parser.add_argument("--detector", choices=['mediapipe', 'stub'], default='mediapipe',
+                        help="Find landmarks with MediaPipe or with a colour-based stub.")
+    parser.add_argument("--engine", choices=['holistic', 'face'], default='holistic',
+                        help="The landmark detector used with --detector mediapipe.")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--detect_every", type=int, default=1)
+    parser.add_argument("--vosk_model", type=str,
+                        help="Where the vosk model is unzipped. redact_names is skipped if the \
+                             model can't be loaded.")
+    parser.add_argument("--asr_workers", type=int, default=1)
+    parser.add_argument("--kernel_frames", type=int, default=100,
+                        help="Number of frames the blur kernel is timed on.")
+    parser.add_argument("--startup_runs", type=int, default=5,
+                        help="Number of times each startup command is timed.")
+    parser.add_argument("--startup_only", action='store_true',
+                        help="Only time the command line startup, no videos are processed.")
+    parser.add_argument("--output", type=str, help="Save the results to this JSON file.")
+    parser.add_argument("--compare", type=str, help="A results JSON file to compare against.")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="How much slower (as a fraction) a stage can get before it's \
+                             flagged as a regression.")
+    parser.add_argument("--min_seconds", type=float, default=0.05,
+                        help="Stages faster than this are too noisy to flag.")
+    args = parser.parse_args()
+
+    # Nothing leaves the machine: Google is stubbed and MediaPipe can be
+    audio_processing.sr.Recognizer.recognize_google = stub_recognize_google
+    if args.detector == 'stub':
+        frame_processing.load_detector = lambda *a, **kw: frame_processing.HolisticDetector(StubHolistic())
+
+    vosk_model = None
+    if not args.startup_only:
+        try:
+            vosk_model = audio_processing.load_vosk(args.vosk_model)
+        except Exception as e:
+            print(f'Skipping redact_names, the vosk model could not be loaded: {e}')
+
+    os.makedirs(os.path.join(args.work_dir, 'videos'), exist_ok=True)
+    results = {'meta': get_meta(args), 'videos': {}}
+    print('\nBenchmarking startup...')
+    results['videos']['startup'] = bench_startup(args.work_dir, args.startup_runs)
+    for resolution in ([] if args.startup_only else args.resolutions):
+        (width, height) = RESOLUTIONS[resolution]
+        for minutes in args.minutes:
+            name = f'{resolution}_{minutes:g}min'
+            video = os.path.join(args.work_dir, 'videos', f'{name}_h264.mp4')
+            if not os.path.exists(video):
+                make_video(video, width, height, minutes * 60)
+            print(f'\nBenchmarking {name}...')
+            results['videos'][name] = bench_video(name, video, minutes * 60, args, vosk_model)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f'\nResults saved to {args.output}')
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold, args.min_seconds)
+        if regressions:
+            print(f'\n{len(regressions)} stage(s) regressed by more than {args.threshold:.0%}')
+            sys.exit(1)
+        print('\nNo regressions')
+
+if __name__ == "__main__":
+    main()
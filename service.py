@@ -0,0 +1,269 @@
+import asyncio
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import time
+import app
+from vid_anon import encoding, frame_processing, jobs
+
+# Files written by the pipeline, which are never taken for new videos when the output
+# directory is inside the watched one
+OUTPUT_SUFFIXES = ('_anon.mp4', '_cut.mp4', '_blurred.mp4')
+
+# The most times a video is tried when the worker anonymizing it dies
+MAX_ATTEMPTS = 3
+
+# Which limit each stage waits on. The stages that only run ffmpeg share one
+STAGE_LIMITS = {'cut': 'ffmpeg', 'extract': 'ffmpeg', 'merge': 'ffmpeg', 'redact': 'asr',
+                'blur': 'blur', 'stream': 'blur'}
+
+def get_limits(args, ctx):
+    """
+    Makes the semaphores that limit how many worker processes run each stage at once, so
+    e.g. one video can be merged by ffmpeg while another is blurred.
+
+    Inputs:
+    args - Namespace - the parsed command-line arguments
+    ctx  - Context   - the multiprocessing context of the worker processes
+
+    Returns:
+    A dictionary of semaphores by stage name, passed on to app.load_models.
+    """
+    semaphores = {'ffmpeg': ctx.Semaphore(args.ffmpeg_limit),
+                  'asr': ctx.Semaphore(args.asr_limit),
+                  'blur': ctx.Semaphore(args.blur_limit)}
+
+    return {stage: semaphores[limit] for stage, limit in STAGE_LIMITS.items()}
+
+async def probe(file, slots):
+    """
+    Checks a video can be read, e.g. that it isn't still being copied in, with an ffprobe
+    run on the event loop.
+
+    Inputs:
+    file  - String    - the video to check
+    slots - Semaphore - limits how many ffprobes run at once
+
+    Returns:
+    True if ffprobe found a video stream with a length.
+    """
+    async with slots:
+        proc = await asyncio.create_subprocess_exec('ffprobe', '-v', 'error', '-select_streams', 'v:0',
+                                                    '-show_entries', 'stream=codec_name:format=duration',
+                                                    '-of', 'json', file,
+                                                    stdout=asyncio.subprocess.PIPE,
+                                                    stderr=asyncio.subprocess.DEVNULL)
+        out, _ = await proc.communicate()
+    if proc.returncode != 0:
+        return False
+    try:
+        info = json.loads(out)
+        return bool(info['streams']) and float(info['format']['duration']) > 0
+    except (ValueError, KeyError, TypeError):
+        return False
+
+async def scan(args, queue, slots):
+    """
+    Queues the videos in the watched directory that have no job yet. A video is only queued
+    once it hasn't changed for a while and ffprobe can read it, so half copied videos are
+    left until they're complete.
+
+    Inputs:
+    args  - Namespace - the parsed command-line arguments
+    queue - JobQueue  - the job queue
+    slots - Semaphore - limits how many ffprobes run at once
+
+    Returns:
+    The number of videos queued.
+    """
+    new = []
+    for file in app.find_files(args.input_dir):
+        if file.endswith(OUTPUT_SUFFIXES):
+            continue
+        try:
+            if queue.state(file) is None and time.time() - os.path.getmtime(file) >= args.settle:
+                new.append(file)
+        except FileNotFoundError:
+            # Moved or deleted since it was listed
+            pass
+
+    readable = await asyncio.gather(*(probe(file, slots) for file in new))
+    queued = 0
+    for file, ok in zip(new, readable):
+        if ok and queue.add(file):
+            print(f'Queued {file}')
+            queued += 1
+
+    return queued
+
+def make_pool(args, ctx, limits):
+    """
+    Starts the worker processes. Each loads its models once and keeps them for every video
+    it anonymizes.
+
+    Inputs:
+    args   - Namespace - the parsed command-line arguments
+    ctx    - Context   - the multiprocessing context
+    limits - dict      - the stage semaphores from get_limits
+
+    Returns:
+    The ProcessPoolExecutor.
+    """
+    return concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs, mp_context=ctx,
+                                                  initializer=app.load_models,
+                                                  initargs=(args, limits))
+
+async def run_job(pool, queue, file, args, timings, broken):
+    """
+    Anonymizes one video in a worker process and records how it went.
+
+    Inputs:
+    pool    - ProcessPoolExecutor - the worker processes
+    queue   - JobQueue            - the job queue
+    file    - String              - the video to anonymize
+    args    - Namespace           - the parsed command-line arguments
+    timings - dict                - the first/last mile start/stop times, or None
+    broken  - list                - the videos whose worker died are added to this
+
+    Returns:
+    The result of app.anonymize_file, or None if the video was queued again.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        result = await loop.run_in_executor(pool, app.anonymize_file, file, args, True, timings)
+    except concurrent.futures.process.BrokenProcessPool as e:
+        # A worker died (e.g. ran out of memory) and took every job in the pool with it, so
+        # they are tried again in a new pool, but only a few times in case this video did it
+        broken.append(file)
+        if queue.retry(file, MAX_ATTEMPTS):
+            print(f'A worker died while anonymizing {file}, it is queued again')
+            return None
+        result = {'file': file, 'output': None, 'status': 'failed',
+                  'error': f'{type(e).__name__}: {e}'}
+    queue.finish(file, result)
+    if result['status'] == 'ok':
+        print(f"Finished {file} in {result['seconds']:.1f}s")
+    else:
+        print(f"Failed {file}: {result['error']}")
+
+    return result
+
+async def serve(args):
+    """
+    Watches the input directory and anonymizes every new video in it. Jobs are claimed from
+    the SQLite job queue and run in a pool of worker processes that keep their models
+    loaded between videos, up to --jobs at once, while the stage limits keep e.g. the
+    blurring from crowding out the ffmpeg work of other videos.
+
+    Inputs:
+    args - Namespace - the parsed command-line arguments
+
+    Returns:
+    None
+    """
+    queue = jobs.JobQueue(args.job_db)
+    if not queue.hold():
+        print(f'Another service is using {args.job_db}...stopping')
+        queue.close()
+        return
+    requeued = queue.requeue_running()
+    if requeued:
+        print(f'Queued {requeued} videos again that were running when the service stopped')
+    if args.retry_failed:
+        retried = sum(queue.add(file, retry_failed=True) for file in app.find_files(args.input_dir)
+                      if queue.state(file) == 'failed')
+        if retried:
+            print(f'Queued {retried} videos again that failed')
+
+    # Spawned rather than forked, since forking a process that is running an event loop and
+    # threads can deadlock
+    ctx = multiprocessing.get_context('spawn')
+    limits = get_limits(args, ctx)
+    pool = make_pool(args, ctx, limits)
+    probes = asyncio.Semaphore(args.ffmpeg_limit)
+    wake = asyncio.Event()
+    running = {}
+    broken = []
+    try:
+        while True:
+            # The first/last mile timings can be updated while the service runs
+            timings = None
+            if args.cut_first_last_mile:
+                timings = frame_processing.read_timings(f'{args.input_dir}/{args.cut_first_last_mile}')
+            await scan(args, queue, probes)
+
+            # A pool whose worker died is replaced once every job it had has failed
+            if broken and not running:
+                pool.shutdown(wait=False)
+                pool = make_pool(args, ctx, limits)
+                broken.clear()
+
+            while not broken and len(running) < args.jobs:
+                file = queue.claim()
+                if file is None:
+                    break
+                task = asyncio.create_task(run_job(pool, queue, file, args, timings, broken))
+                task.add_done_callback(lambda task, file=file: (running.pop(file), wake.set()))
+                running[file] = task
+
+            if args.once and not running and queue.counts()['queued'] == 0:
+                break
+
+            # Wake up early when a job finishes so the next one starts straight away
+            try:
+                await asyncio.wait_for(wake.wait(), args.poll)
+            except asyncio.TimeoutError:
+                pass
+            wake.clear()
+    finally:
+        pool.shutdown(cancel_futures=True)
+        print(f'Jobs: {queue.counts()}')
+        queue.close()
+
+def main():
+    parser = app.get_parser()
+    parser.description = "Video anonymization service, anonymizing every new video put in \
+                          input_dir"
+    parser.add_argument("--poll", help="Seconds between looks for new videos.", type=float,
+                        default=10)
+    parser.add_argument("--settle", help="Seconds a video must go unchanged before it is taken, so \
+                                         videos still being copied in are left alone.",
+                        type=float, default=5)
+    parser.add_argument("--blur_limit", help="Most videos blurred at once.", type=int, default=1)
+    parser.add_argument("--asr_limit", help="Most videos having names redacted at once.",
+                        type=int, default=1)
+    parser.add_argument("--ffmpeg_limit", help="Most videos cut, having audio extracted or being \
+                                               merged at once.", type=int, default=2)
+    parser.add_argument("--once", help="Stop once every video in input_dir is done instead of \
+                                       watching for new ones.", action='store_true')
+    parser.set_defaults(job_db='vid_anon_jobs.sqlite', jobs=2)
+
+    args = parser.parse_args()
+    app.check_args(parser, args)
+    if args.patch:
+        parser.error('--patch can not be used with the service, run app.py instead')
+
+    if args.dry_run:
+        queue = jobs.JobQueue(args.job_db)
+        files = [file for file in app.find_files(args.input_dir)
+                 if not file.endswith(OUTPUT_SUFFIXES)
+                 and queue.state(file) not in (('done',) if args.retry_failed else ('done', 'failed'))]
+        app.print_plan(files, args, None, None)
+        return
+
+    # Check the encoder is available before any work is done
+    try:
+        encoding.get_encoder(args.encoder, args.preset, args.crf)
+    except ValueError as e:
+        parser.error(str(e))
+    print(f'Encoding video with {app.get_encoder(args)}')
+    print(f'Watching {args.input_dir} with {args.jobs} workers, job states in {args.job_db}')
+
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        print('Stopped, videos that were running are queued again at the next start')
+
+if __name__ == "__main__":
+    main()
@@ -19,7 +19,8 @@ setup(
     packages = find_packages(),
     entry_points ={
         'console_scripts': [
-            'vid_anon = app:main'
+            'vid_anon = app:main',
+            'vid_anon_service = service:main'
         ]
     },
     classifiers =[
@@ -0,0 +1,116 @@
+import numpy as np
+import pytest
+from vid_anon import frame_processing, tracks
+
+(WIDTH, HEIGHT) = (320, 240)
+SHIRT_POINTS = [11, 12, 24, 23]
+
+class ListDetector:
+    """
+    Gives the landmarks of each frame in turn instead of running a model.
+    """
+    def __init__(self, found):
+        self.found = list(found)
+
+    def detect(self, frame):
+        return self.found.pop(0)
+
+def make_frames(n):
+    rng = np.random.default_rng(0)
+    return [rng.integers(0, 256, (HEIGHT, WIDTH, 3), dtype=np.uint8) for _ in range(n)]
+
+def make_landmarks(pose=True):
+    rng = np.random.default_rng(1)
+    size = np.array([WIDTH, HEIGHT])
+    face = (rng.uniform(0.1, 0.4, (tracks.FACE_POINTS, 2)) * size).astype(np.int32)
+    body = (rng.uniform(0.5, 0.9, (tracks.POSE_POINTS, 2)) * size).astype(np.int32)
+    return {'pose': body if pose else None, 'faces': [face], 'tracked': False}
+
+def expected_face_only(frame, lms, before, missed, track_dilate):
+    """
+    The frame with its face blurred and the missing shirt handled by the missed policy.
+    """
+    frame = frame_processing.blur_regions(frame.copy(), [(lms['faces'][0], 10)])
+    if missed == 'pass':
+        return frame
+    if missed == 'reuse' and before is not None:
+        return frame_processing.blur_regions(frame, [(before['pose'][SHIRT_POINTS], 20)],
+                                             track_dilate)
+    return frame_processing.pixelate(frame, frame_processing.FULL_FRAME_BLOCKS)
+
+def blur_with_detector(found, frames, missed, on_missed):
+    blur = frame_processing.make_frame_blurrer(True, True, detector=ListDetector(found),
+                                               missed=missed, on_missed=on_missed)
+    return [blur(idx, frame.copy()) for idx, frame in enumerate(frames)]
+
+def blur_with_tracks(found, frames, missed, on_missed, tmp_path):
+    writer = tracks.TrackWriter(str(tmp_path / 'tracks'), [WIDTH, HEIGHT])
+    for idx, lms in enumerate(found):
+        writer.write(idx, lms)
+    writer.close()
+    render = frame_processing.make_landmark_renderer(tracks.read_tracks(str(tmp_path / 'tracks')),
+                                                     True, True, missed=missed,
+                                                     on_missed=on_missed)
+    return [render(idx, frame.copy()) for idx, frame in enumerate(frames)]
+
+@pytest.mark.parametrize('missed', frame_processing.MISSED_POLICIES)
+@pytest.mark.parametrize('replay', [False, True])
+@pytest.mark.parametrize('first_pose', [True, False])
+def test_face_blurred_without_pose(tmp_path, missed, replay, first_pose):
+    # The second frame has a face but no pose, after a frame with both (or with no pose either)
+    frames = make_frames(2)
+    found = [make_landmarks(pose=first_pose), make_landmarks(pose=False)]
+    missed_frames = []
+    if replay:
+        blurred = blur_with_tracks(found, frames, missed, missed_frames.append, tmp_path)
+    else:
+        blurred = blur_with_detector(found, frames, missed, missed_frames.append)
+
+    before = found[0] if first_pose else None
+    expected = expected_face_only(frames[1], found[1], before, missed, 0.15)
+    np.testing.assert_array_equal(blurred[1], expected)
+    assert missed_frames == ([1] if first_pose else [0, 1])
+
+    # The face is never left as it was, whatever the policy
+    face = found[1]['faces'][0]
+    (x0, y0), (x1, y1) = face.min(axis=0), face.max(axis=0)
+    assert not np.array_equal(blurred[1][y0:y1, x0:x1], frames[1][y0:y1, x0:x1])
+
+class RegionRecorder(frame_processing.FaceMeshDetector):
+    """
+    A face engine detector that records the region each detection runs on and always finds
+    the same faces, without loading the models.
+    """
+    def __init__(self, faces, max_faces):
+        frame_processing.ScaledDetector.__init__(self, 0, roi_margin=0.5)
+        self.max_faces = max_faces
+        self.faces = faces
+        self.regions = []
+
+    def detect_in(self, frame, roi):
+        self.regions.append(roi)
+        return {'pose': None, 'faces': [face.copy() for face in self.faces], 'tracked': False}
+
+def make_face(x, y):
+    return np.array([[x, y], [x + 40, y], [x + 40, y + 40], [x, y + 40]], dtype=np.int32)
+
+@pytest.mark.parametrize('n_faces, max_faces', [(1, 2), (1, 4), (3, 4)])
+def test_face_roi_unused_while_faces_can_be_missed(n_faces, max_faces):
+    frame = np.zeros((HEIGHT, WIDTH, 3), dtype=np.uint8)
+    detector = RegionRecorder([make_face(20 + 60 * i, 100) for i in range(n_faces)], max_faces)
+    for _ in range(10):
+        detector.detect(frame)
+
+    assert detector.regions == [None] * 10
+
+def test_face_roi_refreshed_often_with_every_face_found():
+    frame = np.zeros((HEIGHT, WIDTH, 3), dtype=np.uint8)
+    detector = RegionRecorder([make_face(20, 100), make_face(200, 100)], max_faces=2)
+    for _ in range(4 * frame_processing.FACE_ROI_REFRESH):
+        detector.detect(frame)
+
+    # Every run of detections on the region is followed by one on the whole frame
+    whole = [i for i, roi in enumerate(detector.regions) if roi is None]
+    assert whole[0] == 0 and len(whole) > 1
+    assert max(np.diff(whole)) <= frame_processing.FACE_ROI_REFRESH + 1
+    assert any(roi is not None for roi in detector.regions)
@@ -0,0 +1,44 @@
+import os
+import subprocess
+import sys
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Loaded lazily, so starting the command line or planning a dry run never imports them
+HEAVY = ['mediapipe', 'cv2', 'vosk', 'nltk', 'speech_recognition', 'pandas', 'scipy']
+
+def loaded_modules(argv):
+    """
+    Runs app.main with the given arguments in a fresh interpreter and returns the heavy
+    modules it imported.
+    """
+    code = ('import sys, app\n'
+            'sys.argv = ["vid_anon"] + sys.argv[1:]\n'
+            'try:\n'
+            '    app.main() if len(sys.argv) > 1 else None\n'
+            'except SystemExit:\n'
+            '    pass\n'
+            f'print(" ".join(m for m in {HEAVY!r} if m in sys.modules))')
+    out = subprocess.run([sys.executable, '-c', code] + argv, cwd=ROOT, capture_output=True,
+                         text=True, check=True).stdout
+    return out.splitlines()[-1].split() if out.strip() else []
+
+@pytest.fixture
+def videos(tmp_path):
+    in_dir = tmp_path / 'videos'
+    in_dir.mkdir()
+    (in_dir / 'drive.mp4').write_bytes(b'')
+    (in_dir / 'timings.csv').write_text('file,start,stop\ndrive.mp4,00:00:01,00:00:05\n')
+    return str(in_dir) + os.sep
+
+def test_import_is_light():
+    assert loaded_modules([]) == []
+
+def test_help_is_light():
+    assert loaded_modules(['--help']) == []
+
+def test_dry_run_is_light(videos, tmp_path):
+    argv = [videos, '--blur_face', '--blur_shirt', '--redact_names', '--cut_first_last_mile',
+            'timings.csv', '--job_db', str(tmp_path / 'jobs.sqlite'), '--dry_run']
+    assert loaded_modules(argv) == []
@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+from vid_anon import frame_processing, tracks
+from vid_anon.cache import ResultCache
+
+def make_landmarks(rng, width, height):
+    """
+    Makes one frame's landmarks in the pixel form detect_landmarks gives them.
+    """
+    size = np.array([width, height])
+    pose = (rng.uniform(0.2, 0.8, (tracks.POSE_POINTS, 2)) * size).astype(np.int32)
+    face = (rng.uniform(0.3, 0.6, (tracks.FACE_POINTS, 2)) * size).astype(np.int32)
+    return {'pose': pose, 'faces': [face], 'tracked': False}
+
+def live_blur(frame, lms):
+    parts = frame_processing.find_regions(lms, True, True)
+    return frame_processing.blur_parts(frame.copy(), parts, {})
+
+def replay_blur(arrays, idx, frame):
+    render = frame_processing.make_landmark_renderer(arrays, True, True)
+    return render(idx, frame.copy())
+
+@pytest.mark.parametrize('width, height', [(320, 240), (1920, 1080), (3840, 2160)])
+def test_tracks_replay_matches_live_blur(tmp_path, width, height):
+    rng = np.random.default_rng(0)
+    frames = [rng.integers(0, 256, (height, width, 3), dtype=np.uint8) for _ in range(3)]
+    found = [make_landmarks(rng, width, height) for _ in frames]
+
+    writer = tracks.TrackWriter(str(tmp_path / 'tracks'), [width, height], fps=30)
+    for idx, lms in enumerate(found):
+        writer.write(idx, lms)
+    writer.close()
+    saved = tracks.read_tracks(str(tmp_path / 'tracks'))
+
+    for idx, (frame, lms) in enumerate(zip(frames, found)):
+        replayed = frame_processing.unpack_landmarks(saved, idx, [width, height])
+        np.testing.assert_array_equal(replayed['pose'], lms['pose'])
+        np.testing.assert_array_equal(replayed['faces'][0], lms['faces'][0])
+        np.testing.assert_array_equal(replay_blur(saved, idx, frame), live_blur(frame, lms))
+
+def test_cached_landmarks_match_live_blur(tmp_path):
+    (width, height) = (640, 360)
+    rng = np.random.default_rng(1)
+    frame = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+    lms = make_landmarks(rng, width, height)
+
+    writer = tracks.TrackWriter(str(tmp_path / 'tracks'), [width, height])
+    writer.write(0, lms)
+    writer.close()
+    found = tracks.read_tracks(str(tmp_path / 'tracks'))
+    cache = ResultCache(str(tmp_path / 'cache'))
+    cache.put_arrays('landmarks', pose=found['pose'], faces=found['faces'],
+                     tracked=found['tracked'])
+
+    np.testing.assert_array_equal(replay_blur(cache.get_arrays('landmarks'), 0, frame),
+                                  live_blur(frame, lms))
@@ -1,159 +1,570 @@
+import concurrent.futures
 import os
-import wave
+import shutil
+import struct
+import subprocess
 import json
 import math
-import pandas as pd
+import multiprocessing
 import numpy as np
-import speech_recognition as sr
-from pydub import AudioSegment
-from pydub.silence import split_on_silence
-from nltk.tag import pos_tag
-from vosk import Model, KaldiRecognizer 
+from . import encoding
+from . import names
+from . import profiling
+from . import streaming
+from .lazy import lazy_import
 
-def get_audio(file, audio_file):
+# Only loaded once speech is recognized
+sr = lazy_import('speech_recognition')
+vosk = lazy_import('vosk')
+
+# Where the vosk model is unzipped to (see the README), can be overridden with VOSK_MODEL_PATH
+VOSK_MODEL_PATH = os.environ.get('VOSK_MODEL_PATH',
+                                 '/home/farlab/vid_anon/vid_anon/vosk-model-en-us-0.22')
+
+# Vosk models already loaded in this process, by path
+_vosk_models = {}
+
+# Pools of speech to text worker processes, by (model path, number of workers)
+_asr_pools = {}
+
+def load_vosk(model_path=None):
+    """
+    Loads the vosk speech to text model. This is slow and uses a lot of memory so the model
+    is only loaded once per process and reused for every file.
+
+    Inputs:
+    model_path - String - where the vosk model is unzipped, defaults to VOSK_MODEL_PATH
+
+    Returns:
+    The vosk model object.
+    """
+    model_path = model_path or VOSK_MODEL_PATH
+    if model_path not in _vosk_models:
+        _vosk_models[model_path] = vosk.Model(model_path)
+
+    return _vosk_models[model_path]
+
+def open_pcm(audio_file, mode='r'):
+    """
+    Memory-maps the samples of a PCM WAV file, so even hours of audio can be read (or edited
+    in place) without loading the file into memory.
+
+    Inputs:
+    audio_file - String - the WAV file
+    mode       - String - 'r' to read the samples or 'r+' to change them in the file
+
+    Returns:
+    A (frames, channels) array of the samples and the sample rate.
+    """
+    with open(audio_file, 'rb') as f:
+        riff, _, wave_id = struct.unpack('<4sI4s', f.read(12))
+        if riff != b'RIFF' or wave_id != b'WAVE':
+            raise ValueError(f'{audio_file} is not a WAV file')
+
+        # Skip over every chunk up to the samples, remembering the format on the way
+        fmt = None
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                raise ValueError(f'{audio_file} has no audio data')
+            chunk_id, size = struct.unpack('<4sI', header)
+            if chunk_id == b'data':
+                offset = f.tell()
+                break
+            if chunk_id == b'fmt ':
+                fmt = struct.unpack('<HHIIHH', f.read(16))
+                size -= 16
+            f.seek(size + (size & 1), 1)
+
+    if fmt is None or fmt[0] not in (1, 0xFFFE):
+        raise ValueError(f'{audio_file} is not PCM audio')
+    (_, channels, rate, _, _, bits) = fmt
+
+    # 8 bit WAVs are unsigned, everything else is signed
+    dtype = {8: np.uint8, 16: np.int16, 32: np.int32}[bits]
+
+    # The size can be missing (or wrong) when the WAV was written to a pipe
+    size = min(size, os.path.getsize(audio_file) - offset)
+    n_frames = size // (channels * bits // 8)
+    if n_frames == 0:
+        return np.zeros((0, channels), dtype=dtype), rate
+
+    return np.memmap(audio_file, dtype=dtype, mode=mode, offset=offset,
+                     shape=(n_frames, channels)), rate
+
+def to_pcm16(samples):
+    """
+    Converts a block of samples to the mono 16 bit PCM bytes the speech recognizers take.
+    Mono 16 bit audio is passed through as is.
+
+    Inputs:
+    samples - numpy array - (frames, channels) samples
+
+    Returns:
+    The PCM bytes.
+    """
+    if samples.shape[1] > 1 or samples.dtype != np.int16:
+        mono = samples.astype(np.float32).mean(axis=1)
+        if samples.dtype == np.uint8:
+            mono = (mono - 128) * 256
+        elif samples.dtype == np.int32:
+            mono /= 65536
+        samples = mono.astype(np.int16)
+
+    return samples.tobytes()
+
+def find_speech(samples, rate, min_silence_len=5000, silence_offset=14, keep_silence=500,
+                window_ms=10, block_seconds=10):
+    """
+    Finds the stretches of speech between long silences, padded with some of the silence
+    on either side the same way split_on_silence does. The loudness is worked out over short
+    windows a block of samples at a time, so memory stays flat however long the audio is.
+
+    Inputs:
+    samples         - numpy array - (frames, channels) samples, e.g. memory-mapped by open_pcm
+    rate            - Integer     - the sample rate
+    min_silence_len - Integer     - the shortest silence (ms) to split on
+    silence_offset  - Integer     - how far below the average loudness (dB) counts as silence
+    keep_silence    - Integer     - how much silence (ms) to keep on each side of the speech
+    window_ms       - Integer     - the length (ms) of the windows the loudness is measured over
+    block_seconds   - Integer     - how many seconds of samples are read at a time
+
+    Returns:
+    A list of non-overlapping [start, end] sample offsets.
+    """
+    n_frames = len(samples)
+    if n_frames == 0:
+        return []
+    window = max(1, rate * window_ms // 1000)
+    block = window * max(1, rate * block_seconds // window)
+
+    # The summed square of the samples in every window, the last window may be short
+    n_windows = -(-n_frames // window)
+    energy = np.empty(n_windows, dtype=np.float64)
+    for start in range(0, n_frames, block):
+        x = samples[start:start + block].astype(np.float32)
+        squares = np.square(x).sum(axis=1)
+        first = start // window
+        full = len(squares) // window
+        energy[first:first + full] = squares[:full * window].reshape(full, window).sum(axis=1)
+        if full * window < len(squares):
+            energy[first + full] = squares[full * window:].sum()
+    counts = np.full(n_windows, window * samples.shape[1], dtype=np.float64)
+    counts[-1] = (n_frames - (n_windows - 1) * window) * samples.shape[1]
+
+    # Silence is anything quieter than silence_offset dB under the loudness of the whole file
+    thresh = energy.sum() / counts.sum() * 10 ** (-silence_offset / 10)
+
+    # Like pydub, a silence starts wherever the next min_silence_len is quiet on average
+    k = max(1, round(min_silence_len / window_ms))
+    if n_windows < k:
+        return [[0, n_frames]]
+    energy_sum = np.r_[0, np.cumsum(energy)]
+    count_sum = np.r_[0, np.cumsum(counts)]
+    quiet = (energy_sum[k:] - energy_sum[:-k]) / (count_sum[k:] - count_sum[:-k]) <= thresh
+
+    # Join runs of quiet starts into silences and keep what is between them
+    edges = np.diff(np.r_[0, quiet.astype(np.int8), 0])
+    silence_starts = np.flatnonzero(edges == 1) * window
+    silence_ends = np.minimum((np.flatnonzero(edges == -1) - 1 + k) * window, n_frames)
+    bounds = np.r_[0, np.stack((silence_starts, silence_ends), axis=1).ravel(), n_frames]
+    pad = keep_silence * rate // 1000
+    ranges = [[max(0, int(start) - pad), min(n_frames, int(end) + pad)]
+              for start, end in bounds.reshape(-1, 2) if end > start]
+
+    # Split any overlapping padding down the middle
+    for prev, cur in zip(ranges, ranges[1:]):
+        if prev[1] > cur[0]:
+            mid = (prev[1] + cur[0]) // 2
+            prev[1] = cur[0] = mid
+
+    return ranges
+
+def _init_asr_worker(model_path):
+    """
+    Loads the vosk model once in a speech to text worker process.
+    """
+    load_vosk(model_path)
+
+def recognize_range(audio_file, start, end, model_path=None, model=None):
+    """
+    Runs vosk over part of a WAV file and gives the word timings on the timeline of the
+    whole file. The samples are read straight from the memory-mapped file.
+
+    Inputs:
+    audio_file - String  - the WAV file to recognize
+    start      - Integer - the sample the part starts at
+    end        - Integer - the sample the part ends at
+    model_path - String  - where the vosk model is unzipped, defaults to VOSK_MODEL_PATH
+    model      - vosk Model - an already loaded vosk model, loaded from model_path if not given
+
+    Returns:
+    A list of vosk word dictionaries (word, start, end, conf) with times in seconds.
+    """
+    if model is None:
+        model = load_vosk(model_path)
+    samples, rate = open_pcm(audio_file)
+
+    rec = vosk.KaldiRecognizer(model, rate)
+    rec.SetWords(True)
+
+    # Found from a stackoverflow...I think this one: https://stackoverflow.com/questions/68175694/how-to-use-wave-file-as-input-in-vosk-speech-recognition
+    results = []
+    # Recognize speech using vosk model
+    for block in range(start, end, 4000):
+        if rec.AcceptWaveform(to_pcm16(samples[block:min(block + 4000, end)])):
+            results.append(json.loads(rec.Result()))
+    results.append(json.loads(rec.FinalResult()))
+
+    # Move the word timings from the start of the part to the start of the file
+    offset = start / rate
+    words = []
+    for sentence in results:
+        for obj in sentence.get('result', []):
+            obj['start'] += offset
+            obj['end'] += offset
+            words.append(obj)
+
+    return words
+
+def recognize_words(audio_file, ranges, model_path=None, asr_workers=1, model=None):
+    """
+    Gets the vosk word timings for every stretch of speech in a WAV file. With more than one
+    worker the stretches are recognized in parallel worker processes, which each load the
+    model once and are kept for the next file.
+
+    Inputs:
+    audio_file  - String  - the WAV file to recognize
+    ranges      - list    - the [start, end] sample offsets of the speech
+    model_path  - String  - where the vosk model is unzipped, defaults to VOSK_MODEL_PATH
+    asr_workers - Integer - the number of processes recognizing speech at once
+    model       - vosk Model - an already loaded vosk model to use when there is one worker
+
+    Returns:
+    A list of vosk word dictionaries (word, start, end, conf) sorted by start time.
+    """
+    if asr_workers <= 1 or len(ranges) <= 1:
+        chunk_words = [recognize_range(audio_file, start, end, model_path, model)
+                       for start, end in ranges]
+    else:
+        key = (model_path, asr_workers)
+        if key not in _asr_pools:
+            # Spawned rather than forked, since this process may be running the Google request
+            # threads or holding a loaded vosk model, and forking it could deadlock
+            ctx = multiprocessing.get_context('spawn')
+            _asr_pools[key] = concurrent.futures.ProcessPoolExecutor(max_workers=asr_workers,
+                                                                     mp_context=ctx,
+                                                                     initializer=_init_asr_worker,
+                                                                     initargs=(model_path,))
+        futures = [_asr_pools[key].submit(recognize_range, audio_file, start, end, model_path)
+                   for start, end in ranges]
+        chunk_words = [f.result() for f in futures]
+
+    words = [word for chunk in chunk_words for word in chunk]
+    words.sort(key=lambda word: word['start'])
+
+    return words
+
+def get_audio(file, audio_file, start=None, end=None):
     """
     Extracts audio from a video file.
 
     Inputs:
     file       - String - the name and path of the video file to extract audio from
     audio_file - String - the name and path of where the extracted audio should be saved
+    start      - String - where to start the audio (HH:MM:SS), or None for the start of the file
+    end        - String - where to stop the audio (HH:MM:SS), or None for the end of the file
 
     Returns:
     The name and path of where the extracted audio was saved
     """
     print(f'Extracting audio from {file}...saving to {audio_file}')
-    # TODO add GPU
-    os.system(f'ffmpeg -loglevel quiet -y -i {file} -vn {audio_file}')
+    trim = []
+    if start is not None:
+        trim += ['-ss', str(start)]
+    if end is not None:
+        trim += ['-to', str(end)]
+
+    # Run without a shell so paths with spaces or quotes in them are passed as they are. A
+    # failed extraction raises rather than leaving a missing or cut short audio file behind
+    subprocess.run(['ffmpeg', '-loglevel', 'error', '-nostdin', '-y', *trim, '-i', file, '-vn',
+                    audio_file], check=True)
 
     return audio_file
 
-def merge_audio(audio_file, file, merged_file):
+def merge_audio(audio_file, file, merged_file, encoder=None):
     """
-    Combines the audio and visual files to make a final video file.
+    Combines the audio and visual files to make a final video file. Video that is already in
+    the encoder's codec (e.g. from blur_vid) is copied as is rather than encoded again.
 
     Inputs:
-    audio_file  - String - the name and path of the audio file
-    file        - String - the name and path of the visual file
-    merged_file - String - the name and path where the combined video will be saved
+    audio_file  - String  - the name and path of the audio file
+    file        - String  - the name and path of the visual file
+    merged_file - String  - the name and path where the combined video will be saved
+    encoder     - Encoder - the encoder settings, or None for the default libx264 ones
 
     Returns:
     The name and path where the combined video was saved
     """
     print(f'Combining audio and video streams and saving to {merged_file}')
-    # TODO add GPU
-    os.system(f'ffmpeg -y -i {file} -i {audio_file} -map 0:v:0 -map 1:a:0 {merged_file}')
+    encoder = encoder or encoding.Encoder()
+    info = streaming.probe_video(file)
+    frames = int(round(info['duration'] * info['fps']))
+
+    cmd = ['ffmpeg', '-loglevel', 'error', '-nostdin', '-y', '-i', file, '-i', audio_file,
+           '-map', '0:v:0', '-map', '1:a:0', '-c:a', 'aac']
+    if info['codec'] == encoder.codec:
+        cmd += ['-c:v', 'copy']
+        encoder = None
+    else:
+        cmd += encoder.args()
+    encoding.run(cmd + [merged_file], 'merge', encoder, frames)
 
     return merged_file
 
-def redact_names(audio_file, redacted_file, out_path):
+def words_to_columns(words):
+    """
+    Turns a list of vosk word dictionaries into columns of numpy arrays.
+
+    Inputs:
+    words - list - vosk word dictionaries with word, start, end and conf
+
+    Returns:
+    A dictionary of arrays with the word, start (s), end (s) and conf of every word.
+    """
+    return {'word': np.array([w['word'] for w in words], dtype=str),
+            'start': np.fromiter((w['start'] for w in words), dtype=np.float64, count=len(words)),
+            'end': np.fromiter((w['end'] for w in words), dtype=np.float64, count=len(words)),
+            'conf': np.fromiter((w['conf'] for w in words), dtype=np.float64, count=len(words))}
+
+def merge_intervals(intervals):
+    """
+    Merges overlapping or touching time intervals.
+
+    Inputs:
+    intervals - numpy array - (N, 2) start and end times
+
+    Returns:
+    An (M, 2) array of sorted, non-overlapping intervals.
+    """
+    intervals = np.asarray(intervals, dtype=np.float64).reshape(-1, 2)
+    if len(intervals) == 0:
+        return intervals
+    intervals = intervals[np.argsort(intervals[:, 0])]
+
+    # A new interval starts wherever the start is past every end before it
+    running_end = np.maximum.accumulate(intervals[:, 1])
+    new_group = np.r_[True, intervals[1:, 0] > running_end[:-1]]
+    group_starts = np.flatnonzero(new_group)
+    group_ends = np.r_[group_starts[1:], len(intervals)] - 1
+
+    return np.stack((intervals[group_starts, 0], running_end[group_ends]), axis=1)
+
+def redact_intervals(audio_file, redacted_file, intervals, redact_mode='mute', fade_ms=0):
+    """
+    Silences or bleeps time intervals of a WAV file directly in its samples and writes the
+    result without running ffmpeg or loading the whole file.
+
+    Inputs:
+    audio_file    - String      - the WAV file to redact
+    redacted_file - String      - where the redacted WAV file should be saved
+    intervals     - numpy array - (N, 2) start and end times in seconds to redact
+    redact_mode   - String      - 'mute' to silence the intervals or 'bleep' to bleep over them
+    fade_ms       - Integer     - how long (ms) to fade out before and in after each interval
+
+    Returns:
+    The name and path of the redacted file.
+    """
+    # Only the redacted samples are touched, in a memory-mapped copy of the file
+    shutil.copyfile(audio_file, redacted_file)
+    samples, rate = open_pcm(redacted_file, 'r+')
+    dtype = samples.dtype.type
+    silence = 128 if dtype == np.uint8 else 0
+    full_scale = np.iinfo(dtype).max - silence
+    fade = int(fade_ms * rate / 1000)
+
+    for start, end in merge_intervals(intervals):
+        start = max(0, int(start * rate))
+        end = min(len(samples), int(np.ceil(end * rate)))
+        if end <= start:
+            continue
+
+        # Ramp the audio down into the interval and back up out of it
+        if fade > 0:
+            before = samples[max(0, start - fade):start]
+            ramp = np.linspace(1, 0, len(before), endpoint=False)[:, None]
+            before[:] = silence + (before.astype(np.float32) - silence) * ramp
+            after = samples[end:end + fade]
+            ramp = np.linspace(0, 1, len(after), endpoint=False)[:, None]
+            after[:] = silence + (after.astype(np.float32) - silence) * ramp
+
+        if redact_mode == 'bleep':
+            t = np.arange(start, end) / rate
+            tone = silence + 0.3 * full_scale * np.sin(2 * np.pi * 1000 * t)
+            samples[start:end] = tone.astype(dtype)[:, None]
+        else:
+            samples[start:end] = silence
+
+    if isinstance(samples, np.memmap):
+        samples.flush()
+    del samples
+
+    return redacted_file
+
+def transcribe_range(samples, rate, start, end):
+    """
+    Transcribes one stretch of speech with google. The stretch is handed to the recognizer
+    from memory, no chunk file is written.
+
+    Inputs:
+    samples - numpy array - (frames, channels) samples, e.g. memory-mapped by open_pcm
+    rate    - Integer     - the sample rate
+    start   - Integer     - the sample offset the speech starts at
+    end     - Integer     - the sample offset the speech ends at
+
+    Returns:
+    The transcript, or None if nothing was recognized.
+    """
+    audio_data = sr.AudioData(to_pcm16(samples[start:end]), rate, 2)
+    text = sr.Recognizer().recognize_google(audio_data, language='en', show_all=True)
+    if not text or not text.get('alternative'):
+        return None
+
+    return text['alternative'][0]['transcript']
+
+def transcribe_google(samples, rate, ranges, google_requests=1):
+    """
+    Transcribes each stretch of speech with google, which capitalizes names so they can be
+    tagged. Several stretches can be sent at once, since each request mostly waits on the
+    network. A stretch that fails is logged and skipped.
+
+    Inputs:
+    samples         - numpy array - (frames, channels) samples, e.g. memory-mapped by open_pcm
+    rate            - Integer     - the sample rate
+    ranges          - list        - the [start, end] sample offsets of the speech
+    google_requests - Integer     - the most requests waiting on google at once
+
+    Returns:
+    A list with the transcript of each stretch of speech that was recognized.
+    """
+    def transcribe(speech):
+        (start, end) = speech
+        try:
+            return transcribe_range(samples, rate, start, end)
+        except Exception as e:
+            print(f'Google could not transcribe the speech at {start / rate:.1f}s '
+                  f'({type(e).__name__}: {e})...continuing...')
+            return None
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, google_requests)) as pool:
+        transcripts = list(pool.map(transcribe, ranges))
+
+    failed = sum(t is None for t in transcripts)
+    if failed:
+        print(f'Google transcribed {len(ranges) - failed} of {len(ranges)} stretches of speech')
+
+    return [t for t in transcripts if t is not None]
+
+def redact_names(audio_file, redacted_file, model=None, model_path=None, asr_workers=1,
+                 redact_mode='mute', fade_ms=0, cache=None, audio_key=None, tagger=None,
+                 google_pass=True, google_requests=1):
     """
     Redacts proper nouns from an audio file by first converting an audio file to text
-    then finding the proper nouns in that text. Requires matching across two speech
-    to text tools so does not recognize uncommon names well. Very good with common names.
+    then finding the proper nouns in that text. The vosk transcript gives the word timings
+    and is tagged itself, and words in the tagger's name lists are always redacted. An
+    optional second pass with google, which capitalizes names, finds names the vosk
+    transcript misses. The google requests run while vosk recognizes the speech, so they
+    only add time when they are slower.
 
     Inputs:
     audio_file    - String - the path where the audio file is saved
     redacted_file - String - where the redacted audio file should be saved
-    out_path      - String - the path where all temporary files are saved for chunk files
+    model         - vosk Model - an already loaded vosk model, only used with one ASR worker
+    model_path    - String - where the vosk model is unzipped, defaults to VOSK_MODEL_PATH
+    asr_workers   - Integer - the number of processes recognizing speech chunks at once
+    redact_mode   - String - 'mute' to silence the redacted words or 'bleep' to bleep over them
+    fade_ms       - Integer - how long (ms) to fade in and out around each redacted word
+    cache         - ResultCache - where to save and look up word timings and transcripts, or None
+    audio_key     - String - the cache key of the audio file
+    tagger        - NameTagger - an already loaded tagger with any name lists, made here if not
+                                 given
+    google_pass   - Boolean - whether to also transcribe with google to find names, otherwise
+                              nothing leaves this machine
+    google_requests - Integer - the most requests waiting on google at once
 
     Returns:
-    A list where the first entry is the redacted audio file location followed by the
-    chunk files to delete later.
+    The redacted audio file location, or the original audio file if there was nothing to
+    redact.
     """
     if not os.path.exists(redacted_file):
         print(f'Redacting proper nouns from {audio_file}...saving to {redacted_file}')
+        tagger = tagger if tagger is not None else names.NameTagger()
 
-        # Pull in the audio objects and chunk the audio for manageable processing
-        r = sr.Recognizer()
-        files = []
-        sound = AudioSegment.from_wav(f'{audio_file}')
-        chunks = split_on_silence(sound,
-                                min_silence_len = 5000,
-                                silence_thresh = sound.dBFS-14,
-                                keep_silence=500,
-                                )
- 
-        # Loop through and process each audio chunk into text and find proper nouns
-        redacted_words = []
-        for i, audio_chunk in enumerate(chunks, start=1):
-            # Save the chunk file
-            chunk_filename = os.path.join(out_path, f'chunk{i}.wav')
-            files += [chunk_filename]
-            audio_chunk.export(chunk_filename, format="wav")
-
-            try:
-                with sr.AudioFile(chunk_filename) as source:
-                    # Convert audio to text with google
-                    audio_data = r.record(source)
-                    text = r.recognize_google(audio_data, language='en', show_all=True)
-
-                # Split the text into words and label by parts of speech (pos)
-                tagged_sent = pos_tag(text['alternative'][0]['transcript'].split())
-
-                # If the word is a proper noun, state that it will be redacted and save the
-                # redacted word to a list
-                new_text = [word if pos != "NNP" else "[redacted]" for word, pos in tagged_sent]
-                redacted_words.append([word.lower() for word, pos in tagged_sent if pos == 'NNP'])
-            except Exception as e:
-                pass
-
-        # Read in the second speech to text tool which gives us the word timings
-        model = Model('/home/farlab/vid_anon/vid_anon/vosk-model-en-us-0.22')
-        wf = wave.open(f'{audio_file}', "rb")
-        rec = KaldiRecognizer(model, wf.getframerate())
-        rec.SetWords(True)
-
-        # Found from a stackoverflow...I think this one: https://stackoverflow.com/questions/68175694/how-to-use-wave-file-as-input-in-vosk-speech-recognition
-        results = []
-        # Recognize speech using vosk model
-        while True:
-            data = wf.readframes(4000)
-            if len(data) == 0:
-                break
-            if rec.AcceptWaveform(data):
-                part_result = json.loads(rec.Result())
-                results.append(part_result)
-        part_result = json.loads(rec.FinalResult())
-        results.append(part_result)
-
-        # Convert list of JSON dictionaries to dataframe where each word is a row and gives the start/stop times
-        word_df = pd.DataFrame(columns=['word','start','end','conf'])
-        i = 0
-        for sentence in results:
-            if len(sentence) == 1:
-                # Account for empty words from pauses
-                continue
-            for obj in sentence['result']:
-                word_df.loc[i] = [obj['word'], obj['start'], obj['end'], obj['conf']]
-                i += 1
+        # Look up the transcripts from an earlier run
+        words = transcripts = None
+        if cache is not None and audio_key is not None:
+            words_key = cache.stage_key(audio_key, 'asr', {'model': model_path or VOSK_MODEL_PATH})
+            google_key = cache.stage_key(audio_key, 'google')
+            words = cache.get_json(words_key)
+            if google_pass:
+                transcripts = cache.get_json(google_key)
+
+        # Find the stretches of speech in the memory-mapped samples
+        if words is None or (google_pass and transcripts is None):
+            samples, rate = open_pcm(audio_file)
+            ranges = find_speech(samples, rate)
+
+        # Send the speech to google in the background
+        google = None
+        if not google_pass:
+            transcripts = []
+        elif transcripts is None:
+            google_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+            google = google_pool.submit(transcribe_google, samples, rate, ranges, google_requests)
+            google_pool.shutdown(wait=False)
+        else:
+            print('Using cached google transcripts...')
+
+        # Read in the second speech to text tool which gives us the word timings. The same
+        # stretches of speech are recognized separately (in parallel with several workers)
+        # and put back on the timeline of the whole file
+        if words is None:
+            with profiling.stage('asr'):
+                words = recognize_words(audio_file, ranges, model_path, asr_workers, model)
+            if cache is not None and audio_key is not None:
+                cache.put_json(words_key, words)
+        else:
+            print('Using cached word timings...')
+
+        if google is not None:
+            # Only the time spent waiting on google after vosk finished is on the critical path
+            with profiling.stage('google'):
+                transcripts = google.result()
+            if cache is not None and audio_key is not None:
+                cache.put_json(google_key, transcripts)
+
+        # Collect the word timings into columns
+        word_cols = words_to_columns(words)
+
+        # Tag every transcript in one batch, then mark each vosk word that is a proper noun
+        # or in the name lists
+        with profiling.stage('tagging'):
+            proper_nouns = tagger.proper_nouns(transcripts + names.split_sentences(word_cols))
+            redacted = tagger.match(word_cols['word'], proper_nouns)
 
         # Only redact if there are redacted words
-        if len(redacted_words) > 0:
-            # Mark a word as redacted in the dataframe with the timings if it was determined to be a proper
-            # noun by nltk. (Weirdly the text from the vosk model doesn't determine proper nouns well.)
-            word_df['redacted'] = np.where(word_df['word'].isin(redacted_words[0]), 1, 0)
-            redacted_df = word_df[word_df['redacted'] == 1].reset_index(drop=True)
-            
-            # Form the ffmpeg command to redact each redacted word from the actual file using the start/stop times
-            # TODO add GPU
-            ffmpeg_cmd = f'''ffmpeg -y -i {audio_file} -af "'''
-            for i, row in redacted_df.iterrows():
-                if i > 0:
-                    ffmpeg_cmd += """, """
-                ffmpeg_cmd += f"""volume=enable='between(t,{row['start']}, {row['end']})':volume=0"""
-
-            ffmpeg_cmd += f"""" {redacted_file}"""
-            os.system(ffmpeg_cmd)
+        if redacted.any():
+            intervals = np.stack((word_cols['start'][redacted], word_cols['end'][redacted]), axis=1)
+
+            # Silence (or bleep) each redacted word in the samples themselves
+            with profiling.stage('redaction'):
+                redact_intervals(audio_file, redacted_file, intervals, redact_mode, fade_ms)
 
         else:
             # If no redaction, return the original audio file
-            word_df['redacted'] = 0
             redacted_file = audio_file
 
-        # Close the audio file
-        wf.close() 
-
-        return [redacted_file] + files
+        return redacted_file
     else:
         print(f'Redacted file already exists...continuing...')
-        return [redacted_file]
\ No newline at end of file
+        return redacted_file
@@ -0,0 +1,191 @@
+import hashlib
+import io
+import json
+import os
+import tempfile
+import numpy as np
+
+class ResultCache:
+    """
+    A persistent cache of stage results keyed by the content of the input file plus the
+    options each stage ran with. Small results (cut bounds, word timings, tags) are stored as
+    JSON and per-frame landmarks as NPZ. Stages that write a file record where the file is,
+    so a later run only trusts it if it hasn't changed since. Entries are written atomically
+    and the least recently used ones are removed when the cache gets too big.
+    """
+    def __init__(self, cache_dir, max_bytes=10 * 1024**3):
+        """
+        Inputs:
+        cache_dir - String  - where the cache is stored
+        max_bytes - Integer - the most the cache can hold before old entries are removed
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(os.path.join(cache_dir, 'objects'), exist_ok=True)
+        os.makedirs(os.path.join(cache_dir, 'hashes'), exist_ok=True)
+
+    def file_key(self, file):
+        """
+        Hashes the content of a file. The hash is remembered by path, size and modification
+        time so unchanged files aren't read again.
+
+        Inputs:
+        file - String - the file to hash
+
+        Returns:
+        The SHA-256 hex digest of the file content.
+        """
+        stat = os.stat(file)
+        memo = os.path.join(self.cache_dir, 'hashes',
+                            hashlib.sha1(os.path.realpath(file).encode()).hexdigest() + '.json')
+        try:
+            with open(memo) as f:
+                saved = json.load(f)
+            if saved['size'] == stat.st_size and saved['mtime'] == stat.st_mtime_ns:
+                return saved['hash']
+        except (OSError, ValueError, KeyError):
+            pass
+
+        digest = hashlib.sha256()
+        with open(file, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+        key = digest.hexdigest()
+        self._write(memo, json.dumps({'size': stat.st_size, 'mtime': stat.st_mtime_ns,
+                                      'hash': key}).encode())
+
+        return key
+
+    @staticmethod
+    def stage_key(parent_key, stage, params=None):
+        """
+        Makes the key for a stage from the key of its input and its options.
+
+        Inputs:
+        parent_key - String - the key of the file or stage this stage reads from
+        stage      - String - the name of the stage
+        params     - dict   - the options that change the stage's result
+
+        Returns:
+        The stage key.
+        """
+        blob = json.dumps([parent_key, stage, params or {}], sort_keys=True, default=str)
+        return hashlib.sha256(blob.encode()).hexdigest()
+
+    def get_json(self, key):
+        """
+        Returns the JSON result stored under a key, or None if there isn't one.
+        """
+        data = self._read(key, 'json')
+        return None if data is None else json.loads(data)
+
+    def put_json(self, key, value):
+        """
+        Stores a JSON-serializable result under a key.
+        """
+        self._put(key, 'json', json.dumps(value).encode())
+
+    def get_arrays(self, key):
+        """
+        Returns the dictionary of numpy arrays stored under a key, or None if there isn't one.
+        """
+        data = self._read(key, 'npz')
+        if data is None:
+            return None
+        with np.load(io.BytesIO(data)) as npz:
+            return {name: npz[name] for name in npz.files}
+
+    def put_arrays(self, key, **arrays):
+        """
+        Stores a set of named numpy arrays under a key.
+        """
+        buf = io.BytesIO()
+        np.savez_compressed(buf, **arrays)
+        self._put(key, 'npz', buf.getvalue())
+
+    def get_file(self, key):
+        """
+        Returns the file a stage wrote under a key, as long as it still exists unchanged.
+
+        Inputs:
+        key - String - the stage key
+
+        Returns:
+        The path of the file, or None if it was never recorded or has changed since.
+        """
+        record = self.get_json(key)
+        if record is None:
+            return None
+        try:
+            stat = os.stat(record['path'])
+        except OSError:
+            return None
+        if stat.st_size != record['size'] or stat.st_mtime_ns != record['mtime']:
+            return None
+
+        return record['path']
+
+    def put_file(self, key, path):
+        """
+        Records the file a stage wrote under a key.
+        """
+        stat = os.stat(path)
+        self.put_json(key, {'path': path, 'size': stat.st_size, 'mtime': stat.st_mtime_ns})
+
+    def _path(self, key, ext):
+        return os.path.join(self.cache_dir, 'objects', key[:2], f'{key}.{ext}')
+
+    def _read(self, key, ext):
+        path = self._path(key, ext)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+
+        # Mark the entry as recently used
+        os.utime(path)
+        return data
+
+    def _put(self, key, ext, data):
+        self._write(self._path(key, ext), data)
+        self.evict()
+
+    def _write(self, path, data):
+        # Write to a temporary file next to the entry and rename it into place, so a crash
+        # can never leave a half-written entry behind
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache fits in max_bytes.
+        """
+        entries = []
+        for root, _, names in os.walk(os.path.join(self.cache_dir, 'objects')):
+            for name in names:
+                if name.endswith('.tmp'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
@@ -0,0 +1,225 @@
+import resource
+import subprocess
+import time
+from . import profiling
+
+# The software encoders supported, by the codec they write. Pieces re-encoded with these can
+# be joined to pieces stream-copied from a source video of the same codec
+ENCODERS = {'h264': 'libx264', 'hevc': 'libx265'}
+
+# Speed presets shared by libx264 and libx265, fastest first
+PRESETS = ['ultrafast', 'superfast', 'veryfast', 'faster', 'fast', 'medium', 'slow', 'slower',
+           'veryslow']
+
+# The CRF each encoder uses when none is given, about the same quality for both
+DEFAULT_CRF = {'libx264': 18, 'libx265': 22}
+
+# The profiles each encoder can write, by the name ffprobe gives them. Re-encoded pieces are
+# only joined to copied ones of a profile in here
+PROFILES = {'libx264': {'Constrained Baseline': 'baseline', 'Baseline': 'baseline',
+                        'Main': 'main', 'High': 'high', 'High 10': 'high10',
+                        'High 4:2:2': 'high422', 'High 4:4:4 Predictive': 'high444'},
+            'libx265': {'Main': 'main', 'Main 10': 'main10'}}
+
+# The video encoders the installed ffmpeg was built with, probed once per process
+_available = None
+
+class Encoder:
+    """
+    The settings ffmpeg encodes video with: the encoder, its speed preset, the constant rate
+    factor and how many threads it can use.
+    """
+    def __init__(self, name='libx264', preset='veryfast', crf=None, threads=0, profile=None,
+                 level=None):
+        """
+        Inputs:
+        name    - String  - the ffmpeg encoder, libx264 or libx265
+        preset  - String  - the speed preset, faster presets give bigger files
+        crf     - Integer - the constant rate factor (lower is better quality), or None for the
+                            encoder's default
+        threads - Integer - the most threads the encoder uses, 0 to use every core
+        profile - String  - the encoder profile (e.g. main), or None to let it pick
+        level   - Integer - the level as ffprobe gives it (e.g. 40 for h264 4.0, 120 for hevc
+                            4.0), or None to let the encoder pick
+        """
+        if name not in ENCODERS.values():
+            raise ValueError(f'Unsupported encoder {name}, choose from {sorted(ENCODERS.values())}')
+        if preset not in PRESETS:
+            raise ValueError(f'Unknown preset {preset}, choose from {PRESETS}')
+        self.name = name
+        self.preset = preset
+        self.crf = DEFAULT_CRF[name] if crf is None else crf
+        self.threads = threads
+        self.profile = profile
+        self.level = level
+
+    @property
+    def codec(self):
+        """
+        The codec the encoder writes.
+        """
+        return next(codec for codec, name in ENCODERS.items() if name == self.name)
+
+    def matching(self, codec):
+        """
+        Returns an encoder with the same settings that writes the given codec, so re-encoded
+        pieces can be joined to stream-copied ones. Codecs with no supported encoder keep this
+        encoder.
+        """
+        if codec not in ENCODERS or codec == self.codec:
+            return self
+        return Encoder(ENCODERS[codec], self.preset, None, self.threads)
+
+    def matching_stream(self, info):
+        """
+        Returns an encoder with the same settings that writes the same codec, profile and level
+        as a video stream, so re-encoded pieces can be joined to pieces copied from it without
+        players choking on the joins. One blank frame is encoded to check the installed encoder
+        can write the stream's pixel format at that level.
+
+        Inputs:
+        info - dict - the stream's details from streaming.probe_video
+
+        Returns:
+        The Encoder, or None if the stream can't be matched and has to be re-encoded whole.
+        """
+        if info['codec'] not in ENCODERS:
+            return None
+        encoder = self.matching(info['codec'])
+        profile = PROFILES[encoder.name].get(info.get('profile'))
+        if profile is None:
+            return None
+        level = info.get('level')
+        encoder = Encoder(encoder.name, encoder.preset, encoder.crf, encoder.threads, profile,
+                          level if level and level > 0 else None)
+
+        cmd = ['ffmpeg', '-loglevel', 'quiet', '-nostdin', '-f', 'lavfi',
+               '-i', f"color=size={info['width']}x{info['height']}:rate={info['fps']}",
+               '-frames:v', '1'] + encoder.args(info['pix_fmt']) + ['-f', 'null', '-']
+        if subprocess.run(cmd).returncode != 0:
+            return None
+
+        return encoder
+
+    def args(self, pix_fmt=None):
+        """
+        Returns the ffmpeg output options that encode the video with these settings.
+        """
+        args = ['-c:v', self.name, '-preset', self.preset, '-crf', str(self.crf),
+                '-pix_fmt', pix_fmt or 'yuv420p']
+        if self.profile is not None:
+            args += ['-profile:v', self.profile]
+        if self.name == 'libx265':
+            # x265 sizes its thread pool itself and is chatty unless told otherwise, and
+            # players expect the hvc1 tag in mp4. ffprobe gives hevc levels times 30
+            params = 'log-level=error' + (f':pools={self.threads}' if self.threads else '')
+            if self.level is not None:
+                params += f':level-idc={self.level / 30:.1f}'
+            args += ['-x265-params', params, '-tag:v', 'hvc1']
+        else:
+            # ffprobe gives h264 levels times 10
+            if self.level is not None:
+                args += ['-level', f'{self.level / 10:.1f}']
+            args += ['-threads', str(self.threads)]
+
+        return args
+
+    def params(self):
+        """
+        Returns the settings as a dictionary, e.g. for cache keys.
+        """
+        params = {'name': self.name, 'preset': self.preset, 'crf': self.crf}
+        if self.profile is not None:
+            params.update(profile=self.profile, level=self.level)
+
+        return params
+
+    def __repr__(self):
+        threads = self.threads or 'auto'
+        profile = f', profile {self.profile}' if self.profile is not None else ''
+        return f'{self.name} (preset {self.preset}, crf {self.crf}{profile}, threads {threads})'
+
+def probe_encoders():
+    """
+    Lists the video encoders the installed ffmpeg was built with.
+
+    Returns:
+    A set of encoder names.
+    """
+    global _available
+    if _available is None:
+        out = subprocess.run(['ffmpeg', '-hide_banner', '-encoders'], capture_output=True,
+                             text=True).stdout
+        _available = set()
+        for line in out.splitlines():
+            fields = line.split()
+            if len(fields) >= 2 and fields[0].startswith('V') and fields[1] != '=':
+                _available.add(fields[1])
+
+    return _available
+
+def get_encoder(name='libx264', preset='veryfast', crf=None, threads=0):
+    """
+    Sets up an encoder after checking the installed ffmpeg has it.
+
+    Inputs:
+    name    - String  - the ffmpeg encoder, libx264 or libx265
+    preset  - String  - the speed preset
+    crf     - Integer - the constant rate factor, or None for the encoder's default
+    threads - Integer - the most threads the encoder uses, 0 to use every core
+
+    Returns:
+    The Encoder.
+    """
+    encoder = Encoder(name, preset, crf, threads)
+    available = probe_encoders()
+    if encoder.name not in available:
+        supported = sorted(set(ENCODERS.values()) & available) or ['none']
+        raise ValueError(f'ffmpeg has no {encoder.name} encoder, it has {", ".join(supported)}')
+
+    return encoder
+
+def children_cpu():
+    """
+    Returns the CPU time (seconds) used by the child processes that have been waited on.
+    """
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return children.ru_utime + children.ru_stime
+
+def run(cmd, stage, encoder, frames):
+    """
+    Runs an ffmpeg command that encodes video and reports how fast it encoded.
+
+    Inputs:
+    cmd     - list    - the ffmpeg command
+    stage   - String  - the stage the encode is part of
+    encoder - Encoder - the encoder used, or None if the video was stream-copied
+    frames  - Integer - the number of frames written
+
+    Returns:
+    None
+    """
+    wall = time.perf_counter()
+    cpu = children_cpu()
+    subprocess.run(cmd, check=True)
+    report(stage, encoder, frames, time.perf_counter() - wall, children_cpu() - cpu)
+
+def report(stage, encoder, frames, wall, cpu):
+    """
+    Prints the throughput of an encode and adds it to the active profiler, if any.
+
+    Inputs:
+    stage   - String  - the stage the encode is part of
+    encoder - Encoder - the encoder used, or None if the video was stream-copied
+    frames  - Integer - the number of frames written
+    wall    - Float   - how long the encode took (seconds)
+    cpu     - Float   - the CPU time ffmpeg used (seconds)
+
+    Returns:
+    None
+    """
+    name = encoder.name if encoder is not None else 'copy'
+    fps = frames / wall if wall > 0 else 0.0
+    print(f'{stage}: {name} wrote {frames} frames in {wall:.1f}s ({fps:.1f} fps, '
+          f'{cpu:.1f}s cpu)')
+    profiling.record_encoder(stage, name, frames, wall, cpu)
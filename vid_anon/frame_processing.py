@@ -1,12 +1,29 @@
-import mediapipe
-import cv2
-import pandas as pd
+import concurrent.futures
+import functools
+import multiprocessing
 import numpy as np
 import os
+import shutil
 import subprocess
-from .utils import find_and_blur_pts
-from datetime import datetime as dt
-from datetime import timedelta as td 
+import tempfile
+import time
+from .utils import landmarks_to_array, blur_region, pixelate
+from . import tracking
+from . import tracks
+from .pipeline import run_pipeline, run_process_pipeline
+from . import streaming
+from . import encoding
+from . import profiling
+from .lazy import lazy_import
+
+# Only loaded once a stage uses them
+mediapipe = lazy_import('mediapipe')
+cv2 = lazy_import('cv2')
+pd = lazy_import('pandas')
+
+# How long (seconds) the first and last mile of driving takes, assuming an average
+# residential speed of 25 mph
+FIRST_LAST_MILE = 144
 
 def load_mp():
     """
@@ -25,16 +42,871 @@ def load_mp():
 
     return holistic
 
-def blur_vid(file, blurred_file, blur_shirt_bool, blur_face_bool):
+# What is done with a frame where the landmarks can't be found: blur the regions last found
+# again, pixelate the whole frame, or write it as it is
+MISSED_POLICIES = ['reuse', 'full', 'pass']
+
+# How many blocks across a frame is pixelated with when nothing was found in it
+FULL_FRAME_BLOCKS = 8
+
+# How many detections in a row can run on the region of interest before the whole frame is
+# checked again, so a face that comes into view outside it is still found
+ROI_REFRESH = 30
+
+# The same for the face engine, which only uses the region at all while it finds as many
+# faces as it can, since otherwise any new face could be outside it
+FACE_ROI_REFRESH = 5
+
+class ScaledDetector:
+    """
+    Runs a landmark model on a downscaled copy of the frame, so colour conversion and inference
+    cost depends on the detection size rather than the video resolution. The copy can also be
+    cropped to a region of interest around where the subject was last found. The model's
+    normalized landmarks are mapped back to full resolution pixels. Subclasses implement find.
+    """
+    # Detections in a row on the region of interest before the whole frame is checked again
+    roi_refresh = ROI_REFRESH
+
+    def __init__(self, detect_width=640, roi_margin=None):
+        """
+        Inputs:
+        detect_width - Integer - the width frames are downscaled to before detection (regions
+                                 are scaled by the same amount), or 0 to detect at full
+                                 resolution
+        roi_margin   - Float   - how far the region of interest reaches past the landmarks last
+                                 found, as a fraction of their size, or None to always detect
+                                 on the whole frame
+        """
+        self.detect_width = detect_width
+        self.roi_margin = roi_margin
+        self.roi = None
+        self.roi_age = 0
+        self.found = (False, 0)
+
+    def detect(self, frame):
+        (f_h, f_w) = frame.shape[:2]
+        roi = self.roi if self.roi_age < self.roi_refresh and self.roi_usable() else None
+        lms = self.detect_in(frame, roi)
+
+        # Look at the whole frame if less was found in the region than last time
+        if roi is not None and (lms['pose'] is None and self.found[0]
+                                or len(lms['faces']) < self.found[1]):
+            roi = None
+            lms = self.detect_in(frame, None)
+
+        self.found = (lms['pose'] is not None, len(lms['faces']))
+        if self.roi_margin is not None:
+            self.update_roi(lms, f_w, f_h, roi)
+
+        return lms
+
+    def detect_in(self, frame, roi):
+        """
+        Runs the model on a region of the frame (the whole frame if roi is None).
+        """
+        (x0, y0, x1, y1) = roi if roi is not None else (0, 0, frame.shape[1], frame.shape[0])
+        crop = frame[y0:y1, x0:x1]
+        (c_h, c_w) = crop.shape[:2]
+
+        # A region is scaled the same as the whole frame would be, so it costs less to detect on
+        if self.detect_width and frame.shape[1] > self.detect_width:
+            scale = self.detect_width / frame.shape[1]
+            crop = cv2.resize(crop, (max(1, int(c_w * scale)), max(1, int(c_h * scale))),
+                              interpolation=cv2.INTER_AREA)
+        rgb = cv2.cvtColor(crop, cv2.COLOR_BGR2RGB)
+
+        # The landmarks are normalized to the region, so they map straight back to full size
+        offset = np.array([x0, y0], dtype=np.int32)
+        to_pixels = lambda landmarks, n: (landmarks_to_array(landmarks, range(n), [c_w, c_h])
+                                          + offset)
+
+        return self.find(rgb, to_pixels)
+
+    def roi_usable(self):
+        """
+        Returns whether the next detection can be limited to the region of interest, given
+        what the last one found.
+        """
+        return True
+
+    def find(self, rgb, to_pixels):
+        """
+        Runs the model on an RGB image and returns the landmarks, using to_pixels(landmarks, n)
+        to turn the model's first n normalized landmarks into full resolution pixels.
+        """
+        raise NotImplementedError
+
+    def update_roi(self, lms, f_w, f_h, roi):
+        """
+        Moves the region of interest to cover the landmarks just found. The region is kept as
+        it is while the landmarks stay well inside it, since the models track between frames
+        best when the image they are given doesn't move.
+        """
+        pts = list(lms['faces'])
+        if lms['pose'] is not None:
+            pts.append(lms['pose'])
+        if not pts:
+            (self.roi, self.roi_age) = (None, 0)
+            return
+
+        pts = np.concatenate(pts)
+        (x0, y0) = np.clip(pts.min(axis=0), 0, [f_w, f_h])
+        (x1, y1) = np.clip(pts.max(axis=0), 0, [f_w, f_h])
+        (w, h) = (max(x1 - x0, 1), max(y1 - y0, 1))
+        grow = lambda margin: (int(max(0, x0 - w * margin)), int(max(0, y0 - h * margin)),
+                               int(min(f_w, x1 + w * margin)), int(min(f_h, y1 + h * margin)))
+        if roi is not None:
+            inner = grow(self.roi_margin / 2)
+            if (inner[0] >= roi[0] and inner[1] >= roi[1]
+                    and inner[2] <= roi[2] and inner[3] <= roi[3]):
+                self.roi_age += 1
+                return
+
+        (self.roi, self.roi_age) = (grow(self.roi_margin), 0)
+
+class HolisticDetector(ScaledDetector):
+    """
+    Finds one person's body pose and face with the MediaPipe holistic model.
+    """
+    def __init__(self, holistic=None, detect_width=640, roi_margin=None):
+        """
+        Inputs:
+        holistic     - mediapipe Object - an already loaded holistic model, loaded here if not
+                                          given
+        detect_width - Integer          - the width frames are downscaled to before detection,
+                                          or 0 for full resolution
+        roi_margin   - Float            - how far the region of interest reaches past the
+                                          person, or None to detect on the whole frame
+        """
+        super().__init__(detect_width, roi_margin)
+        self.holistic = holistic if holistic is not None else load_mp()
+
+    def find(self, rgb, to_pixels):
+        results = self.holistic.process(rgb)
+
+        lms = {'pose': None, 'faces': [], 'tracked': False}
+        if results.pose_landmarks is not None:
+            lms['pose'] = to_pixels(results.pose_landmarks.landmark, 33)
+        if results.face_landmarks is not None:
+            lms['faces'].append(to_pixels(results.face_landmarks.landmark, 468))
+
+        return lms
+
+class FaceMeshDetector(ScaledDetector):
+    """
+    Finds every face in a frame with MediaPipe FaceMesh, plus the body pose with MediaPipe Pose
+    when the shirts are blurred. Much lighter than the holistic model, which only finds one
+    person and also runs the hand models.
+    """
+    roi_refresh = FACE_ROI_REFRESH
+    def __init__(self, pose=False, max_faces=4, detect_width=640, roi_margin=None):
+        """
+        Inputs:
+        pose         - Boolean - whether to find the body pose as well as the faces
+        max_faces    - Integer - the most faces found in a frame
+        detect_width - Integer - the width frames are downscaled to before detection, or 0 for
+                                 full resolution
+        roi_margin   - Float   - how far the region of interest reaches past the faces, or None
+                                 to detect on the whole frame
+        """
+        super().__init__(detect_width, roi_margin)
+        self.max_faces = max_faces
+        self.face_mesh = mediapipe.solutions.face_mesh.FaceMesh(max_num_faces=max_faces,
+                                                                min_detection_confidence=0.2,
+                                                                min_tracking_confidence=0.2)
+        self.pose = None
+        if pose:
+            self.pose = mediapipe.solutions.pose.Pose(min_detection_confidence=0.2,
+                                                      min_tracking_confidence=0.2,
+                                                      model_complexity=0)
+
+    def roi_usable(self):
+        # While fewer faces than the most are found, a new one could come into view anywhere
+        return self.found[1] >= self.max_faces
+
+    def find(self, rgb, to_pixels):
+        lms = {'pose': None, 'faces': [], 'tracked': False}
+        results = self.face_mesh.process(rgb)
+        for face in results.multi_face_landmarks or []:
+            lms['faces'].append(to_pixels(face.landmark, 468))
+        if self.pose is not None:
+            results = self.pose.process(rgb)
+            if results.pose_landmarks is not None:
+                lms['pose'] = to_pixels(results.pose_landmarks.landmark, 33)
+
+        return lms
+
+def load_detector(engine='holistic', pose=True, max_faces=4, detect_width=640, roi_margin=None):
+    """
+    Loads the landmark detector for an engine.
+
+    Inputs:
+    engine       - String  - 'holistic' for the holistic model or 'face' for FaceMesh (and Pose)
+    pose         - Boolean - whether the face engine also finds the body pose
+    max_faces    - Integer - the most faces the face engine finds in a frame
+    detect_width - Integer - the width frames are downscaled to before detection, 0 for none
+    roi_margin   - Float   - how far the region of interest reaches past the landmarks last
+                             found, or None to detect on the whole frame
+
+    Returns:
+    The detector object.
+    """
+    if engine == 'face':
+        return FaceMeshDetector(pose, max_faces, detect_width, roi_margin)
+
+    return HolisticDetector(detect_width=detect_width, roi_margin=roi_margin)
+
+def detect_landmarks(detector, frame):
+    """
+    Runs the landmark detector on a frame and gets the pixel coordinates of the landmarks.
+
+    Inputs:
+    detector - Object      - the detector from load_detector
+    frame    - numpy array - the BGR frame
+
+    Returns:
+    A dictionary with the (33, 2) pose points or None, a list of (468, 2) face points (one per
+    face found) and whether the points were tracked rather than detected (always False here).
+    """
+    return detector.detect(frame)
+
+def find_regions(lms, blur_shirt_bool, blur_face_bool):
+    """
+    Gets the pixel outlines of everything that should be blurred from a frame's landmarks.
+
+    Inputs:
+    lms             - dict    - the frame's landmarks, as returned by detect_landmarks
+    blur_shirt_bool - Boolean - whether or not to blur the logos on shirts
+    blur_face_bool  - Boolean - whether or not to blur faces
+
+    Returns:
+    A dictionary with a list of regions for each part that should be blurred ('shirt' and
+    'face'), or None for a part that wasn't found. Each region is a (points, blocks) pair with
+    its pixel points and how many blocks to pixelate it with.
+    """
+    parts = {}
+
+    # If the shirt logos should be blurred, do this
+    if blur_shirt_bool:
+        shirt_points = [11,12,24,23]
+        parts['shirt'] = None if lms['pose'] is None else [(lms['pose'][shirt_points], 20)]
+
+    # If the faces should be blurred, do this
+    if blur_face_bool:
+        parts['face'] = [(face, 10) for face in lms['faces']] or None
+
+    return parts
+
+def missing_parts(parts):
+    """
+    Returns the parts from find_regions that weren't found.
+    """
+    return [part for part, regions in parts.items() if regions is None]
+
+def blur_regions(frame, regions, dilate=0):
+    """
+    Pixelates every region of a frame.
+
+    Inputs:
+    frame   - numpy array - the frame to blur, modified in place
+    regions - list        - (points, blocks) pairs, as find_regions gives for each part
+    dilate  - Float       - how much to grow the regions, as a fraction of their size
+
+    Returns:
+    The blurred frame.
+    """
+    for pts, blocks in regions:
+        if dilate > 0:
+            pts = tracking.dilate_region(pts, dilate)
+        frame = blur_region(frame, pts, blocks)
+
+    return frame
+
+def blur_missed(frame, regions, missed='reuse', dilate=0):
+    """
+    Blurs a frame where the landmarks couldn't be found, following the missed detection
+    policy. The frame is always kept so the video stays in sync with its audio.
+
+    Inputs:
+    frame   - numpy array - the frame, modified in place
+    regions - list        - the (points, blocks) regions last found, or None if there are none
+    missed  - String      - 'reuse' to blur the regions last found again (or the whole frame if
+                            there are none), 'full' to pixelate the whole frame or 'pass' to
+                            leave the frame as it is
+    dilate  - Float       - how much to grow reused regions, as a fraction of their size
+
+    Returns:
+    The blurred frame.
+    """
+    if missed == 'pass':
+        return frame
+    if missed == 'reuse' and regions:
+        return blur_regions(frame, regions, dilate)
+
+    frame[:] = pixelate(frame, FULL_FRAME_BLOCKS)
+    return frame
+
+def blur_parts(frame, parts, last, dilate=0, missed='reuse', track_dilate=0):
+    """
+    Blurs the regions found in a frame, and the parts that weren't found following the missed
+    detection policy, so e.g. a face is still blurred when the pose next to it is missed.
+
+    Inputs:
+    frame        - numpy array - the frame to blur, modified in place
+    parts        - dict        - the regions of each part, from find_regions
+    last         - dict        - the regions of each part last found, updated with the ones
+                                 found in this frame
+    dilate       - Float       - how much to grow the regions found
+    missed       - String      - what to do with the parts that weren't found, one of
+                                 MISSED_POLICIES (see blur_missed)
+    track_dilate - Float       - how much to grow regions reused for the parts not found
+
+    Returns:
+    The blurred frame.
+    """
+    found = {part: regions for part, regions in parts.items() if regions is not None}
+    frame = blur_regions(frame, [r for regions in found.values() for r in regions], dilate)
+    missing = missing_parts(parts)
+    if missing:
+        # Reusing only works when every missing part was found before
+        reused = None
+        if all(last.get(part) for part in missing):
+            reused = [r for part in missing for r in last[part]]
+        frame = blur_missed(frame, reused, missed, track_dilate)
+    last.update(found)
+
+    return frame
+
+def make_frame_blurrer(blur_shirt_bool, blur_face_bool, detector=None, detect_every=1,
+                       motion_thresh=None, scene_thresh=25.0, track_dilate=0.15,
+                       engine='holistic', max_faces=4, detect_width=640, roi_margin=None,
+                       missed='reuse', on_landmarks=None, on_missed=None):
+    """
+    Builds a function that blurs a single frame. Each call loads its own landmark detector so
+    every worker in the frame pipeline can run independently.
+
+    When detect_every is more than 1, the landmarks are only detected on keyframes and are
+    moved along with optical flow in between. A new keyframe is also forced when the frames
+    aren't consecutive, when the scene changes, when the motion is too large or when the
+    tracking fails. Regions are grown by track_dilate so drift can't uncover a face.
+
+    Inputs:
+    blur_shirt_bool - Boolean          - whether or not to blur the logos on shirts
+    blur_face_bool  - Boolean          - whether or not to blur faces
+    detector        - Object           - an already loaded detector, loaded here if not given
+    detect_every    - Integer          - run the detector at least every this many frames
+    motion_thresh   - Float            - redetect when regions move more than this many pixels
+                                         in a frame, or None for no limit
+    scene_thresh    - Float            - redetect when the mean grey level difference between
+                                         frames is more than this
+    track_dilate    - Float            - how much to grow the regions while tracking, as a
+                                         fraction of their size
+    engine          - String           - the detector to load, 'holistic' or 'face'
+    max_faces       - Integer          - the most faces the face engine finds in a frame
+    detect_width    - Integer          - the width frames are downscaled to before detection
+    roi_margin      - Float            - how far the region of interest reaches past the
+                                         landmarks last found, or None for the whole frame
+    missed          - String           - what to do with frames where the landmarks can't be
+                                         found, one of MISSED_POLICIES (see blur_missed)
+    on_landmarks    - function         - called with (frame index, landmarks) for every frame,
+                                         e.g. to save them
+    on_missed       - function         - called with the frame index of every frame where the
+                                         landmarks couldn't be found, e.g. to count them
+
+    Returns:
+    A function taking (frame index, frame) that returns the blurred frame.
+    """
+    if detector is None:
+        detector = load_detector(engine, blur_shirt_bool, max_faces, detect_width, roi_margin)
+    dilate = track_dilate if detect_every > 1 else 0
+
+    # The last frame this worker saw, used to track between keyframes, and the last regions
+    # found of each part, reused when a part isn't found
+    state = {'idx': None, 'gray': None, 'lms': None, 'age': 0}
+    last = {}
+
+    def blur_frame(idx, frame):
+        lms = None
+
+        # Move the landmarks from the last frame if it isn't time for a keyframe
+        if detect_every > 1:
+            start = time.perf_counter()
+            gray, scale = tracking.small_gray(frame)
+            if (state['idx'] == idx - 1 and state['age'] + 1 < detect_every
+                    and not tracking.scene_changed(state['gray'], gray, scene_thresh)):
+                lms = tracking.track_landmarks(state['gray'], gray, state['lms'],
+                                               scale, motion_thresh)
+            state['age'] = state['age'] + 1 if lms is not None else 0
+            profiling.record_frame('track', time.perf_counter() - start)
+
+        parts = None if lms is None else find_regions(lms, blur_shirt_bool, blur_face_bool)
+
+        # Get the body pose estimation points
+        if parts is None or missing_parts(parts):
+            start = time.perf_counter()
+            lms = detect_landmarks(detector, frame)
+            profiling.record_frame('inference', time.perf_counter() - start)
+            parts = find_regions(lms, blur_shirt_bool, blur_face_bool)
+            state['age'] = 0
+        if on_landmarks is not None:
+            on_landmarks(idx, lms)
+
+        start = time.perf_counter()
+        if missing_parts(parts):
+            state['idx'] = None
+            if on_missed is not None:
+                on_missed(idx)
+        elif detect_every > 1:
+            state.update(idx=idx, gray=gray, lms=lms)
+        frame = blur_parts(frame, parts, last, dilate, missed, track_dilate)
+        profiling.record_frame('blur', time.perf_counter() - start)
+
+        return frame
+
+    return blur_frame
+
+def make_process_blurrer(blur_shirt_bool, blur_face_bool, blur_opts, send_landmarks, send):
+    """
+    Builds the frame blurrer inside a worker process of the process pipeline, where the
+    landmarks and missed detections are sent back to the main process, tagged with what they
+    are, rather than saved directly.
+
+    Inputs:
+    blur_shirt_bool - Boolean  - whether or not to blur the logos on shirts
+    blur_face_bool  - Boolean  - whether or not to blur faces
+    blur_opts       - dict     - keyframe and tracking options passed on to make_frame_blurrer
+    send_landmarks  - Boolean  - whether every frame's landmarks are sent back
+    send            - function - sends (frame index, value) back to the main process
+
+    Returns:
+    A function taking (frame index, frame) as returned by make_frame_blurrer.
+    """
+    on_landmarks = None
+    if send_landmarks:
+        on_landmarks = lambda idx, lms: send(idx, ('landmarks', lms))
+
+    return make_frame_blurrer(blur_shirt_bool, blur_face_bool, on_landmarks=on_landmarks,
+                              on_missed=lambda idx: send(idx, ('missed', None)), **blur_opts)
+
+def unpack_landmarks(arrays, idx, frame_shape):
+    """
+    Gets one frame's landmarks back out of saved track arrays.
+
+    Inputs:
+    arrays      - dict    - the pose, faces and tracked arrays from tracks.read_tracks
+    idx         - Integer - the frame index
+    frame_shape - list    - frame width, frame height
+
+    Returns:
+    The frame's landmarks in the same form as detect_landmarks.
+    """
+    lms = {'pose': None, 'faces': [], 'tracked': False}
+    if idx >= len(arrays['pose']):
+        return lms
+
+    # Rounded rather than truncated, so the pixels match the ones the landmarks were found at
+    scale = np.asarray(frame_shape, dtype=np.float32)
+    if not np.isnan(arrays['pose'][idx, 0, 0]):
+        lms['pose'] = np.rint(arrays['pose'][idx].astype(np.float32) * scale).astype(np.int32)
+    for face in arrays['faces'][idx]:
+        if not np.isnan(face[0, 0]):
+            lms['faces'].append(np.rint(face.astype(np.float32) * scale).astype(np.int32))
+    lms['tracked'] = bool(arrays['tracked'][idx])
+
+    return lms
+
+def make_landmark_renderer(arrays, blur_shirt_bool, blur_face_bool, dilate=0, missed='reuse',
+                           track_dilate=0.15, on_missed=None):
+    """
+    Builds a function that blurs frames using saved landmarks instead of running a model.
+
+    Inputs:
+    arrays          - dict     - the pose, faces and tracked arrays from tracks.read_tracks
+    blur_shirt_bool - Boolean  - whether or not to blur the logos on shirts
+    blur_face_bool  - Boolean  - whether or not to blur faces
+    dilate          - Float    - how much to grow the regions, as a fraction of their size
+    missed          - String   - what to do with frames where no landmarks were saved, one of
+                                 MISSED_POLICIES (see blur_missed)
+    track_dilate    - Float    - how much to grow regions reused for those frames
+    on_missed       - function - called with the frame index of every frame with no landmarks
+
+    Returns:
+    A function taking (frame index, frame) that returns the blurred frame.
+    """
+    last = {}
+
+    def render_frame(idx, frame):
+        (f_h, f_w) = frame.shape[:2]
+        parts = find_regions(unpack_landmarks(arrays, idx, [f_w, f_h]),
+                             blur_shirt_bool, blur_face_bool)
+
+        start = time.perf_counter()
+        if missing_parts(parts) and on_missed is not None:
+            on_missed(idx)
+        frame = blur_parts(frame, parts, last, dilate, missed, track_dilate)
+        profiling.record_frame('blur', time.perf_counter() - start)
+
+        return frame
+
+    return render_frame
+
+def get_chunk_size(blur_opts):
+    """
+    Picks how many consecutive frames each pipeline worker gets at a time. Tracking between
+    keyframes only works on consecutive frames, so chunks cover several keyframe intervals.
+
+    Inputs:
+    blur_opts - dict - the options passed on to make_frame_blurrer
+
+    Returns:
+    The chunk size.
+    """
+    detect_every = blur_opts.get('detect_every', 1)
+    return 1 if detect_every <= 1 else 4 * detect_every
+
+def report_missed(missed, frames, policy):
+    """
+    Prints how many frames the landmarks couldn't be found in.
+
+    Inputs:
+    missed - Integer - the number of frames with no landmarks
+    frames - Integer - the number of frames written
+    policy - String  - what was done with those frames
+
+    Returns:
+    None
+    """
+    if missed:
+        done = {'reuse': 'blurred where they were last found, or fully pixelated',
+                'full': 'fully pixelated',
+                'pass': 'left as they were'}[policy]
+        print(f'No landmarks found in {missed} of {frames} frames ({missed / frames:.1%}), '
+              f'they were {done}')
+
+def process_frames(read_frame, write_frame, frame_shape, blur_shirt_bool, blur_face_bool,
+                   workers=1, queue_size=64, detector=None, cache=None, video_key=None,
+                   tracks_dir=None, from_tracks=None, fps=None, processes=False, **blur_opts):
+    """
+    Blurs every frame from a reader into a writer through the frame pipeline. The landmarks
+    found can be saved to a track directory and to the cache, and a later run can blur from
+    the saved landmarks without running the model.
+
+    Inputs:
+    read_frame      - function    - returns the next frame or None at the end
+    write_frame     - function    - writes a blurred frame
+    frame_shape     - list        - frame width, frame height
+    blur_shirt_bool - Boolean     - whether or not to blur the logos on shirts
+    blur_face_bool  - Boolean     - whether or not to blur faces
+    workers         - Integer     - the number of threads finding landmarks and blurring frames
+    queue_size      - Integer     - the number of frames that can wait between pipeline stages
+    detector        - Object      - an already loaded landmark detector for the first worker
+    cache           - ResultCache - where to save and look up landmarks, or None
+    video_key       - String      - the cache key of the video being read
+    tracks_dir      - String      - a directory to save every frame's landmarks to, or None
+    from_tracks     - String      - a track directory to blur from instead of running the model
+    fps             - Float       - the frame rate, saved with the tracks
+    processes       - Boolean     - whether the workers finding landmarks are processes sharing
+                                    frames through shared memory rather than threads
+    blur_opts       - dict        - keyframe and tracking options passed on to make_frame_blurrer
+
+    Returns:
+    The number of frames written.
+    """
+    detect_every = blur_opts.get('detect_every', 1)
+    missed = []
+    landmarks_key = None
+    saved = None
+    if from_tracks is not None:
+        print(f'Blurring from the landmarks saved in {from_tracks}...')
+        saved = tracks.read_tracks(from_tracks)
+        detect_every = saved['meta'].get('detect_every', 1)
+    elif cache is not None and video_key is not None:
+        detect_opts = {k: v for k, v in blur_opts.items() if k not in ('track_dilate', 'missed')}
+        landmarks_key = cache.stage_key(video_key, 'landmarks',
+                                        dict(detect_opts, blur_shirt=blur_shirt_bool,
+                                             blur_face=blur_face_bool, dtype=tracks.DTYPE))
+        saved = cache.get_arrays(landmarks_key)
+        if saved is not None:
+            print('Blurring from cached landmarks...')
+            if tracks_dir is not None:
+                tracks.write_tracks(tracks_dir, saved, {'width': frame_shape[0],
+                                                        'height': frame_shape[1], 'fps': fps,
+                                                        'detect_every': detect_every})
+
+    if saved is not None:
+        track_dilate = blur_opts.get('track_dilate', 0.15)
+        dilate = track_dilate if detect_every > 1 else 0
+        make_worker = lambda: make_landmark_renderer(saved, blur_shirt_bool, blur_face_bool, dilate,
+                                                     blur_opts.get('missed', 'reuse'),
+                                                     track_dilate, missed.append)
+        written = run_pipeline(read_frame, write_frame, make_worker, workers=workers,
+                               queue_size=queue_size)
+        report_missed(len(missed), written, blur_opts.get('missed', 'reuse'))
+        profiling.record_media(written, fps, len(missed))
+        return written
+
+    # Save the landmarks as they are found, to a temporary directory if only the cache wants them
+    writer = None
+    temp_dir = None
+    if tracks_dir is None and landmarks_key is not None:
+        temp_dir = tempfile.mkdtemp(prefix='tracks_', dir=cache.cache_dir)
+    if tracks_dir is not None or temp_dir is not None:
+        # Only the face engine finds more than one face
+        n_faces = blur_opts.get('max_faces', 1) if blur_opts.get('engine') == 'face' else 1
+        writer = tracks.TrackWriter(tracks_dir or temp_dir, frame_shape, fps, n_faces=n_faces,
+                                    detect_every=detect_every)
+
+    # The first worker reuses the model passed in, the others load their own
+    preloaded = [detector] if detector is not None else []
+
+    def make_worker():
+        model = preloaded.pop() if preloaded else None
+        return make_frame_blurrer(blur_shirt_bool, blur_face_bool, model,
+                                  on_landmarks=writer.write if writer is not None else None,
+                                  on_missed=missed.append, **blur_opts)
+
+    # The worker processes send back what each value they send is
+    def on_result(idx, value):
+        (kind, value) = value
+        if kind == 'landmarks':
+            writer.write(idx, value)
+        else:
+            missed.append(idx)
+
+    try:
+        if processes:
+            # Every worker process loads its own model
+            make_worker = functools.partial(make_process_blurrer, blur_shirt_bool, blur_face_bool,
+                                            blur_opts, writer is not None)
+            written = run_process_pipeline(read_frame, write_frame, make_worker, frame_shape,
+                                           workers=workers, queue_size=queue_size,
+                                           chunk_size=get_chunk_size(blur_opts),
+                                           on_result=on_result)
+        else:
+            written = run_pipeline(read_frame, write_frame, make_worker, workers=workers,
+                                   queue_size=queue_size, chunk_size=get_chunk_size(blur_opts))
+    finally:
+        if writer is not None:
+            writer.close()
+    report_missed(len(missed), written, blur_opts.get('missed', 'reuse'))
+    profiling.record_media(written, fps, len(missed))
+
+    try:
+        if landmarks_key is not None:
+            found = tracks.read_tracks(tracks_dir or temp_dir)
+            cache.put_arrays(landmarks_key, pose=found['pose'], faces=found['faces'],
+                             tracked=found['tracked'])
+    finally:
+        if temp_dir is not None:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    return written
+
+def get_shards(file, shards, info=None):
+    """
+    Splits a video into runs of frames of about the same length that each start on a
+    keyframe, so every run can be decoded on its own. Only the packet headers near the split
+    points are read.
+
+    Inputs:
+    file   - String  - the video to split
+    shards - Integer - how many runs to split it into
+    info   - dict    - the video's details from streaming.probe_video, probed if not given
+
+    Returns:
+    A list of (first frame, end frame) pairs covering the video. There can be fewer than asked
+    for if keyframes are far apart.
+    """
+    info = info or streaming.probe_video(file)
+    (fps, n_frames) = (info['fps'], info['frames'])
+    targets = [round(i * n_frames / shards) for i in range(1, shards)]
+    times = streaming.probe_keyframes(file, [info['start_time'] + t / fps for t in targets])
+    keyframes = np.round((times - info['start_time']) * fps).astype(int)
+
+    # Split at the keyframe nearest each target
+    bounds = [0]
+    for target in targets:
+        if len(keyframes) == 0:
+            break
+        k = int(keyframes[np.argmin(np.abs(keyframes - target))])
+        if bounds[-1] < k < n_frames:
+            bounds.append(k)
+    bounds.append(n_frames)
+
+    return list(zip(bounds[:-1], bounds[1:]))
+
+def blur_shard(file, part_file, first, last, info, blur_shirt_bool, blur_face_bool, warmup=30,
+               queue_size=64, encoder=None, final=False, profile=False, **blur_opts):
+    """
+    Blurs one run of frames of a video into its own file. Runs in a process of its own with
+    its own model. The warm-up frames before the run are only shown to the model, so it is
+    already tracking the people in the video when the run starts.
+
+    Inputs:
+    file            - String  - the video to blur
+    part_file       - String  - where to save the blurred run
+    first           - Integer - the first frame of the run, a keyframe
+    last            - Integer - the frame the run ends before
+    info            - dict    - the video's details from streaming.probe_video
+    blur_shirt_bool - Boolean - whether or not to blur the logos on shirts
+    blur_face_bool  - Boolean - whether or not to blur faces
+    warmup          - Integer - how many frames before the run are shown to the model
+    queue_size      - Integer - the number of frames that can wait between pipeline stages
+    encoder         - Encoder - the encoder settings, or None for the default libx264 ones
+    final           - Boolean - whether the run goes to the end of the video, in which case
+                                every frame left is read whatever the frame count said
+    profile         - Boolean - whether to send back the per-frame timings
+    blur_opts       - dict    - keyframe and tracking options passed on to make_frame_blurrer
+
+    Returns:
+    The number of frames written, how long the encode took and the CPU time it used
+    (seconds), the per-frame timings by kind if profiling and the number of frames the
+    landmarks couldn't be found in.
+    """
+    profiler = profiling.start() if profile else None
+    (fps, f_w, f_h) = (info['fps'], info['width'], info['height'])
+    warm = min(warmup, first)
+    half = 0.5 / fps
+
+    # Only frames of the run itself count as missed, not the warm-up ones
+    missed = []
+    blurrer = make_frame_blurrer(blur_shirt_bool, blur_face_bool,
+                                 on_missed=lambda idx: idx >= first and missed.append(idx),
+                                 **blur_opts)
+    reader = streaming.open_reader(file, max(0, (first - warm) / fps - half),
+                                   None if final else last / fps + half, passthrough=True)
+    encode_start = time.perf_counter()
+    writer = streaming.open_writer(part_file, f_w, f_h, fps, encoder=encoder)
+
+    # The decoder can give a frame more than asked for, so frames are counted
+    count = [0]
+
+    def read_frame():
+        if not final and count[0] >= warm + last - first:
+            return None
+        count[0] += 1
+        return streaming.read_frame(reader, f_w, f_h)
+
+    try:
+        for idx in range(first - warm, first):
+            frame = read_frame()
+            if frame is None:
+                break
+            blurrer(idx, frame)
+        written = run_pipeline(read_frame, lambda frame: streaming.write_frame(writer, frame),
+                               lambda: (lambda idx, frame: blurrer(first + idx, frame)),
+                               queue_size=queue_size, chunk_size=get_chunk_size(blur_opts))
+    except Exception:
+        writer.kill()
+        raise
+    finally:
+        reader.kill()
+        reader.wait()
+    cpu = encoding.children_cpu()
+    streaming.close(writer)
+
+    timings = profiler.frames if profiler is not None else {}
+    profiling.stop()
+
+    return (written, time.perf_counter() - encode_start, encoding.children_cpu() - cpu, timings,
+            len(missed))
+
+def blur_sharded(file, blurred_file, blur_shirt_bool, blur_face_bool, shards, warmup=30,
+                 queue_size=64, encoder=None, **blur_opts):
+    """
+    Blurs a long video as several runs of frames at once, each in its own process with its
+    own model, so one long video doesn't leave every core but one idle. The runs start on
+    keyframes, are encoded separately and are joined without re-encoding.
+
+    Inputs:
+    file            - String  - where the video to blur is saved
+    blurred_file    - String  - where to save the blurred video
+    blur_shirt_bool - Boolean - whether or not to blur the logos on shirts
+    blur_face_bool  - Boolean - whether or not to blur faces
+    shards          - Integer - how many runs to split the video into
+    warmup          - Integer - how many frames before each run are shown to its model
+    queue_size      - Integer - the number of frames that can wait between pipeline stages
+    encoder         - Encoder - the encoder settings, or None for the default libx264 ones
+    blur_opts       - dict    - keyframe and tracking options passed on to make_frame_blurrer
+
+    Returns:
+    The number of frames written.
+    """
+    info = streaming.probe_video(file)
+    runs = get_shards(file, shards, info)
+    print(f'Blurring {len(runs)} shards at once, starting at frames {[a for a, _ in runs]}...')
+
+    # The cores are split between the encoders of the shards
+    encoder = encoder or encoding.Encoder()
+    if encoder.threads == 0:
+        encoder = encoding.Encoder(encoder.name, encoder.preset, encoder.crf,
+                                   max(1, (os.cpu_count() or 1) // len(runs)))
+
+    start = time.perf_counter()
+    temp_dir = tempfile.mkdtemp(prefix='shards_', dir=os.path.dirname(blurred_file) or '.')
+    try:
+        # Spawned rather than forked, since forking a process that is running model threads
+        # can deadlock
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=len(runs), mp_context=multiprocessing.get_context('spawn')) as pool:
+            futures = [pool.submit(blur_shard, file, os.path.join(temp_dir, f'part{i}.mkv'),
+                                   a, b, info, blur_shirt_bool, blur_face_bool, warmup,
+                                   queue_size, encoder, i == len(runs) - 1,
+                                   profiling.enabled(), **blur_opts)
+                       for i, (a, b) in enumerate(runs)]
+            results = [future.result() for future in futures]
+
+        # Shards with no frames (e.g. past the real end of the video) have nothing to join
+        parts = []
+        durations = []
+        for i, (written, _, _, timings, _) in enumerate(results):
+            for kind, times in timings.items():
+                for seconds in times:
+                    profiling.record_frame(kind, seconds)
+            if written > 0:
+                parts.append(os.path.join(temp_dir, f'part{i}.mkv'))
+                durations.append(written / info['fps'])
+        written = sum(r[0] for r in results)
+        missed = sum(r[4] for r in results)
+        if not parts:
+            raise RuntimeError(f'No frames of {file} could be blurred')
+        streaming.concat_segments(parts, blurred_file, durations)
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+    encoding.report('blur', encoder, written, time.perf_counter() - start,
+                    sum(r[2] for r in results))
+    report_missed(missed, written, blur_opts.get('missed', 'reuse'))
+    profiling.record_media(written, info['fps'], missed)
+
+    return written
+
+def blur_vid(file, blurred_file, blur_shirt_bool, blur_face_bool, workers=1, queue_size=64,
+             detector=None, cache=None, video_key=None, tracks_dir=None, from_tracks=None,
+             encoder=None, processes=False, shards=1, warmup=30, **blur_opts):
     """
     Blurs the video based on the face and logo blur preferences. Takes in the booleans to know
-    what to blur.
+    what to blur. Decoding, blurring and encoding run in separate threads so they overlap.
 
     Inputs:
     file            - String  - where the video to blur is saved
     blurred_file    - String  - where to save the blurred video
     blur_shirt_bool - Boolean - whether or not to blur the logos on shirts
     blur_face_bool  - Boolean - whether or not to blur faces
+    workers         - Integer - the number of threads finding landmarks and blurring frames
+    queue_size      - Integer - the number of frames that can wait between pipeline stages
+    detector        - Object  - an already loaded landmark detector for the first worker
+    cache           - ResultCache - where to save and look up the landmarks, or None
+    video_key       - String  - the cache key of the video being blurred
+    tracks_dir      - String  - a directory to save every frame's landmarks to, or None
+    from_tracks     - String  - a track directory to blur from instead of running MediaPipe
+    encoder         - Encoder - the encoder settings, or None for the default libx264 ones
+    processes       - Boolean - whether the workers are processes rather than threads
+    shards          - Integer - how many runs of frames to split the video into and blur at
+                                once, each in its own process (the workers, tracks and cached
+                                landmarks are only used with one)
+    warmup          - Integer - how many frames before each shard are shown to its model
+    blur_opts       - dict    - keyframe and tracking options passed on to make_frame_blurrer
 
     Returns:
     The location where the blurred video is stored (no audio).
@@ -52,103 +924,265 @@ def blur_vid(file, blurred_file, blur_shirt_bool, blur_face_bool):
             print_msg = print_msg.format('logos')
         print(print_msg)
 
-        # Get the holistic object if faces are being blurred
-        if blur_face_bool:
-            holistic = load_mp()
+        if shards > 1:
+            blur_sharded(file, blurred_file, blur_shirt_bool, blur_face_bool, shards, warmup,
+                         queue_size, encoder, **blur_opts)
+            return blurred_file
 
-        # Read in the video file and set up the output file
+        # Read in the video file and set up an ffmpeg encoder for the output file
         cap = cv2.VideoCapture(file)
-        out = cv2.VideoWriter(blurred_file, cv2.VideoWriter_fourcc('m','p','4','v'), 
-                            30, (int(cap.get(3)), int(cap.get(4))))
-
-        # Iterators for tracking changes between frames and errors in empty
-        # frames at file end
-        good_frame = 0
-        bad_frame = 0
-
-        while True:
-            try:
-                # Read in the next frame and get its shape if it's the first frame
-                _, frame = cap.read()
-                if good_frame == 0:
-                    (f_h, f_w) = frame.shape[:2]
-
-                # Get the body pose estimation points
-                results = holistic.process(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
-
-                # If the shirt logos should be blurred, do this
-                if blur_shirt_bool:
-                    shirt_lms = results.pose_landmarks.landmark
-                    shirt_points = [11,12,24,23]
-                    frame = find_and_blur_pts(frame, shirt_lms, shirt_points, [f_w, f_h], 20)
-
-                # If the faces should be blurred, do this
-                if blur_face_bool:
-                    face_lms = results.face_landmarks.landmark
-
-                    face_pts = range(468)
-                    frame = find_and_blur_pts(frame, face_lms, face_pts, [f_w, f_h], 10)
-
-                # Save the file and print an update regularly to show progress
-                out.write(frame)
-                if good_frame % 1000 == 0:
-                    print(f'Finished frame {good_frame}')
-                good_frame += 1
-            except Exception as e:
-                # At end of file, break the loop
-                bad_frame += 1
-                if bad_frame > 1000:
-                    break
-                pass
-
-        # Close the original file and the new file
-        out.release()
-        cap.release()
+        if not cap.isOpened():
+            raise IOError(f'Could not open {file} to blur it')
+        frame_shape = [int(cap.get(3)), int(cap.get(4))]
+        fps = cap.get(cv2.CAP_PROP_FPS) or 30
+        n_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        encode_start = time.perf_counter()
+        out = streaming.open_writer(blurred_file, frame_shape[0], frame_shape[1], fps,
+                                    encoder=encoder)
+
+        # The end of the video is when a frame can't be read, no frame is skipped
+        def read_frame():
+            ok, frame = cap.read()
+            return frame if ok else None
+
+        try:
+            written = process_frames(read_frame, lambda frame: streaming.write_frame(out, frame),
+                                     frame_shape, blur_shirt_bool, blur_face_bool,
+                                     workers=workers, queue_size=queue_size, detector=detector,
+                                     cache=cache, video_key=video_key, tracks_dir=tracks_dir,
+                                     from_tracks=from_tracks, fps=fps, processes=processes,
+                                     **blur_opts)
+        except Exception:
+            out.kill()
+            raise
+        finally:
+            cap.release()
+
+        # Finishing the encode and closing the file
+        cpu = encoding.children_cpu()
+        streaming.close(out)
+        encoding.report('blur', encoder or encoding.Encoder(), written,
+                        time.perf_counter() - encode_start, encoding.children_cpu() - cpu)
+        if n_frames and written < n_frames:
+            print(f'Only {written} of the {n_frames} frames of {file} could be read, the end of '
+                  'the video may be damaged')
 
         return blurred_file
     else:
         print('Blurred file already exists...continuing...')
         return blurred_file
 
-def cut_vid(file, cut_file, timings_file):
+def read_timings(timings_file):
     """
-    Shorten a video based on a file which gives when a driver starts and stops driving
-    in a video and an estimate of what buffer will need to be cut in order to remove the 
-    first and last mile of a driver's footage. The purpose is to be able to obfuscate where
-    the driver lives.
+    Reads the file with when drivers start and stop driving in each video. Read once for the
+    whole batch rather than once per video.
 
     Inputs:
-    file - String - where the original file is stored
-    cut_file - String - where the shortened file will be stored
     timings_file - String - where to find the file with the start/stop times
-        NOTE: this has a special format with the following columns in this order and only these:
-        [filename, start, stop] where start and stop are formatted as strings as HH:MM:SS
+        NOTE: this has a special format with the video file name in the first column (file or
+        filename) and either start_frame and end_frame columns with frame numbers, or start and
+        stop times formatted as strings as HH:MM:SS in the next two columns
+
+    Returns:
+    A dictionary from video file name to (start, end, unit), where unit is 'frames' or
+    'seconds'.
+    """
+    file_timings_df = pd.read_csv(timings_file)
+    names = file_timings_df[file_timings_df.columns[0]].map(os.path.basename)
+
+    if {'start_frame', 'end_frame'} <= set(file_timings_df.columns):
+        starts = file_timings_df['start_frame'].astype(float)
+        ends = file_timings_df['end_frame'].astype(float)
+        unit = 'frames'
+    else:
+        starts = pd.to_timedelta(file_timings_df[file_timings_df.columns[1]]).dt.total_seconds()
+        ends = pd.to_timedelta(file_timings_df[file_timings_df.columns[2]]).dt.total_seconds()
+        unit = 'seconds'
+
+    return {name: (start, end, unit) for name, start, end in zip(names, starts, ends)}
+
+def get_cut_times(file, timings, fps=None):
+    """
+    Looks up when a driver starts and stops driving in a video and moves those times in by
+    the estimated length of the first and last mile of driving.
+
+    Inputs:
+    file    - String - the video to look up, by its file name
+    timings - dict   - the start/stop times from read_timings
+    fps     - Float  - the frame rate of the video, probed if needed and not given
+
+    Returns:
+    The (start, end) times to keep in seconds, or None if the video isn't in the timings file.
+    """
+    if os.path.basename(file) not in timings:
+        return None
+    (start, end, unit) = timings[os.path.basename(file)]
+
+    # Frame numbers are turned into times at the video's real frame rate
+    if unit == 'frames':
+        if fps is None:
+            fps = streaming.probe_video(file)['fps']
+        (start, end) = (start / fps, end / fps)
+
+    # Move the start later and the end earlier to remove the first and last mile
+    start += FIRST_LAST_MILE
+    end -= FIRST_LAST_MILE
+    if end <= start:
+        raise ValueError(f'{file} is too short to remove the first and last mile '
+                         f'(driving ends {end + 2 * FIRST_LAST_MILE - start:.0f}s after it starts)')
+
+    return start, end
+
+def cut_vid(file, cut_file, cut_times, fast=True, encoder=None):
+    """
+    Shorten a video to remove the first and last mile of driving, to be able to obfuscate
+    where the driver lives. The cut lands on the exact frames, but only the short runs of
+    frames between each cut point and the nearest keyframe inside the cut are re-encoded. The
+    rest of the video between those keyframes is copied as is, so the cut runs at close to
+    the speed of copying the file.
+
+    Inputs:
+    file      - String  - where the original file is stored
+    cut_file  - String  - where the shortened file will be stored
+    cut_times - tuple   - the (start, end) times to keep in seconds, from get_cut_times
+    fast      - Boolean - whether to copy the video between keyframes, otherwise the whole
+                          kept part is re-encoded
+    encoder   - Encoder - the encoder settings, or None for the default libx264 ones. Pieces
+                          joined to copied video are encoded to the source codec, profile and
+                          level, and if they can't be the whole kept part is re-encoded
 
     Returns:
     The location where the shortened video is stored.
     """
-    if not os.path.exists(cut_file):
-        # Read in the file timings
-        file_timings_df = pd.read_csv(timings_file)
+    if os.path.exists(cut_file):
+        print('First/last mile already removed...continuing...')
+        return cut_file
 
-        # If the file being processed is in the file, get the start stop times
-        if file.split('/')[1] in file_timings_df.file.values:
-            print(f'Removing first and last mile of driving from {file}...saving to {cut_file}')
-            (_, start, end) = file_timings_df[file_timings_df['file'] == file.split('/')[1]].values[0]
+    print(f'Removing first and last mile of driving from {file}...saving to {cut_file}')
+    info = streaming.probe_video(file)
+    fps = info['fps']
 
-            # Add 2 minutes 24 seconds to the start and subtracted from the end to remove the first and 
-            # last mile. Assumes average residential speed of 25 mph
-            # NOTE if file is longer than a day long, this will not work....
-            start = dt.strftime(dt.strptime(start, "%H:%M:%S") + td(minutes=2, seconds=24), "%H:%M:%S")
-            end = dt.strftime(dt.strptime(end, "%H:%M:%S") - td(minutes=2, seconds=24), "%H:%M:%S")
+    # Keep the frames from the first one at or after the start up to the last one before the end
+    (start, end) = cut_times
+    first = int(np.ceil(start * fps - 1e-6))
+    last = int(np.ceil(end * fps - 1e-6))
 
-            # Remove the start and stop times from the file
-            # TODO add GPU
-            os.system(f'ffmpeg -y -i {file} -ss {start} -to {end} -filter:v fps=30 {cut_file}')
+    # Find the keyframes nearest the cut points inside the kept part. The pieces re-encoded
+    # at the ends are only joined to the copied middle if they can match its profile and level
+    encoder = encoder or encoding.Encoder()
+    segments = [('encode', first, last)]
+    matched = encoder.matching_stream(info) if fast else None
+    if fast and matched is None and info['codec'] in encoding.ENCODERS:
+        print(f"Can't encode {info['codec']} {info['profile']} video that can be joined to "
+              f"{file}, re-encoding all of it")
+    if matched is not None:
+        times = streaming.probe_keyframes(file, [info['start_time'] + start,
+                                                 info['start_time'] + end])
+        keyframes = np.round((times - info['start_time']) * fps).astype(int)
+        inside = keyframes[(keyframes >= first) & (keyframes <= last)]
+        if len(inside) >= 2:
+            segments = [('encode', first, inside[0]), ('copy', inside[0], inside[-1]),
+                        ('encode', inside[-1], last)]
+            encoder = matched
 
-            return cut_file
-        else:
-            return file
+    # Seek half a frame away from each frame time so rounding can't land on the wrong frame
+    half = 0.5 / fps
+    temp_dir = tempfile.mkdtemp(prefix='cut_', dir=os.path.dirname(cut_file) or '.')
+    try:
+        parts = []
+        durations = []
+        encoded = [0, 0.0, 0.0]
+        for i, (kind, a, b) in enumerate(segments):
+            if b <= a:
+                continue
+            part = os.path.join(temp_dir, f'part{i}.mkv')
+            if kind == 'copy':
+                streaming.copy_segment(file, part, a / fps + half, b - a, info['codec'])
+            else:
+                wall = time.perf_counter()
+                cpu = encoding.children_cpu()
+                streaming.encode_segment(file, part, max(0, a / fps - half), b - a, encoder,
+                                         info['pix_fmt'], fps)
+                encoded[0] += b - a
+                encoded[1] += time.perf_counter() - wall
+                encoded[2] += encoding.children_cpu() - cpu
+            parts.append(part)
+            durations.append((b - a) / fps)
+        encoding.report('cut', encoder, *encoded)
+
+        # The audio is cut on its own at the same times
+        streaming.concat_segments(parts, cut_file, durations, file, first / fps,
+                                  (last - first) / fps)
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+    return cut_file
+
+def stream_vid(file, anon_file, blur_shirt_bool, blur_face_bool, cut_times=None, audio_file=None,
+               workers=1, queue_size=64, detector=None, cache=None, video_key=None,
+               tracks_dir=None, from_tracks=None, encoder=None, processes=False, **blur_opts):
+    """
+    Anonymizes a video in a single pass with no intermediate video files. Raw frames are piped
+    from an ffmpeg decoder, through the blur pipeline, into an ffmpeg encoder which also muxes
+    in the audio and applies the first/last mile trim.
+
+    Inputs:
+    file            - String  - where the original video is saved
+    anon_file       - String  - where to save the anonymized video
+    blur_shirt_bool - Boolean - whether or not to blur the logos on shirts
+    blur_face_bool  - Boolean - whether or not to blur faces
+    cut_times       - tuple   - the (start, end) times to keep, or None to keep everything
+    audio_file      - String  - an already trimmed (e.g. redacted) audio file to use, or None
+                                to take the audio straight from the original video
+    workers         - Integer - the number of threads finding landmarks and blurring frames
+    queue_size      - Integer - the number of frames that can wait between pipeline stages
+    detector        - Object  - an already loaded landmark detector for the first worker
+    cache           - ResultCache - where to save and look up the landmarks, or None
+    video_key       - String  - the cache key of the trimmed video being blurred
+    tracks_dir      - String  - a directory to save every frame's landmarks to, or None
+    from_tracks     - String  - a track directory to blur from instead of running MediaPipe
+    encoder         - Encoder - the encoder settings, or None for the default libx264 ones
+    processes       - Boolean - whether the workers are processes rather than threads
+    blur_opts       - dict    - keyframe and tracking options passed on to make_frame_blurrer
+
+    Returns:
+    The location where the anonymized video is stored.
+    """
+    print(f'Streaming {file} through the anonymization pipeline...saving to {anon_file}')
+    (start, end) = cut_times if cut_times is not None else (None, None)
+    info = streaming.probe_video(file)
+    (f_w, f_h) = (info['width'], info['height'])
+
+    # Without a separate audio file, the encoder trims the original audio the same way as the video
+    encode_start = time.perf_counter()
+    if audio_file is None:
+        writer = streaming.open_writer(anon_file, f_w, f_h, info['fps'], file, start, end,
+                                       encoder=encoder)
     else:
-        print('First/last mile already removed...continuing...')
-        return cut_file
\ No newline at end of file
+        writer = streaming.open_writer(anon_file, f_w, f_h, info['fps'], audio_file,
+                                       encoder=encoder)
+    reader = streaming.open_reader(file, start, end)
+
+    read = lambda: streaming.read_frame(reader, f_w, f_h)
+    write = lambda frame: streaming.write_frame(writer, frame)
+    try:
+        if blur_face_bool or blur_shirt_bool:
+            written = process_frames(read, write, [f_w, f_h], blur_shirt_bool, blur_face_bool,
+                                     workers=workers, queue_size=queue_size, detector=detector,
+                                     cache=cache, video_key=video_key, tracks_dir=tracks_dir,
+                                     from_tracks=from_tracks, fps=info['fps'],
+                                     processes=processes, **blur_opts)
+        else:
+            written = run_pipeline(read, write, lambda: (lambda idx, frame: frame),
+                                   queue_size=queue_size)
+    except Exception:
+        reader.kill()
+        writer.kill()
+        raise
+    streaming.close(reader)
+    cpu = encoding.children_cpu()
+    streaming.close(writer)
+    encoding.report('stream', encoder or encoding.Encoder(), written,
+                    time.perf_counter() - encode_start, encoding.children_cpu() - cpu)
+
+    return anon_file
@@ -0,0 +1,198 @@
+import contextlib
+import fcntl
+import os
+import sqlite3
+import time
+
+# The states a job moves through. Queued jobs wait for a worker, running jobs have one, and
+# done or failed jobs aren't run again until their video changes
+STATES = ['queued', 'running', 'done', 'failed']
+
+class JobQueue:
+    """
+    A queue of videos to anonymize kept in a SQLite database, with the state of every job. A
+    video is known by its path, size and modification time, so a video that was anonymized
+    is never processed again unless it is replaced. The database is local to one machine and
+    safe to share between the processes on it.
+    """
+    def __init__(self, db_file):
+        """
+        Inputs:
+        db_file - String - the SQLite database, made if it doesn't exist
+        """
+        if os.path.dirname(db_file):
+            os.makedirs(os.path.dirname(db_file), exist_ok=True)
+        # A service keeps this file locked while it runs, see hold
+        self.lock_file = db_file + '.service'
+        self.lock = None
+        self.db = sqlite3.connect(db_file, timeout=30, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS jobs ('
+                        'file TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, state TEXT, '
+                        'output TEXT, error TEXT, seconds REAL, attempts INTEGER DEFAULT 0, '
+                        'updated REAL)')
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        # Taking the write lock first keeps two processes from adding or claiming the same job
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException:
+            self.db.execute('ROLLBACK')
+            raise
+        self.db.execute('COMMIT')
+
+    def add(self, file, retry_failed=False):
+        """
+        Queues a video unless it was already anonymized. A video that changed since its last
+        job is queued again.
+
+        Inputs:
+        file         - String  - the video to anonymize
+        retry_failed - Boolean - whether a video whose job failed is queued again
+
+        Returns:
+        True if the video is waiting to be anonymized, False if it is done, failed or running.
+        """
+        file = os.path.abspath(file)
+        stat = os.stat(file)
+        with self._transaction():
+            row = self.db.execute('SELECT size, mtime, state FROM jobs WHERE file = ?',
+                                  (file,)).fetchone()
+            if row is None:
+                self.db.execute('INSERT INTO jobs (file, size, mtime, state, updated) '
+                                'VALUES (?, ?, ?, ?, ?)',
+                                (file, stat.st_size, stat.st_mtime_ns, 'queued', time.time()))
+                return True
+            (size, mtime, state) = row
+            if (size, mtime) != (stat.st_size, stat.st_mtime_ns):
+                self.db.execute('UPDATE jobs SET size = ?, mtime = ?, state = ?, output = NULL, '
+                                'error = NULL, attempts = 0, updated = ? WHERE file = ?',
+                                (stat.st_size, stat.st_mtime_ns, 'queued', time.time(), file))
+                return True
+            if state == 'failed' and retry_failed:
+                self.db.execute("UPDATE jobs SET state = 'queued', error = NULL, attempts = 0, "
+                                "updated = ? WHERE file = ?", (time.time(), file))
+                return True
+
+        return state == 'queued'
+
+    def state(self, file):
+        """
+        Returns the state of a video's job, or None if it has no job for its current content.
+        Only its size and modification time are read.
+        """
+        stat = os.stat(file)
+        row = self.db.execute('SELECT size, mtime, state FROM jobs WHERE file = ?',
+                              (os.path.abspath(file),)).fetchone()
+        if row is None or (row[0], row[1]) != (stat.st_size, stat.st_mtime_ns):
+            return None
+        return row[2]
+
+    def claim(self):
+        """
+        Takes the oldest queued job and marks it as running.
+
+        Returns:
+        The path of the video, or None if nothing is queued.
+        """
+        with self._transaction():
+            row = self.db.execute("SELECT file FROM jobs WHERE state = 'queued' "
+                                  "ORDER BY updated LIMIT 1").fetchone()
+            if row is None:
+                return None
+            self.db.execute("UPDATE jobs SET state = 'running', attempts = attempts + 1, "
+                            "updated = ? WHERE file = ?", (time.time(), row[0]))
+
+        return row[0]
+
+    def finish(self, file, result):
+        """
+        Records how a job went.
+
+        Inputs:
+        file   - String - the video the job anonymized
+        result - dict   - the result of app.anonymize_file
+
+        Returns:
+        None
+        """
+        state = 'done' if result['status'] == 'ok' else 'failed'
+        self.db.execute('UPDATE jobs SET state = ?, output = ?, error = ?, seconds = ?, '
+                        'updated = ? WHERE file = ?',
+                        (state, result['output'], result['error'], result.get('seconds'),
+                         time.time(), os.path.abspath(file)))
+
+    def retry(self, file, max_attempts):
+        """
+        Queues a running job again, unless it was already tried too many times.
+
+        Inputs:
+        file         - String  - the video of the job
+        max_attempts - Integer - the most times a job is run
+
+        Returns:
+        True if the job was queued again.
+        """
+        return self.db.execute("UPDATE jobs SET state = 'queued', updated = ? "
+                               "WHERE file = ? AND state = 'running' AND attempts < ?",
+                               (time.time(), os.path.abspath(file), max_attempts)).rowcount > 0
+
+    def requeue_running(self):
+        """
+        Queues the jobs left running when the last service stopped, e.g. on a crash.
+
+        Returns:
+        The number of jobs queued again.
+        """
+        return self.db.execute("UPDATE jobs SET state = 'queued', updated = ? "
+                               "WHERE state = 'running'", (time.time(),)).rowcount
+
+    def hold(self):
+        """
+        Marks the database as in use by a service until the queue is closed, so other runs
+        know the jobs left running are still being run. The lock goes with the process, so a
+        service that crashed doesn't hold it.
+
+        Returns:
+        True if it was taken, False if another service holds it.
+        """
+        self.lock = open(self.lock_file, 'w')
+        try:
+            fcntl.flock(self.lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self.lock.close()
+            self.lock = None
+            return False
+
+        return True
+
+    def held(self):
+        """
+        Returns whether a service is using the database.
+        """
+        if self.lock is not None:
+            return True
+        with open(self.lock_file, 'a') as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_SH | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return True
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+        return False
+
+    def counts(self):
+        """
+        Returns the number of jobs in each state.
+        """
+        counts = dict.fromkeys(STATES, 0)
+        counts.update(self.db.execute('SELECT state, COUNT(*) FROM jobs GROUP BY state'))
+        return counts
+
+    def close(self):
+        self.db.close()
+        if self.lock is not None:
+            self.lock.close()
+            self.lock = None
@@ -0,0 +1,37 @@
+import importlib
+import threading
+
+_lock = threading.Lock()
+
+class LazyModule:
+    """
+    Stands in for a module until one of its attributes is used, then imports it. Safe to first
+    use from several pipeline threads at once.
+    """
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            with _lock:
+                if self._module is None:
+                    self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+    def __repr__(self):
+        state = 'loaded' if self._module is not None else 'not loaded yet'
+        return f'<lazy module {self._name!r} ({state})>'
+
+def lazy_import(name):
+    """
+    Imports a module the first time one of its attributes is used rather than straight away,
+    so heavy dependencies are only loaded by the stages that need them.
+
+    Inputs:
+    name - String - the module to import, e.g. 'cv2'
+
+    Returns:
+    The module, loaded on first use.
+    """
+    return LazyModule(name)
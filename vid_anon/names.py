@@ -0,0 +1,103 @@
+import csv
+import numpy as np
+from .lazy import lazy_import
+
+# Only loaded once a transcript is tagged
+nltk = lazy_import('nltk')
+
+# Gaps (seconds) between vosk words long enough to start a new sentence for the tagger
+SENTENCE_GAP = 1.0
+
+def load_names(name_lists):
+    """
+    Reads name lists (e.g. first and last names, or the participants of a study) into a set
+    for constant time lookup. Each line can hold one name or several comma separated ones, and
+    names with several words are split up, since vosk gives one word at a time.
+
+    Inputs:
+    name_lists - list - the text or CSV files of names
+
+    Returns:
+    A set of the lower case names.
+    """
+    names = set()
+    for name_list in name_lists or []:
+        with open(name_list, newline='') as f:
+            for row in csv.reader(f):
+                for field in row:
+                    names.update(part.lower() for part in field.split())
+
+    return names
+
+def split_sentences(words, gap=SENTENCE_GAP):
+    """
+    Splits vosk words into sentences at the pauses between them.
+
+    Inputs:
+    words - dict  - the word, start and end columns from audio_processing.words_to_columns
+    gap   - Float - the pause (seconds) that starts a new sentence
+
+    Returns:
+    A list of sentences, each a list of words.
+    """
+    if len(words['word']) == 0:
+        return []
+    breaks = np.flatnonzero(words['start'][1:] - words['end'][:-1] > gap) + 1
+
+    return [sentence.tolist() for sentence in np.split(words['word'], breaks)]
+
+class NameTagger:
+    """
+    Finds the names in transcripts. A part of speech tagger marks the proper nouns, and words
+    in the name lists are always names. The tagger is loaded once and kept, and every
+    transcript of a file is tagged in one batch.
+    """
+    def __init__(self, name_lists=(), tagger=None):
+        """
+        Inputs:
+        name_lists - list   - text or CSV files of names that are always redacted
+        tagger     - Object - an already loaded nltk tagger, the perceptron tagger is loaded
+                              the first time it's needed if not given
+        """
+        self.names = load_names(name_lists)
+        self._tagger = tagger
+
+    @property
+    def tagger(self):
+        if self._tagger is None:
+            self._tagger = nltk.tag.perceptron.PerceptronTagger()
+        return self._tagger
+
+    def proper_nouns(self, sentences):
+        """
+        Tags every sentence in one batch and collects the proper nouns.
+
+        Inputs:
+        sentences - list - the sentences, each a string or a list of words
+
+        Returns:
+        A set of the lower case proper nouns.
+        """
+        sentences = [s.split() if isinstance(s, str) else list(s) for s in sentences]
+        sentences = [s for s in sentences if s]
+        if not sentences:
+            return set()
+
+        return {word.lower() for tagged in self.tagger.tag_sents(sentences)
+                for word, pos in tagged if pos in ('NNP', 'NNPS')}
+
+    def match(self, words, proper_nouns=()):
+        """
+        Finds which words are names.
+
+        Inputs:
+        words        - numpy array - the words, e.g. the vosk transcript
+        proper_nouns - set         - lower case proper nouns found by proper_nouns
+
+        Returns:
+        A boolean array marking the names.
+        """
+        names = self.names | set(proper_nouns)
+
+        return np.fromiter((word.lower() in names for word in words), dtype=bool,
+                           count=len(words))
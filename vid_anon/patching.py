@@ -0,0 +1,331 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+import numpy as np
+from . import audio_processing
+from . import encoding
+from . import profiling
+from . import streaming
+from .frame_processing import get_chunk_size, make_frame_blurrer
+from .pipeline import run_pipeline
+from .utils import blur_region
+
+# How many blocks the forced blur boxes are pixelated with, the same as faces
+BOX_BLOCKS = 10
+
+def parse_time(value):
+    """
+    Turns a time from a patch file into seconds.
+
+    Inputs:
+    value - String or Float - seconds, or a time formatted as HH:MM:SS or MM:SS (the seconds
+                              can have a fraction)
+
+    Returns:
+    The time in seconds.
+    """
+    if isinstance(value, (int, float)):
+        return float(value)
+
+    seconds = 0.0
+    for part in str(value).split(':'):
+        seconds = seconds * 60 + float(part)
+
+    return seconds
+
+def read_patches(patch_file):
+    """
+    Reads the time ranges to re-process in each video. The file is JSON with the video file
+    name (as in the input directory) as the key and a list of ranges as the value:
+
+        {"drive.mp4": [{"start": "12:00", "end": "12:30", "blur": [[100, 80, 60, 60]],
+                        "redact": ["Alice"]}]}
+
+    The times are on the timeline of the anonymized video. Each range can list boxes
+    ([x, y, width, height] in pixels) that are blurred on every frame of the range whatever
+    the detector finds, and words that are redacted from the audio of the range.
+
+    Inputs:
+    patch_file - String - where to find the patch file
+
+    Returns:
+    A dictionary from video file name to a list of ranges, each a dictionary with the start
+    and end (seconds), the blur boxes as (4, 2) corner points and the set of lower case words
+    to redact.
+    """
+    with open(patch_file) as f:
+        entries = json.load(f)
+
+    patches = {}
+    for name, ranges in entries.items():
+        patches[os.path.basename(name)] = []
+        for entry in ranges:
+            (start, end) = (parse_time(entry['start']), parse_time(entry['end']))
+            if end <= start:
+                raise ValueError(f'{name}: the range {entry["start"]} to {entry["end"]} is empty')
+
+            boxes = []
+            for box in entry.get('blur', []):
+                if len(box) != 4:
+                    raise ValueError(f'{name}: blur boxes are [x, y, width, height], got {box}')
+                (x, y, w, h) = box
+                boxes.append(np.array([[x, y], [x + w, y], [x + w, y + h], [x, y + h]],
+                                      dtype=np.int32))
+
+            # Names with several words are split up, since vosk gives one word at a time
+            words = {part.lower() for word in entry.get('redact', []) for part in word.split()}
+            patches[os.path.basename(name)].append({'start': start, 'end': end, 'blur': boxes,
+                                                    'redact': words})
+
+    return patches
+
+def plan_segments(ranges, keyframes, n_frames):
+    """
+    Works out which runs of frames are re-encoded and which are copied as is. Each range is
+    widened out to the keyframes around it, so the re-encoded runs can be joined to the copied
+    ones, and ranges that share a group of pictures are re-encoded together.
+
+    Inputs:
+    ranges    - list        - the ranges, with the first and last (exclusive) frame of each
+    keyframes - numpy array - the sorted keyframe indexes of the video
+    n_frames  - Integer     - the number of frames in the video
+
+    Returns:
+    A list of (kind, first frame, end frame, ranges) segments covering the whole video, where
+    kind is 'encode' or 'copy'.
+    """
+    spans = []
+    for r in sorted(ranges, key=lambda r: r['first']):
+        before = keyframes[keyframes <= r['first']]
+        after = keyframes[keyframes >= r['last']]
+        a = int(before[-1]) if len(before) else 0
+        b = int(after[0]) if len(after) else n_frames
+        if spans and a <= spans[-1][1]:
+            spans[-1][1] = max(spans[-1][1], b)
+            spans[-1][2].append(r)
+        else:
+            spans.append([a, b, [r]])
+
+    segments = []
+    pos = 0
+    for a, b, rs in spans:
+        if a > pos:
+            segments.append(('copy', pos, a, []))
+        segments.append(('encode', a, b, rs))
+        pos = b
+    if pos < n_frames:
+        segments.append(('copy', pos, n_frames, []))
+
+    return segments
+
+def make_patch_worker(first, ranges, blur_shirt_bool, blur_face_bool, detector=None,
+                      **blur_opts):
+    """
+    Builds a function that re-processes a frame of the anonymized video. Inside a range the
+    detector runs again (when faces or logos are blurred) and the range's boxes are blurred.
+    When the detector finds nothing the frame is kept as it was anonymized before.
+
+    Inputs:
+    first           - Integer - the index in the video of the first frame the worker is given
+    ranges          - list    - the ranges in this run of frames
+    blur_shirt_bool - Boolean - whether or not to blur the logos on shirts
+    blur_face_bool  - Boolean - whether or not to blur faces
+    detector        - Object  - an already loaded landmark detector, loaded here if not given
+    blur_opts       - dict    - keyframe and tracking options passed on to make_frame_blurrer
+
+    Returns:
+    A function taking (frame index, frame) that returns the re-processed frame.
+    """
+    blurrer = None
+    if blur_shirt_bool or blur_face_bool:
+        blurrer = make_frame_blurrer(blur_shirt_bool, blur_face_bool, detector,
+                                     **dict(blur_opts, missed='pass'))
+
+    def patch_frame(idx, frame):
+        idx += first
+        inside = [r for r in ranges if r['first'] <= idx < r['last']]
+        if not inside:
+            return frame
+
+        if blurrer is not None:
+            frame = blurrer(idx, frame)
+
+        start = time.perf_counter()
+        for r in inside:
+            for box in r['blur']:
+                frame = blur_region(frame, box, BOX_BLOCKS)
+        profiling.record_frame('blur', time.perf_counter() - start)
+
+        return frame
+
+    return patch_frame
+
+def patch_audio(file, audio_file, redacted_file, ranges, model=None, model_path=None,
+                redact_mode='mute', fade_ms=0):
+    """
+    Redacts the extra words of each range from the audio of a video. Only the ranges are run
+    through vosk.
+
+    Inputs:
+    file          - String     - the video to take the audio from
+    audio_file    - String     - where to save the extracted audio
+    redacted_file - String     - where to save the redacted audio
+    ranges        - list       - the ranges, with the words to redact from each
+    model         - vosk Model - an already loaded vosk model, loaded from model_path if not given
+    model_path    - String     - where the vosk model is unzipped, defaults to VOSK_MODEL_PATH
+    redact_mode   - String     - 'mute' to silence the redacted words or 'bleep' to bleep over them
+    fade_ms       - Integer    - how long (ms) to fade in and out around each redacted word
+
+    Returns:
+    The redacted audio file, or None if there was nothing to redact.
+    """
+    ranges = [r for r in ranges if r['redact']]
+    if not ranges:
+        return None
+
+    audio_processing.get_audio(file, audio_file)
+    samples, rate = audio_processing.open_pcm(audio_file)
+    n_samples = len(samples)
+    del samples
+
+    intervals = []
+    for r in ranges:
+        (start, end) = (int(r['start'] * rate), min(n_samples, int(np.ceil(r['end'] * rate))))
+        words = audio_processing.recognize_range(audio_file, start, end, model_path, model)
+        intervals += [(w['start'], w['end']) for w in words if w['word'].lower() in r['redact']]
+    print(f'Found {len(intervals)} of the words to redact')
+    if not intervals:
+        return None
+
+    return audio_processing.redact_intervals(audio_file, redacted_file, intervals, redact_mode,
+                                             fade_ms)
+
+def patch_vid(file, patched_file, ranges, blur_shirt_bool, blur_face_bool, workers=1,
+              queue_size=64, detector=None, encoder=None, model=None, model_path=None,
+              redact_mode='mute', fade_ms=0, **blur_opts):
+    """
+    Re-processes only some time ranges of an already anonymized video, e.g. to fix a face
+    a reviewer found was missed. Each range is widened out to the keyframes around it and only
+    those groups of pictures are decoded, re-processed and re-encoded; the rest of the video
+    is copied as is and the pieces are joined back together. The audio is copied too, unless
+    extra words are redacted from it.
+
+    Inputs:
+    file            - String     - the anonymized video
+    patched_file    - String     - where to save the patched video, can be the same as file
+    ranges          - list       - the ranges to re-process, from read_patches
+    blur_shirt_bool - Boolean    - whether or not to find and blur the logos on shirts again
+    blur_face_bool  - Boolean    - whether or not to find and blur faces again
+    workers         - Integer    - the number of threads finding landmarks and blurring frames
+    queue_size      - Integer    - the number of frames that can wait between pipeline stages
+    detector        - Object     - an already loaded landmark detector for the first worker
+    encoder         - Encoder    - the encoder settings, or None for the default libx264 ones.
+                                   The re-encoded pieces are encoded to the video's codec
+    model           - vosk Model - an already loaded vosk model for redacting extra words
+    model_path      - String     - where the vosk model is unzipped, defaults to VOSK_MODEL_PATH
+    redact_mode     - String     - 'mute' to silence the redacted words or 'bleep' to bleep them
+    fade_ms         - Integer    - how long (ms) to fade in and out around each redacted word
+    blur_opts       - dict       - keyframe and tracking options passed on to make_frame_blurrer
+
+    Returns:
+    The location where the patched video is stored.
+    """
+    print(f'Re-processing {len(ranges)} ranges of {file}...saving to {patched_file}')
+    info = streaming.probe_video(file)
+    (fps, f_w, f_h) = (info['fps'], info['width'], info['height'])
+    n_frames = info['frames']
+
+    # The frames from the first one at or after each start up to the last one before its end
+    ranges = [dict(r, first=int(np.ceil(r['start'] * fps - 1e-6)),
+                   last=min(n_frames, int(np.ceil(r['end'] * fps - 1e-6)))) for r in ranges]
+    ranges = [r for r in ranges if r['last'] > r['first']]
+    if not ranges:
+        print('No frames to re-process...continuing...')
+        return file
+
+    # The re-encoded pieces must match the copied ones to be joined, if they can't the whole
+    # video is re-encoded. Only the packet headers near the ranges are read to find the keyframes
+    encoder = encoder or encoding.Encoder()
+    matched = encoder.matching_stream(info)
+    if matched is None:
+        print(f"Can't encode {info['codec']} {info['profile']} video that can be joined to {file}, "
+              're-encoding all of it')
+        encoder = encoder.matching(info['codec'])
+        keyframes = np.array([0])
+    else:
+        encoder = matched
+        times = streaming.probe_keyframes(file, [info['start_time'] + r[k] for r in ranges
+                                                 for k in ('start', 'end')])
+        keyframes = np.round((times - info['start_time']) * fps).astype(int)
+    segments = plan_segments(ranges, keyframes, n_frames)
+
+    # Seek half a frame away from each frame time so rounding can't land on the wrong frame
+    half = 0.5 / fps
+    temp_dir = tempfile.mkdtemp(prefix='patch_', dir=os.path.dirname(patched_file) or '.')
+    try:
+        parts = []
+        durations = []
+        encoded = [0, 0.0, 0.0]
+        for i, (kind, a, b, rs) in enumerate(segments):
+            part = os.path.join(temp_dir, f'part{i}.mkv')
+            if kind == 'copy':
+                streaming.copy_segment(file, part, a / fps + half, b - a, info['codec'])
+            else:
+                print(f'Re-encoding frames {a} to {b}...')
+                wall = time.perf_counter()
+                cpu = encoding.children_cpu()
+                reader = streaming.open_reader(file, max(0, a / fps - half), b / fps + half,
+                                               passthrough=True)
+                writer = streaming.open_writer(part, f_w, f_h, fps, encoder=encoder,
+                                               pix_fmt=info['pix_fmt'], inband=True)
+
+                # The decoder can give a frame more than asked for, only b - a are taken
+                count = [0]
+
+                def read(reader=reader, n=b - a):
+                    if count[0] >= n:
+                        return None
+                    count[0] += 1
+                    return streaming.read_frame(reader, f_w, f_h)
+
+                # The first worker reuses the model passed in, the others load their own
+                preloaded = [detector] if detector is not None else []
+                make_worker = lambda: make_patch_worker(
+                    a, rs, blur_shirt_bool, blur_face_bool,
+                    preloaded.pop() if preloaded else None, **blur_opts)
+                try:
+                    written = run_pipeline(read, lambda frame: streaming.write_frame(writer, frame),
+                                           make_worker, workers=workers, queue_size=queue_size,
+                                           chunk_size=get_chunk_size(blur_opts))
+                except Exception:
+                    writer.kill()
+                    raise
+                finally:
+                    reader.kill()
+                    reader.wait()
+                streaming.close(writer)
+                if written != b - a:
+                    raise RuntimeError(f'Expected {b - a} frames from {file} at frame {a}, '
+                                       f'got {written}')
+                encoded[0] += written
+                encoded[1] += time.perf_counter() - wall
+                encoded[2] += encoding.children_cpu() - cpu
+            parts.append(part)
+            durations.append((b - a) / fps)
+        encoding.report('patch', encoder, *encoded)
+        profiling.record_media(encoded[0], fps)
+
+        # The audio is copied unless words are redacted from it
+        redacted = patch_audio(file, os.path.join(temp_dir, 'audio.wav'),
+                               os.path.join(temp_dir, 'redacted.wav'), ranges, model, model_path,
+                               redact_mode, fade_ms)
+        joined = os.path.join(temp_dir, 'patched.mp4')
+        streaming.concat_segments(parts, joined, durations, redacted or file,
+                                  audio_codec='aac' if redacted else 'copy')
+        os.replace(joined, patched_file)
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+    return patched_file
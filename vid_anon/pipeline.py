@@ -0,0 +1,391 @@
+import multiprocessing
+import queue
+import threading
+import time
+import traceback
+import numpy as np
+from multiprocessing import shared_memory
+from . import profiling
+
+def _put(q, item, stop):
+    """
+    Puts an item on a bounded queue without blocking forever if the pipeline is stopping.
+
+    Inputs:
+    q    - Queue - the queue to add the item to
+    item - any   - the item to add
+    stop - Event - set when the pipeline is shutting down
+
+    Returns:
+    True if the item was added, False if the pipeline stopped first.
+    """
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+def _get(q, stop):
+    """
+    Gets an item from a queue without blocking forever if the pipeline is stopping.
+
+    Inputs:
+    q    - Queue - the queue to take the item from
+    stop - Event - set when the pipeline is shutting down
+
+    Returns:
+    The next item, or None if the pipeline stopped first.
+    """
+    while not stop.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            pass
+    return None
+
+def run_pipeline(read_frame, write_frame, make_worker, workers=1, queue_size=64, chunk_size=1):
+    """
+    Runs frames through a staged decode -> process -> encode pipeline. One thread decodes,
+    a pool of worker threads processes the frames, and one thread writes them back out in
+    their original order. Bounded queues between the stages keep memory use flat. Frames are
+    handed to the workers in chunks of consecutive frames so models that track between
+    frames see an unbroken run.
+
+    Inputs:
+    read_frame  - function - takes no arguments, returns the next frame or None at the end
+    write_frame - function - takes a processed frame and writes it out
+    make_worker - function - called once inside each worker thread so each worker gets its
+                             own model; returns a function taking (index, frame) and returning
+                             the processed frame, or None if the frame should be dropped
+    workers     - Integer  - the number of processing threads
+    queue_size  - Integer  - the number of frames that can wait between stages
+    chunk_size  - Integer  - the number of consecutive frames given to a worker at a time
+
+    Returns:
+    The number of frames written.
+    """
+    workers = max(1, workers)
+    chunk_size = max(1, chunk_size)
+    queue_size = max(1, queue_size // chunk_size)
+    in_q = queue.Queue(maxsize=queue_size)
+    out_q = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    errors = []
+
+    # Limits the number of chunks anywhere in the pipeline so a slow chunk can't make the
+    # reordering buffer in the encoder grow without bound
+    in_flight = threading.Semaphore(2 * queue_size + workers)
+    written = [0]
+
+    def fail(e):
+        errors.append(e)
+        stop.set()
+
+    def decode():
+        try:
+            idx = 0
+            chunk = 0
+            done = False
+            while not stop.is_set() and not done:
+                while not in_flight.acquire(timeout=0.1):
+                    if stop.is_set():
+                        return
+                frames = []
+                while len(frames) < chunk_size:
+                    start = time.perf_counter()
+                    frame = read_frame()
+                    profiling.record_frame('decode', time.perf_counter() - start)
+                    if frame is None:
+                        done = True
+                        break
+                    frames.append(frame)
+                if not frames:
+                    in_flight.release()
+                    break
+                if not _put(in_q, (chunk, idx, frames), stop):
+                    return
+                idx += len(frames)
+                chunk += 1
+        except Exception as e:
+            fail(e)
+        finally:
+            # Tell every worker there is nothing left to process
+            for _ in range(workers):
+                _put(in_q, None, stop)
+
+    def process():
+        try:
+            worker = make_worker()
+            while True:
+                item = _get(in_q, stop)
+                if item is None:
+                    break
+                chunk, idx, frames = item
+                frames = [worker(idx + i, frame) for i, frame in enumerate(frames)]
+                if not _put(out_q, (chunk, frames), stop):
+                    break
+        except Exception as e:
+            fail(e)
+        finally:
+            _put(out_q, None, stop)
+
+    def encode():
+        try:
+            pending = {}
+            next_chunk = 0
+            finished = 0
+            while finished < workers:
+                item = _get(out_q, stop)
+                if item is None:
+                    if stop.is_set():
+                        return
+                    finished += 1
+                    continue
+                chunk, frames = item
+                pending[chunk] = frames
+
+                # Write every chunk that is next in line, dropped frames are skipped
+                while next_chunk in pending:
+                    for frame in pending.pop(next_chunk):
+                        if frame is not None:
+                            start = time.perf_counter()
+                            write_frame(frame)
+                            profiling.record_frame('encode', time.perf_counter() - start)
+                            if written[0] % 1000 == 0:
+                                print(f'Finished frame {written[0]}')
+                            written[0] += 1
+                    next_chunk += 1
+                    in_flight.release()
+        except Exception as e:
+            fail(e)
+
+    threads = [threading.Thread(target=profiling.cprofiled(decode), daemon=True)]
+    threads += [threading.Thread(target=profiling.cprofiled(process), daemon=True)
+                for _ in range(workers)]
+    threads += [threading.Thread(target=profiling.cprofiled(encode), daemon=True)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    if errors:
+        raise errors[0]
+
+    return written[0]
+
+class FrameRing:
+    """
+    A fixed number of frame slots in shared memory. Processes hand frames to each other by
+    slot index, so frames are never copied between processes or pickled.
+    """
+    def __init__(self, slots, shape, name=None):
+        """
+        Inputs:
+        slots - Integer - the number of frames the ring holds
+        shape - tuple   - the (height, width, channels) of every frame
+        name  - String  - the name of an existing ring to attach to, or None to make a new one
+        """
+        self.shape = tuple(shape)
+        self.frame_bytes = int(np.prod(self.shape))
+        self.owner = name is None
+        if self.owner:
+            self.shm = shared_memory.SharedMemory(create=True, size=slots * self.frame_bytes)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.name = self.shm.name
+
+    def frame(self, slot):
+        """
+        Returns a slot as a writable BGR frame backed by the shared memory.
+        """
+        return np.ndarray(self.shape, dtype=np.uint8, buffer=self.shm.buf,
+                          offset=slot * self.frame_bytes)
+
+    def close(self):
+        """
+        Detaches from the ring, and frees it if this process made it.
+        """
+        try:
+            self.shm.close()
+        except BufferError:
+            # A frame view is still alive somewhere, the memory is freed when it goes
+            pass
+        if self.owner:
+            self.shm.unlink()
+
+def _process_worker(ring_name, shape, slots, chunk_size, make_worker, profile, tasks, results):
+    """
+    Runs in each worker process of run_process_pipeline, processing chunks of frames in place
+    in their ring slots.
+    """
+    ring = FrameRing(slots, shape, name=ring_name)
+    profiler = profiling.start() if profile else None
+    sent = []
+    try:
+        worker = make_worker(lambda idx, value: sent.append((idx, value)))
+        while True:
+            item = tasks.get()
+            if item is None:
+                break
+            chunk, idx, group, n = item
+            kept = []
+            for i in range(n):
+                frame = ring.frame(group * chunk_size + i)
+                out = worker(idx + i, frame)
+                if out is not None and out is not frame:
+                    frame[:] = out
+                kept.append(out is not None)
+
+            # Only the slot, which frames to keep and anything small the worker sent go back
+            timings = {}
+            if profiler is not None:
+                (timings, profiler.frames) = (profiler.frames, {})
+            results.put((chunk, group, kept, sent[:], timings))
+            sent.clear()
+    except Exception:
+        results.put((None, traceback.format_exc(), None, None, None))
+    finally:
+        results.put(None)
+        ring.close()
+
+def run_process_pipeline(read_frame, write_frame, make_worker, frame_shape, workers=1,
+                         queue_size=64, chunk_size=1, on_result=None):
+    """
+    Runs frames through the same decode -> process -> encode pipeline as run_pipeline, but
+    processes them in worker processes so the models and blurring aren't held back by the GIL.
+    Decoded frames go into a fixed ring of frame slots in shared memory and only slot indexes
+    are passed between processes. The decoder waits for a free slot, so memory use is bounded
+    by the ring, and the encoder writes frames straight from their slots in their original
+    order before freeing them.
+
+    Inputs:
+    read_frame  - function - takes no arguments, returns the next frame or None at the end
+    write_frame - function - takes a processed frame and writes it out
+    make_worker - function - picklable, called once in each worker process with a function
+                             send(index, value) the worker can use to pass small results back;
+                             returns a function taking (index, frame) that processes the frame
+                             (in place or not) and returns it, or None if it should be dropped
+    frame_shape - list     - frame width, frame height
+    workers     - Integer  - the number of worker processes
+    queue_size  - Integer  - the number of frames the ring holds
+    chunk_size  - Integer  - the number of consecutive frames given to a worker at a time
+    on_result   - function - called in this process with (index, value) for everything the
+                             workers sent, in frame order
+
+    Returns:
+    The number of frames written.
+    """
+    workers = max(1, workers)
+    chunk_size = max(1, chunk_size)
+    groups = max(workers + 1, queue_size // chunk_size)
+    (f_w, f_h) = frame_shape
+    ring = FrameRing(groups * chunk_size, (f_h, f_w, 3))
+
+    # Spawned rather than forked, since forking a process that is running model threads can
+    # deadlock
+    ctx = multiprocessing.get_context('spawn')
+    tasks = ctx.Queue()
+    results = ctx.Queue()
+    free = queue.Queue()
+    for group in range(groups):
+        free.put(group)
+    stop = threading.Event()
+    errors = []
+    written = 0
+
+    def decode():
+        try:
+            idx = 0
+            chunk = 0
+            done = False
+            while not done:
+                # Waiting for a free group of slots is what holds the decoder back
+                group = _get(free, stop)
+                if group is None:
+                    return
+                n = 0
+                while n < chunk_size:
+                    start = time.perf_counter()
+                    frame = read_frame()
+                    profiling.record_frame('decode', time.perf_counter() - start)
+                    if frame is None:
+                        done = True
+                        break
+                    ring.frame(group * chunk_size + n)[:] = frame
+                    n += 1
+                if n == 0:
+                    break
+                tasks.put((chunk, idx, group, n))
+                idx += n
+                chunk += 1
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            # Tell every worker there is nothing left to process
+            for _ in range(workers):
+                tasks.put(None)
+
+    procs = [ctx.Process(target=_process_worker, daemon=True,
+                         args=(ring.name, ring.shape, groups * chunk_size, chunk_size, make_worker,
+                               profiling.enabled(), tasks, results))
+             for _ in range(workers)]
+    for p in procs:
+        p.start()
+    decoder = threading.Thread(target=profiling.cprofiled(decode), daemon=True)
+    decoder.start()
+
+    try:
+        pending = {}
+        next_chunk = 0
+        finished = 0
+        while finished < workers:
+            try:
+                item = results.get(timeout=0.1)
+            except queue.Empty:
+                if errors:
+                    raise errors[0]
+                dead = [p.exitcode for p in procs if p.exitcode not in (None, 0)]
+                if dead:
+                    raise RuntimeError(f'A frame worker process died with exit code {dead[0]}')
+                continue
+            if item is None:
+                finished += 1
+                continue
+            if item[0] is None:
+                raise RuntimeError(f'A frame worker process failed:\n{item[1]}')
+            pending[item[0]] = item
+
+            # Write every chunk that is next in line, dropped frames are skipped
+            while next_chunk in pending:
+                (_, group, kept, sent, timings) = pending.pop(next_chunk)
+                for kind, times in timings.items():
+                    for seconds in times:
+                        profiling.record_frame(kind, seconds)
+                if on_result is not None:
+                    for idx, value in sent:
+                        on_result(idx, value)
+                for i, keep in enumerate(kept):
+                    if keep:
+                        start = time.perf_counter()
+                        write_frame(ring.frame(group * chunk_size + i))
+                        profiling.record_frame('encode', time.perf_counter() - start)
+                        if written % 1000 == 0:
+                            print(f'Finished frame {written}')
+                        written += 1
+                free.put(group)
+                next_chunk += 1
+        if errors:
+            raise errors[0]
+    finally:
+        stop.set()
+        decoder.join()
+        for p in procs:
+            p.join(timeout=1)
+            if p.is_alive():
+                p.terminate()
+        ring.close()
+
+    return written
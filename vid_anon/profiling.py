@@ -0,0 +1,233 @@
+import contextlib
+import cProfile
+import json
+import pstats
+import resource
+import sys
+import threading
+import time
+import numpy as np
+
+# Edges (ms) of the per-frame timing histograms
+HISTOGRAM_EDGES_MS = [0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, float('inf')]
+
+# The profiler collecting timings in this process, or None when profiling is off
+_active = None
+
+# The cProfile profilers of this process while cProfile is on: the one of the thread that
+# turned it on, then one per pipeline thread started since. None when cProfile is off
+_cprofiles = None
+
+# Before Python 3.12 cProfile only sees the thread that enabled it, so every pipeline thread
+# runs its own. From 3.12 it sees every thread and a second one can't be enabled
+_PER_THREAD = sys.version_info < (3, 12)
+
+class Profiler:
+    """
+    Collects wall and CPU time per pipeline stage, per-frame timings split by kind (decode,
+    inference, blur, encode), encoder throughput, frame counts and peak memory for one file.
+    """
+    def __init__(self):
+        self.stages = {}
+        self.frames = {}
+        self.encoders = {}
+        self.media = {'frames': 0, 'fps': None, 'missed': 0}
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Times a stage. CPU time includes every thread and any ffmpeg processes it waited on.
+        """
+        wall = time.perf_counter()
+        cpu = _cpu_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall
+            cpu = _cpu_time() - cpu
+            with self.lock:
+                stats = self.stages.setdefault(name, {'wall': 0.0, 'cpu': 0.0, 'calls': 0})
+                stats['wall'] += wall
+                stats['cpu'] += cpu
+                stats['calls'] += 1
+
+    def record_frame(self, kind, seconds):
+        """
+        Adds one frame's time for a kind of per-frame work.
+        """
+        self.frames.setdefault(kind, []).append(seconds)
+
+    def record_encoder(self, stage, name, frames, wall, cpu):
+        """
+        Adds the frames a stage encoded (or copied) and how long ffmpeg took.
+        """
+        with self.lock:
+            stats = self.encoders.setdefault(stage, {'encoder': name, 'frames': 0,
+                                                     'wall': 0.0, 'cpu': 0.0})
+            stats['encoder'] = name
+            stats['frames'] += frames
+            stats['wall'] += wall
+            stats['cpu'] += cpu
+
+    def record_media(self, frames, fps, missed=0):
+        """
+        Adds the number of frames of video processed, their frame rate and how many of them
+        the landmarks couldn't be found in.
+        """
+        with self.lock:
+            self.media['frames'] += frames
+            self.media['missed'] += missed
+            self.media['fps'] = fps or self.media['fps']
+
+    def summary(self):
+        """
+        Returns everything collected as a JSON-serializable dictionary.
+        """
+        wall = time.perf_counter() - self.start
+        media_seconds = None
+        if self.media['fps']:
+            media_seconds = self.media['frames'] / self.media['fps']
+
+        return {'wall': wall,
+                'stages': self.stages,
+                'frames': {kind: _frame_stats(times) for kind, times in self.frames.items()},
+                'encoders': {stage: dict(stats, fps=stats['frames'] / stats['wall']
+                                         if stats['wall'] > 0 else None)
+                             for stage, stats in self.encoders.items()},
+                'frames_processed': self.media['frames'],
+                'frames_missed': self.media['missed'],
+                'fps': self.media['frames'] / wall if wall > 0 else None,
+                'real_time_factor': wall / media_seconds if media_seconds else None,
+                'peak_rss_mb': peak_rss_mb()}
+
+def _cpu_time():
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.process_time() + children.ru_utime + children.ru_stime
+
+def _frame_stats(times):
+    ms = np.asarray(times) * 1000
+    counts, _ = np.histogram(ms, bins=HISTOGRAM_EDGES_MS)
+    return {'count': len(ms),
+            'total_s': float(ms.sum() / 1000),
+            'mean_ms': float(ms.mean()),
+            'p50_ms': float(np.percentile(ms, 50)),
+            'p90_ms': float(np.percentile(ms, 90)),
+            'p99_ms': float(np.percentile(ms, 99)),
+            'max_ms': float(ms.max()),
+            'histogram_edges_ms': HISTOGRAM_EDGES_MS[:-1] + ['inf'],
+            'histogram': counts.tolist()}
+
+def peak_rss_mb():
+    """
+    Returns the peak resident memory (MB) of this process and of its largest waited-on child.
+    """
+    # Linux reports KB, macOS reports bytes
+    unit = 1024**2 if sys.platform == 'darwin' else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / unit
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / unit
+    return {'self': own, 'children': children}
+
+def start():
+    """
+    Turns profiling on in this process and returns the new profiler.
+    """
+    global _active
+    _active = Profiler()
+    return _active
+
+def stop():
+    """
+    Turns profiling off in this process and returns the summary of what was collected.
+    """
+    global _active
+    profiler, _active = _active, None
+    return profiler.summary() if profiler is not None else None
+
+def stage(name):
+    """
+    Times a stage with the active profiler, or does nothing when profiling is off.
+    """
+    return _active.stage(name) if _active is not None else contextlib.nullcontext()
+
+def record_frame(kind, seconds):
+    """
+    Adds one frame's time for a kind of per-frame work to the active profiler, if any.
+    """
+    if _active is not None:
+        _active.record_frame(kind, seconds)
+
+def record_encoder(stage, name, frames, wall, cpu):
+    """
+    Adds the frames a stage encoded and how long ffmpeg took to the active profiler, if any.
+    """
+    if _active is not None:
+        _active.record_encoder(stage, name, frames, wall, cpu)
+
+def record_media(frames, fps, missed=0):
+    """
+    Adds the number of frames of video processed, and how many of them the landmarks couldn't
+    be found in, to the active profiler, if any.
+    """
+    if _active is not None:
+        _active.record_media(frames, fps, missed)
+
+def enabled():
+    """
+    Returns whether profiling is on in this process.
+    """
+    return _active is not None
+
+def start_cprofile():
+    """
+    Turns cProfile on in this process, for the calling thread and every pipeline thread started
+    until stop_cprofile. Work in other processes (blur shards, process workers, ASR workers)
+    isn't profiled.
+    """
+    global _cprofiles
+    profiler = cProfile.Profile()
+    _cprofiles = [profiler]
+    profiler.enable()
+
+def cprofiled(target):
+    """
+    Wraps a thread's target so the thread is profiled too while cProfile is on.
+    """
+    profilers = _cprofiles
+    if profilers is None or not _PER_THREAD:
+        return target
+
+    def run(*args, **kwargs):
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            return target(*args, **kwargs)
+        finally:
+            profiler.disable()
+            profilers.append(profiler)
+
+    return run
+
+def stop_cprofile(path):
+    """
+    Turns cProfile off and saves the stats of every thread it profiled merged into one file,
+    which can be opened with python -m pstats.
+    """
+    global _cprofiles
+    profilers, _cprofiles = _cprofiles, None
+    profilers[0].disable()
+    stats = pstats.Stats(profilers[0])
+    for profiler in profilers[1:]:
+        profiler.create_stats()
+        # A thread that never got to run anything has no stats to add
+        if profiler.stats:
+            stats.add(profiler)
+    stats.dump_stats(path)
+
+def save(path, summary):
+    """
+    Writes a profiling summary as JSON.
+    """
+    with open(path, 'w') as f:
+        json.dump(summary, f, indent=2)
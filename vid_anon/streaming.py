@@ -0,0 +1,302 @@
+import json
+import os
+import subprocess
+import numpy as np
+from . import encoding
+
+# Bitstream filters that put a stream's parameter sets in front of each of its keyframes, so
+# pieces joined with concat_segments each carry their own even when they came from different
+# encoders. The concat demuxer already does this for h264 by itself
+INBAND_FILTERS = {'hevc': 'hevc_mp4toannexb'}
+
+def inband_args(codec):
+    """
+    Returns the ffmpeg output options that put the parameter sets of a codec in front of every
+    keyframe, if pieces of it need them to be joined.
+    """
+    return ['-bsf:v', INBAND_FILTERS[codec]] if codec in INBAND_FILTERS else []
+
+def probe_video(file):
+    """
+    Reads the size, frame rate and length of the first video stream with ffprobe.
+
+    Inputs:
+    file - String - the video to probe
+
+    Returns:
+    A dictionary with the width, height, fps, duration (seconds), number of frames, start time
+    (seconds), codec, profile, level and pixel format of the video.
+    """
+    cmd = ['ffprobe', '-v', 'error', '-select_streams', 'v:0',
+           '-show_entries', 'stream=width,height,r_frame_rate,codec_name,profile,level,pix_fmt,'
+                            'nb_frames:format=duration,start_time',
+           '-of', 'json', file]
+    info = json.loads(subprocess.run(cmd, capture_output=True, check=True, text=True).stdout)
+    stream = info['streams'][0]
+    num, den = stream['r_frame_rate'].split('/')
+    fps = float(num) / float(den)
+    duration = float(info.get('format', {}).get('duration', 0.0))
+
+    # Only some containers (e.g. mp4) store the frame count, otherwise it's worked out
+    frames = stream.get('nb_frames')
+    frames = int(frames) if frames not in (None, 'N/A') else int(round(duration * fps))
+
+    return {'width': int(stream['width']),
+            'height': int(stream['height']),
+            'fps': fps,
+            'duration': duration,
+            'frames': frames,
+            'start_time': float(info.get('format', {}).get('start_time', 0.0)),
+            'codec': stream.get('codec_name'),
+            'profile': stream.get('profile'),
+            'level': int(stream['level']) if stream.get('level') not in (None, 'N/A') else None,
+            'pix_fmt': stream.get('pix_fmt')}
+
+def probe_keyframes(file, around=(), window=30):
+    """
+    Finds the keyframes of the first video stream from the packet headers, without decoding
+    anything. Only the parts of the file near the given times are read. Keyframes that open a
+    group of pictures other frames still refer back past (e.g. x265's default open GOPs) are
+    left out, since video copied from them can't be decoded on its own.
+
+    Inputs:
+    file   - String - the video to probe
+    around - list   - times (seconds) to look for keyframes near, or empty for the whole file
+    window - Float  - how many seconds either side of each time to look
+
+    Returns:
+    A sorted array of the keyframe times in seconds.
+    """
+    cmd = ['ffprobe', '-v', 'error', '-select_streams', 'v:0',
+           '-show_entries', 'packet=pts_time,flags', '-of', 'csv=p=0']
+    if around:
+        cmd += ['-read_intervals', ','.join(f'{max(0, t - window)}%{t + window}' for t in around)]
+    cmd += [file]
+    out = subprocess.run(cmd, capture_output=True, check=True, text=True).stdout
+
+    # Packets come in decode order, so a picture after a keyframe but shown before it is a
+    # leading picture that refers to the group of pictures before the keyframe
+    times = set()
+    open_gops = set()
+    key = None
+    for line in out.splitlines():
+        fields = line.split(',')
+        if len(fields) < 2 or fields[0] == 'N/A':
+            continue
+        t = float(fields[0])
+        if 'K' in fields[1]:
+            key = t
+            times.add(t)
+        elif key is not None and t < key:
+            open_gops.add(key)
+
+    return np.array(sorted(times - open_gops))
+
+def encode_segment(file, out_file, start, frames, encoder=None, pix_fmt=None, fps=None):
+    """
+    Re-encodes a run of frames of a video (no audio). The seek is frame-accurate, ffmpeg
+    decodes from the keyframe before start and drops the frames before it.
+
+    Inputs:
+    file     - String  - the video to take the frames from
+    out_file - String  - where the segment is saved
+    start    - Float   - the time (seconds) of the first frame, or a little before it
+    frames   - Integer - how many frames to encode
+    encoder  - Encoder - the encoder to use, writing the same codec as the pieces the segment
+                         will be joined with, or None for the default libx264 settings
+    pix_fmt  - String  - the pixel format to encode to, or None for yuv420p
+    fps      - Float   - the frame rate of the video. Resetting the timestamps leaves the rate
+                         unknown to the encoder, which then can't check it against a level
+
+    Returns:
+    The segment file.
+    """
+    cmd = ['ffmpeg', '-loglevel', 'error', '-nostdin', '-y', '-ss', str(start), '-i', file,
+           '-map', '0:v:0', '-an', '-frames:v', str(frames), '-vf', 'setpts=PTS-STARTPTS']
+    if fps is not None:
+        cmd += ['-r', str(fps)]
+    encoder = encoder or encoding.Encoder()
+    cmd += encoder.args(pix_fmt) + inband_args(encoder.codec) + [out_file]
+    subprocess.run(cmd, check=True)
+
+    return out_file
+
+def copy_segment(file, out_file, start, frames, codec=None):
+    """
+    Copies a run of frames starting on a keyframe out of a video without re-encoding them.
+
+    Inputs:
+    file     - String  - the video to take the frames from
+    out_file - String  - where the segment is saved
+    start    - Float   - a time (seconds) just after the keyframe the run starts on
+    frames   - Integer - how many frames to copy
+    codec    - String  - the codec of the video, to keep its parameter sets with the segment
+
+    Returns:
+    The segment file.
+    """
+    cmd = ['ffmpeg', '-loglevel', 'error', '-nostdin', '-y', '-ss', str(start), '-i', file,
+           '-map', '0:v:0', '-an', '-c', 'copy', '-frames:v', str(frames),
+           '-avoid_negative_ts', 'make_zero'] + inband_args(codec) + [out_file]
+    subprocess.run(cmd, check=True)
+
+    return out_file
+
+def concat_segments(segments, out_file, durations=None, audio_file=None, audio_start=None,
+                    audio_duration=None, audio_codec='aac'):
+    """
+    Joins video segments without re-encoding them and adds the audio.
+
+    Inputs:
+    segments       - list   - the segment files, in order
+    out_file       - String - where the joined video is saved
+    durations      - list   - the length (seconds) of each segment, or None to use the length
+                              the container reports, which can be a frame off
+    audio_file     - String - the file to take the audio from, or None for no audio
+    audio_start    - Float  - where the audio starts (seconds), or None
+    audio_duration - Float  - how long the audio is (seconds), or None
+    audio_codec    - String - the codec the audio is encoded to, or 'copy' to keep it as is
+
+    Returns:
+    The joined video.
+    """
+    list_file = out_file + '.txt'
+    with open(list_file, 'w') as f:
+        for i, segment in enumerate(segments):
+            path = os.path.abspath(segment).replace("'", "'\\''")
+            f.write(f"file '{path}'\n")
+            if durations is not None:
+                f.write(f'duration {durations[i]}\n')
+
+    cmd = ['ffmpeg', '-loglevel', 'error', '-nostdin', '-y',
+           '-f', 'concat', '-safe', '0', '-i', list_file]
+    if audio_file is not None:
+        if audio_start is not None:
+            cmd += ['-ss', str(audio_start)]
+        if audio_duration is not None:
+            cmd += ['-t', str(audio_duration)]
+        cmd += ['-i', audio_file, '-map', '0:v:0', '-map', '1:a:0?', '-c:a', audio_codec]
+    cmd += ['-c:v', 'copy', out_file]
+    try:
+        subprocess.run(cmd, check=True)
+    finally:
+        os.remove(list_file)
+
+    return out_file
+
+def open_reader(file, start=None, end=None, passthrough=False):
+    """
+    Starts an ffmpeg process decoding a video to raw BGR frames on its stdout. The trim is
+    done by ffmpeg while decoding so no cut copy of the video is written.
+
+    Inputs:
+    file        - String  - the video to decode
+    start       - String  - where to start reading (HH:MM:SS or seconds), or None for the start
+    end         - String  - where to stop reading (HH:MM:SS or seconds), or None for the end
+    passthrough - Boolean - whether every frame is given once as it is stored. Otherwise
+                            frames are duplicated or dropped to keep a constant frame rate,
+                            which can repeat the first frame after a seek
+
+    Returns:
+    The running ffmpeg process.
+    """
+    cmd = ['ffmpeg', '-loglevel', 'error', '-nostdin']
+    if start is not None:
+        cmd += ['-ss', str(start)]
+    if end is not None:
+        cmd += ['-to', str(end)]
+    cmd += ['-i', file, '-map', '0:v:0']
+    if passthrough:
+        cmd += ['-vsync', 'passthrough']
+    cmd += ['-f', 'rawvideo', '-pix_fmt', 'bgr24', '-']
+
+    return subprocess.Popen(cmd, stdout=subprocess.PIPE, bufsize=0)
+
+def read_frame(reader, width, height):
+    """
+    Reads the next raw frame from a reader process.
+
+    Inputs:
+    reader - Popen   - the process started by open_reader
+    width  - Integer - the frame width
+    height - Integer - the frame height
+
+    Returns:
+    The frame as a writable BGR numpy array, or None at the end of the video.
+    """
+    frame = np.empty((height, width, 3), np.uint8)
+    buf = memoryview(frame).cast('B')
+    read = 0
+    while read < len(buf):
+        n = reader.stdout.readinto(buf[read:])
+        if not n:
+            return None
+        read += n
+
+    return frame
+
+def open_writer(out_file, width, height, fps, audio_file=None, audio_start=None, audio_end=None,
+                encoder=None, pix_fmt=None, inband=False):
+    """
+    Starts an ffmpeg process that encodes raw BGR frames from its stdin and muxes in the
+    audio in the same pass, so the final video is written once.
+
+    Inputs:
+    out_file    - String  - where the encoded video is saved
+    width       - Integer - the frame width
+    height      - Integer - the frame height
+    fps         - Float   - the frame rate of the frames being written
+    audio_file  - String  - the file to take the audio from, or None for no audio
+    audio_start - String  - where to start the audio (HH:MM:SS or seconds), or None
+    audio_end   - String  - where to stop the audio (HH:MM:SS or seconds), or None
+    encoder     - Encoder - the encoder to use, or None for the default libx264 settings
+    pix_fmt     - String  - the pixel format to encode to, or None for yuv420p
+    inband      - Boolean - whether the parameter sets go in front of every keyframe, for
+                            pieces joined to video from another encoder
+
+    Returns:
+    The running ffmpeg process.
+    """
+    encoder = encoder or encoding.Encoder()
+    cmd = ['ffmpeg', '-loglevel', 'error', '-y',
+           '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', f'{width}x{height}', '-r', str(fps),
+           '-i', '-']
+    if audio_file is not None:
+        if audio_start is not None:
+            cmd += ['-ss', str(audio_start)]
+        if audio_end is not None:
+            cmd += ['-to', str(audio_end)]
+        cmd += ['-i', audio_file, '-map', '0:v:0', '-map', '1:a:0?', '-c:a', 'aac', '-shortest']
+    cmd += encoder.args(pix_fmt) + (inband_args(encoder.codec) if inband else []) + [out_file]
+
+    return subprocess.Popen(cmd, stdin=subprocess.PIPE)
+
+def write_frame(writer, frame):
+    """
+    Sends a frame to a writer process.
+
+    Inputs:
+    writer - Popen       - the process started by open_writer
+    frame  - numpy array - the BGR frame to encode
+
+    Returns:
+    None
+    """
+    writer.stdin.write(memoryview(np.ascontiguousarray(frame)).cast('B'))
+
+def close(proc):
+    """
+    Closes a reader or writer process and checks that ffmpeg finished cleanly.
+
+    Inputs:
+    proc - Popen - the process started by open_reader or open_writer
+
+    Returns:
+    None
+    """
+    if proc.stdin is not None:
+        proc.stdin.close()
+    if proc.stdout is not None:
+        proc.stdout.close()
+    if proc.wait() != 0:
+        raise RuntimeError(f'ffmpeg exited with code {proc.returncode}: {" ".join(proc.args)}')
@@ -0,0 +1,116 @@
+import numpy as np
+from .lazy import lazy_import
+
+# Only loaded once frames are tracked
+cv2 = lazy_import('cv2')
+
+def small_gray(frame, max_width=640):
+    """
+    Makes a small greyscale copy of a frame for cheap motion checks and optical flow.
+
+    Inputs:
+    frame     - numpy array - the BGR frame
+    max_width - Integer     - the widest the copy can be
+
+    Returns:
+    The greyscale copy and the scale from full resolution to the copy.
+    """
+    (f_h, f_w) = frame.shape[:2]
+    scale = min(1.0, max_width / f_w)
+    if scale < 1.0:
+        frame = cv2.resize(frame, (int(f_w * scale), int(f_h * scale)),
+                           interpolation=cv2.INTER_AREA)
+
+    return cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY), scale
+
+def scene_changed(prev_gray, gray, scene_thresh):
+    """
+    Checks whether two consecutive frames are different enough to be a scene change.
+
+    Inputs:
+    prev_gray    - numpy array - the small greyscale copy of the previous frame
+    gray         - numpy array - the small greyscale copy of the current frame
+    scene_thresh - Float       - the mean absolute difference (grey levels) counted as a change
+
+    Returns:
+    True if the scene changed.
+    """
+    return cv2.norm(prev_gray, gray, cv2.NORM_L1) / gray.size > scene_thresh
+
+def track_points(prev_gray, gray, pts, scale, motion_thresh=None):
+    """
+    Moves a set of points from the previous frame to the current one with sparse optical
+    flow. The whole set is shifted by the median motion of the points that tracked, which
+    keeps the shape steady even when a few points track badly.
+
+    Inputs:
+    prev_gray     - numpy array - the small greyscale copy of the previous frame
+    gray          - numpy array - the small greyscale copy of the current frame
+    pts           - numpy array - (N, 2) full resolution pixel points
+    scale         - Float       - the scale from full resolution to the greyscale copies
+    motion_thresh - Float       - the largest shift (pixels per frame at full resolution) that
+                                  is trusted, or None for no limit
+
+    Returns:
+    The moved points, or None if tracking failed or the motion was too large.
+    """
+    # Only points inside the frame can be tracked
+    (g_h, g_w) = gray.shape[:2]
+    p0 = (pts * scale).astype(np.float32)
+    inside = (p0[:, 0] >= 0) & (p0[:, 0] < g_w) & (p0[:, 1] >= 0) & (p0[:, 1] < g_h)
+    p0 = p0[inside].reshape(-1, 1, 2)
+    if len(p0) < 3:
+        return None
+
+    p1, status, _ = cv2.calcOpticalFlowPyrLK(prev_gray, gray, p0, None,
+                                             winSize=(21, 21), maxLevel=3)
+    good = status.ravel() == 1
+    if good.sum() < max(3, len(p0) // 2):
+        return None
+
+    shift = np.median((p1 - p0).reshape(-1, 2)[good], axis=0) / scale
+    if motion_thresh is not None and np.hypot(*shift) > motion_thresh:
+        return None
+
+    return pts + np.round(shift).astype(np.int32)
+
+def track_landmarks(prev_gray, gray, lms, scale, motion_thresh=None):
+    """
+    Moves a frame's pose and face landmarks on to the next frame.
+
+    Inputs:
+    prev_gray     - numpy array - the small greyscale copy of the previous frame
+    gray          - numpy array - the small greyscale copy of the current frame
+    lms           - dict        - the previous frame's landmarks (pose, faces)
+    scale         - Float       - the scale from full resolution to the greyscale copies
+    motion_thresh - Float       - the largest shift (pixels per frame at full resolution) that
+                                  is trusted, or None for no limit
+
+    Returns:
+    The moved landmarks marked as tracked, or None if a face failed to track, meaning the
+    landmarks should be detected again. A pose that fails to track is dropped.
+    """
+    tracked = {'pose': None, 'faces': [], 'tracked': True}
+    if lms['pose'] is not None:
+        tracked['pose'] = track_points(prev_gray, gray, lms['pose'], scale, motion_thresh)
+    for face in lms['faces']:
+        face = track_points(prev_gray, gray, face, scale, motion_thresh)
+        if face is None:
+            return None
+        tracked['faces'].append(face)
+
+    return tracked
+
+def dilate_region(pts, track_dilate):
+    """
+    Grows a region outward from its centre so small tracking drift can't uncover the edges.
+
+    Inputs:
+    pts          - numpy array - (N, 2) pixel points outlining the region
+    track_dilate - Float       - how much to grow the region as a fraction of its size
+
+    Returns:
+    The grown points.
+    """
+    centre = pts.mean(axis=0)
+    return (centre + (pts - centre) * (1 + track_dilate)).astype(np.int32)
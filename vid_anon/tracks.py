@@ -0,0 +1,118 @@
+import json
+import os
+import threading
+import numpy as np
+
+# Landmark counts of the mediapipe pose and face mesh models
+POSE_POINTS = 33
+FACE_POINTS = 468
+
+# The type normalized coordinates are stored as. float32 keeps them to well under a pixel on
+# any video (float16 steps are about 2 px apart near the edge of a 4K frame). Tracks written
+# before the type was recorded are float16
+DTYPE = 'float32'
+
+class TrackWriter:
+    """
+    Writes every frame's pose and face landmarks to a track directory as they are found. Each
+    kind of landmark goes in its own flat float32 file of normalized coordinates, with NaN
+    where nothing was found, so the tracks can be memory-mapped back by frame index. Frames can
+    arrive out of order from the pipeline workers and are written in order.
+    """
+    def __init__(self, tracks_dir, frame_shape, fps=None, n_faces=1, detect_every=1):
+        """
+        Inputs:
+        tracks_dir   - String  - the directory to write the tracks to
+        frame_shape  - list    - frame width, frame height
+        fps          - Float   - the frame rate of the video
+        n_faces      - Integer - the most faces saved per frame
+        detect_every - Integer - how often the landmarks were detected rather than tracked
+        """
+        os.makedirs(tracks_dir, exist_ok=True)
+        self.tracks_dir = tracks_dir
+        self.scale = np.asarray(frame_shape, dtype=np.float32)
+        self.meta = {'width': int(frame_shape[0]), 'height': int(frame_shape[1]), 'fps': fps,
+                     'n_faces': n_faces, 'detect_every': detect_every, 'frames': 0,
+                     'dtype': DTYPE}
+        self.files = {name: open(os.path.join(tracks_dir, f'{name}.bin'), 'wb')
+                      for name in ('pose', 'faces', 'tracked')}
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def write(self, idx, lms):
+        """
+        Adds one frame's landmarks (as returned by frame_processing.detect_landmarks).
+        """
+        with self.lock:
+            self.pending[idx] = lms
+            while self.meta['frames'] in self.pending:
+                self._write_frame(self.pending.pop(self.meta['frames']))
+                self.meta['frames'] += 1
+
+    def _write_frame(self, lms):
+        pose = np.full((POSE_POINTS, 2), np.nan, dtype=DTYPE)
+        faces = np.full((self.meta['n_faces'], FACE_POINTS, 2), np.nan, dtype=DTYPE)
+        if lms['pose'] is not None:
+            pose[:] = lms['pose'] / self.scale
+        for k, face in enumerate(lms['faces'][:self.meta['n_faces']]):
+            faces[k] = face / self.scale
+
+        self.files['pose'].write(pose.tobytes())
+        self.files['faces'].write(faces.tobytes())
+        self.files['tracked'].write(np.uint8(lms['tracked']).tobytes())
+
+    def close(self):
+        """
+        Finishes the files and writes the track metadata.
+        """
+        for f in self.files.values():
+            f.close()
+        with open(os.path.join(self.tracks_dir, 'tracks.json'), 'w') as f:
+            json.dump(self.meta, f)
+
+def read_tracks(tracks_dir):
+    """
+    Memory-maps a track directory written by TrackWriter.
+
+    Inputs:
+    tracks_dir - String - the directory the tracks were written to
+
+    Returns:
+    A dictionary with the (F, 33, 2) pose, (F, faces, 468, 2) faces and (F,) tracked arrays,
+    plus the track metadata under 'meta'.
+    """
+    with open(os.path.join(tracks_dir, 'tracks.json')) as f:
+        meta = json.load(f)
+    n_frames = meta['frames']
+
+    def load(name, dtype, shape):
+        path = os.path.join(tracks_dir, f'{name}.bin')
+        if n_frames == 0:
+            return np.zeros((0,) + shape, dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode='r', shape=(n_frames,) + shape)
+
+    dtype = meta.get('dtype', 'float16')
+    return {'pose': load('pose', dtype, (POSE_POINTS, 2)),
+            'faces': load('faces', dtype, (meta['n_faces'], FACE_POINTS, 2)),
+            'tracked': load('tracked', np.uint8, ()).astype(bool),
+            'meta': meta}
+
+def write_tracks(tracks_dir, arrays, meta):
+    """
+    Writes already packed landmark arrays (e.g. from the cache) out as a track directory.
+
+    Inputs:
+    tracks_dir - String - the directory to write the tracks to
+    arrays     - dict   - the pose, faces and tracked arrays
+    meta       - dict   - the track metadata
+
+    Returns:
+    None
+    """
+    os.makedirs(tracks_dir, exist_ok=True)
+    arrays['pose'].astype(DTYPE).tofile(os.path.join(tracks_dir, 'pose.bin'))
+    arrays['faces'].astype(DTYPE).tofile(os.path.join(tracks_dir, 'faces.bin'))
+    arrays['tracked'].astype(np.uint8).tofile(os.path.join(tracks_dir, 'tracked.bin'))
+    meta = dict(meta, frames=len(arrays['pose']), n_faces=arrays['faces'].shape[1], dtype=DTYPE)
+    with open(os.path.join(tracks_dir, 'tracks.json'), 'w') as f:
+        json.dump(meta, f)
@@ -1,7 +1,12 @@
 from cmath import rect
+import hashlib
+import os
 import numpy as np
-import cv2
-from scipy.spatial import ConvexHull 
+from .lazy import lazy_import
+
+# Only loaded once frames are blurred
+cv2 = lazy_import('cv2')
+spatial = lazy_import('scipy.spatial')
 
 def get_output(file, split_dir, output_dir):
     """
@@ -20,6 +25,25 @@ def get_output(file, split_dir, output_dir):
     filename = file.split(split_dir)[1][1:-4]
     return '{0}{1}_'.format(output_dir, filename) + '{0}'
 
+def get_temp_output(file, split_dir, output_dir):
+    """
+    Forms a string format for the intermediary file names that is unique to the input file,
+    so files sharing a basename in different subdirectories can be processed at the same
+    time without overwriting each other.
+
+    Inputs:
+    file       - String - the location of the original input file
+    split_dir  - String - the directory the original files are saved in
+    output_dir - String - the directory where the files will be saved
+
+    Returns:
+    A string format to accept a suffix for the intermediary file names.
+    """
+    rel_path = file.split(split_dir)[1][1:]
+    tag = hashlib.sha1(rel_path.encode()).hexdigest()[:8]
+    filename = os.path.splitext(os.path.basename(rel_path))[0]
+    return '{0}{1}_{2}_'.format(output_dir, filename, tag) + '{0}'
+
 def sort_xy(x, y):
     """
     Sorts a series of coordinates in clockwise rotation. Necessary to build the mask 
@@ -127,10 +151,96 @@ def replace_pixels(blur_rect, blurred_frame, frame):
     
     return frame
 
+def landmarks_to_array(lms, pts, frame_shape):
+    """
+    Gets the pixel coordinates of a set of mediapipe landmarks in one vectorized step.
+
+    Inputs:
+    lms         - list        - the landmarks, either from mediapipe or an (N, 2) array of
+                                normalized x, y coordinates
+    pts         - list        - the indexes to extract from the list of landmarks
+    frame_shape - list        - frame width, frame height
+
+    Returns:
+    An (N, 2) int32 array of pixel coordinates.
+    """
+    if isinstance(lms, np.ndarray):
+        coords = lms[:, :2]
+    else:
+        coords = np.array([(lm.x, lm.y) for lm in lms], dtype=np.float32)
+    coords = coords[np.asarray(pts)] * np.asarray(frame_shape, dtype=np.float32)
+
+    return coords.astype(np.int32)
+
+def pixelate(image, blocks=3):
+    """
+    Pixelates an image into blocks x blocks squares of its average colour by shrinking it
+    and scaling it back up.
+
+    Inputs:
+    image  - numpy array - the portion of the frame that should be anonymized
+    blocks - Integer     - the number of blocks in a row of the pixelation
+
+    Returns:
+    A new, pixelated copy of the image.
+    """
+    (h, w) = image.shape[:2]
+    small = cv2.resize(image, (blocks, blocks), interpolation=cv2.INTER_AREA)
+    return cv2.resize(small, (w, h), interpolation=cv2.INTER_NEAREST)
+
+def blur_region(frame, pts, num_blocks):
+    """
+    Pixelates the convex shape around a set of points in place. Only the bounding rectangle
+    of the shape is touched.
+
+    Inputs:
+    frame      - numpy array - the image to blur, modified in place
+    pts        - numpy array - (N, 2) int32 pixel coordinates outlining the shape to blur
+    num_blocks - Integer     - the amount of blurring (more blocks for bigger sizes)
+
+    Returns:
+    The frame with the region blurred.
+    """
+    (f_h, f_w) = frame.shape[:2]
+    hull = cv2.convexHull(pts.reshape(-1, 1, 2).astype(np.int32))
+
+    # Only work on the part of the bounding rectangle that is inside the frame
+    x, y, w, h = cv2.boundingRect(hull)
+    x0, y0 = max(x, 0), max(y, 0)
+    x1, y1 = min(x + w, f_w), min(y + h, f_h)
+    if x1 <= x0 or y1 <= y0:
+        return frame
+    roi = frame[y0:y1, x0:x1]
+
+    # Pixelate the rectangle and copy it back only inside the shape
+    mask = np.zeros(roi.shape[:2], np.uint8)
+    cv2.fillConvexPoly(mask, hull - np.array([x0, y0], dtype=np.int32), 1)
+    np.copyto(roi, pixelate(roi, num_blocks), where=mask.view(bool)[:, :, None])
+
+    return frame
+
 def find_and_blur_pts(frame, lms, pts, frame_shape, num_blocks): 
     """
     Takes in the frame, the outline points of the space to be blurred, separates that
-    space, blurs it, and superimposes the blur on the original image.
+    space, blurs it, and superimposes the blur on the original image. The frame is
+    blurred in place.
+
+    Inputs:
+    frame       - numpy array - the original image that will be overlayed
+    lms         - list        - the landmarks extracted from the image with mediapipe
+    pts         - list        - the list of points outlining the shape to blur
+    frame_shape - list        - the shape of the frame itself (f_w, h_h)
+    num_blocks  - Integer     - the amount of blurring (more blocks for bigger sizes)
+
+    Returns:
+    The original frame with the blur superimposed on top
+    """
+    return blur_region(frame, landmarks_to_array(lms, pts, frame_shape), num_blocks)
+
+def find_and_blur_pts_legacy(frame, lms, pts, frame_shape, num_blocks):
+    """
+    The original, unvectorized version of find_and_blur_pts. Kept only so the benchmarks can
+    compare against it.
 
     Inputs:
     frame       - numpy array - the original image that will be overlayed
@@ -160,7 +270,7 @@ def find_and_blur_pts(frame, lms, pts, frame_shape, num_blocks):
     cropped = np.concatenate((cropped, np.ones((cropped.shape[0], cropped.shape[1], 1))), axis=2)
     
     # Pull out just the outside shape to ensure the entire torso and face is blurred
-    hull = ConvexHull(points=pts)
+    hull = spatial.ConvexHull(points=pts)
     outside_shape = pts[hull.simplices].shape
     outside_points = np.unique(pts[hull.simplices].reshape(outside_shape[0]*outside_shape[1], 2), axis=0)
     ordered_points = sort_xy(outside_points[:,0], outside_points[:,1])